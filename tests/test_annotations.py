@@ -0,0 +1,120 @@
+"""
+block_break_annotations against the per-subject loops it replaced in thalhiv2_eeg_pipeline.preprocess_subject
+(legacy_block_breaks, kept here as the reference), for the default layout and the registered exceptions of
+10263 and 10264, on synthetic blockStart/blockEnd events
+
+usage:
+    python -m pytest tests
+"""
+import numpy as np
+import mne
+import pytest
+from thalhiv2_annotations import block_break_annotations
+from thalhiv2_subjects import get_subject_config
+
+
+sfreq = 2048.
+
+
+def synthetic_block_events(n_blocks=7, sfreq=2048., crashed_block=None, final_block_crashed=False, seed=0):
+    ''' blockStart/blockEnd (202/203) events with task events in between; a crashed block has no blockEnd
+    (final_block_crashed: the recording ends inside the last block, no trailing blockEnd) '''
+    rng = np.random.default_rng(seed)
+    events = []
+    sample = int(rng.integers(5, 20) * sfreq)
+    for block in range(n_blocks):
+        events.append([sample, 0, 202])
+        block_len = int(rng.uniform(300, 400) * sfreq)
+        for trial_sample in np.sort(rng.integers(sample + 1, sample + block_len, size=40)):
+            events.append([trial_sample, 0, 151])
+        sample += block_len
+        if block == crashed_block:
+            events.append([sample + int(5 * sfreq), 0, 202]) # restarted
+            sample += int(5 * sfreq) + block_len
+        if not (final_block_crashed and block == n_blocks - 1):
+            events.append([sample, 0, 203])
+        sample += int(rng.uniform(20, 90) * sfreq)
+    return np.array(events)
+
+
+def legacy_block_breaks(events, sfreq, sub):
+    ''' the per-subject loops that used to be inline in thalhiv2_eeg_pipeline.preprocess_subject '''
+    dur_list = []
+    break_onsets = []
+    descript_list = []
+    start_blk_trigs = events[(events[:,2] == 202)] # find starts of task blocks
+    stop_blk_trigs = events[(events[:,2] == 203)] # find stops of task blocks
+    if int(sub) == 10263:
+        for ind, cblkt in enumerate(stop_blk_trigs):
+            if (ind) < len(start_blk_trigs[:,0]):
+                cur_dur = (start_blk_trigs[(ind),0] - cblkt[0])/sfreq
+            else:
+                cur_dur = 0
+            dur_list.append(cur_dur + 2)
+            break_onsets.append(cblkt[0]/sfreq - 0.5)
+            descript_list.append('bad_break')
+    elif int(sub) == 10264:
+        adj_num=1
+        for ind, cblkt in enumerate(stop_blk_trigs):
+            if ind == 1:
+                cur_dur = 2
+                dur_list.append(cur_dur)
+                break_onsets.append(start_blk_trigs[(ind+adj_num),0]/sfreq - 1)
+                descript_list.append('bad_break')
+                adj_num=2
+            if (ind+adj_num) < len(start_blk_trigs[:,0]):
+                cur_dur = (start_blk_trigs[(ind+adj_num),0] - cblkt[0])/sfreq
+            else:
+                cur_dur = 2
+            dur_list.append(cur_dur + 2)
+            break_onsets.append(cblkt[0]/sfreq - 0.5)
+            descript_list.append('bad_break')
+    else:
+        for ind, cblkt in enumerate(stop_blk_trigs):
+            if (ind+1) < len(start_blk_trigs[:,0]):
+                cur_dur = (start_blk_trigs[(ind+1),0] - cblkt[0])/sfreq
+            else:
+                cur_dur = 0
+            dur_list.append(cur_dur + 2)
+            break_onsets.append(cblkt[0]/sfreq - 0.5)
+            descript_list.append('bad_break')
+    return break_onsets, dur_list, descript_list
+
+
+def assert_same_breaks(events, sub):
+    onsets, durations, descriptions = legacy_block_breaks(events, sfreq, sub)
+    legacy = mne.Annotations(onset=onsets, duration=durations, description=descriptions)
+    new = block_break_annotations(events, sfreq, **get_subject_config(sub)['block_breaks'])
+    assert len(new) == len(legacy)
+    np.testing.assert_allclose(new.onset, legacy.onset)
+    np.testing.assert_allclose(new.duration, legacy.duration)
+    assert list(new.description) == list(legacy.description)
+
+
+# -- 10263 started on a later block (first stop pairs with the first start), 10264 crashed in block 2
+@pytest.mark.parametrize('sub, events', [
+    ('10001', synthetic_block_events(sfreq=sfreq)),
+    ('10263', synthetic_block_events(sfreq=sfreq, seed=1)[1:]),
+    ('10264', synthetic_block_events(sfreq=sfreq, crashed_block=1, seed=2)),
+])
+def test_block_breaks_match_legacy(sub, events):
+    assert_same_breaks(events, sub)
+
+
+@pytest.mark.parametrize('sub, events', [
+    ('10001', synthetic_block_events(sfreq=sfreq, final_block_crashed=True, seed=3)),
+    ('10263', synthetic_block_events(sfreq=sfreq, final_block_crashed=True, seed=4)[1:]),
+    ('10264', synthetic_block_events(sfreq=sfreq, crashed_block=1, final_block_crashed=True, seed=5)),
+])
+def test_block_breaks_crashed_final_block(sub, events):
+    ''' recording ends inside the last block: no trailing blockEnd, so no break after it '''
+    assert events[events[:, 2] == 203, 0].max() < events[events[:, 2] == 202, 0].max()
+    assert_same_breaks(events, sub)
+
+
+def test_block_breaks_default_layout():
+    events = synthetic_block_events(n_blocks=3, sfreq=sfreq)
+    starts, stops = events[events[:, 2] == 202, 0], events[events[:, 2] == 203, 0]
+    breaks = block_break_annotations(events, sfreq)
+    np.testing.assert_allclose(breaks.onset, stops / sfreq - 0.5)
+    np.testing.assert_allclose(breaks.duration, np.append((starts[1:] - stops[:-1]) / sfreq, 0) + 2)
@@ -0,0 +1,161 @@
+"""
+the behavioral block csvs (thalhiv2_behavior) against what the notebook and the preprocessing script did with them:
+the per-block append, the cache of a subject's blocks, the switch type row loop and reading every block of every
+subject before selecting some of them
+
+usage:
+    python -m pytest tests
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from thalhiv2_subjects import get_subject_config, fix_behavior_block
+from thalhiv2_behavior import (load_behavior, cache_file_for, switch_dict, switch_types, read_behavior_block, update_behavior_dataset,
+                               read_behavior_dataset)
+from thalhiv2_benchmarks import synthetic_behavior_files, legacy_switch_types
+
+
+cues = ['far', 'fab', 'fsr', 'fsb', 'dar', 'dsr', 'dab', 'dsb']
+
+
+@pytest.fixture
+def block_files(tmp_path):
+    return synthetic_behavior_files(str(tmp_path)) # sub-10264, block 2 has rows dropped
+
+
+def legacy_load_behavior(files, sub_cfg):
+    ''' the per-block append of the preprocessing script '''
+    beh_df = pd.DataFrame()
+    for bf in files:
+        beh_df = pd.concat([beh_df, fix_behavior_block(pd.read_csv(bf), bf, sub_cfg)]) # what DataFrame.append did
+    return beh_df
+
+
+def test_load_behavior(block_files):
+    sub_cfg = get_subject_config('10264')
+    beh_df = load_behavior(block_files, sub_cfg)
+    pd.testing.assert_frame_equal(legacy_load_behavior(block_files, sub_cfg), beh_df.drop(columns='Switch_Type'), check_dtype=False)
+    assert len(beh_df) == 7 * 80 - (72 - 33)
+
+
+def test_load_behavior_cache(block_files, tmp_path):
+    sub_cfg = get_subject_config('10264')
+    cache_file = str(tmp_path / 'sub-10264_task-ThalHiV2_behavior.parquet')
+    expected = load_behavior(block_files, sub_cfg)
+    pd.testing.assert_frame_equal(load_behavior(block_files, sub_cfg, cache_file), expected)
+    assert os.path.exists(cache_file_for(cache_file))
+    pd.testing.assert_frame_equal(load_behavior(block_files, sub_cfg, cache_file), expected)
+    # -- an edited block file is read again
+    block_df = pd.read_csv(block_files[0])
+    block_df.loc[0, 'rt'] = -1.0
+    block_df.to_csv(block_files[0], index=False)
+    stat = os.stat(block_files[0])
+    os.utime(block_files[0], (stat.st_atime, stat.st_mtime + 10))
+    assert load_behavior(block_files, sub_cfg, cache_file)['rt'].iloc[0] == -1.0
+
+
+def block_starts(table, by):
+    keys = table[by]
+    return (keys != keys.shift()).any(axis=1).to_numpy()
+
+
+def test_switch_types():
+    rng = np.random.default_rng(0)
+    blocks = []
+    for sub in range(5):
+        version = rng.choice(3, 2, replace=False)
+        for block in range(1, 8):
+            retrocue = np.array(['texture', 'shape', 'color'])[version][np.cumsum(rng.random(80) < 0.3) % 2]
+            blocks.append(pd.DataFrame({'Participant_ID': str(10001 + sub), 'block': float(block), 'cue': rng.choice(cues, 80),
+                                        'retrocue': retrocue}))
+    table = pd.concat(blocks, ignore_index=True)
+    expected = np.concatenate([legacy_switch_types(block_df, switch_dict) for block_df in blocks])
+    assert list(switch_types(table, by=['Participant_ID', 'block'])) == list(expected)
+    assert list(switch_types(blocks[0])) == legacy_switch_types(blocks[0], switch_dict)
+
+
+def test_switch_types_block_boundaries():
+    ''' the first trial of every subject / block is Other, also when the trial before it had the same retrocue '''
+    by = ['Participant_ID', 'block']
+    table = pd.DataFrame({'Participant_ID': ['10001'] * 6 + ['10002'] * 3, 'block': [1., 1., 1., 2., 2., 2., 2., 2., 2.],
+                          'cue': ['far', 'fsr', 'fsr', 'fsr', 'dsb', 'dsb', 'dsb', 'far', 'far'], 'retrocue': 'texture'})
+    labels = switch_types(table, by=by)
+    assert list(labels) == ['Other', 'IDS', 'Repeat', 'Other', 'EDS', 'Repeat', 'Other', 'EDS', 'Repeat']
+    assert list(switch_types(table)[block_starts(table, by)]) == ['Other', 'Repeat', 'Repeat'] # one block, for contrast
+    # -- a single column works too
+    assert list(switch_types(table, by='Participant_ID')[[0, 6]]) == ['Other', 'Other']
+
+
+def test_switch_types_crashed_and_cropped_blocks(tmp_path):
+    ''' 10264 lost the middle of block 2, 10263 the first trials of block 3 (its first block) '''
+    by = ['Participant_ID', 'block']
+    subjects = {'10264': synthetic_behavior_files(str(tmp_path), '10264', seed=1),
+                '10263': synthetic_behavior_files(str(tmp_path), '10263', seed=2)[2:]}
+    blocks = []
+    for sub, files in subjects.items():
+        sub_cfg = get_subject_config(sub)
+        for bf in files:
+            block_df = fix_behavior_block(pd.read_csv(bf), bf, sub_cfg).reset_index(drop=True)
+            block_df['Participant_ID'] = sub
+            blocks.append(block_df)
+    # -- the same retrocue across every boundary
+    for block_df in blocks:
+        block_df['retrocue'] = 'shape'
+    table = pd.concat(blocks, ignore_index=True)
+    labels = switch_types(table, by=by)
+    starts = block_starts(table, by)
+    assert starts.sum() == 7 + 5
+    assert set(labels[starts]) == {'Other'} and 'Other' not in set(labels[~starts])
+    assert table.loc[starts & (table['Participant_ID'] == '10263'), 'trial'].iloc[0] == 4.0 # rows 0-2 of block 3 were dropped
+    expected = np.concatenate([legacy_switch_types(block_df, switch_dict) for block_df in blocks])
+    assert list(labels) == list(expected)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    files_by_subject = {str(10001 + sub): synthetic_behavior_files(str(tmp_path), str(10001 + sub), n_blocks=3, seed=sub) for sub in range(4)}
+    dataset_dir = str(tmp_path / 'behavior_dataset')
+    assert update_behavior_dataset(dataset_dir, files_by_subject) == list(files_by_subject)
+    return dataset_dir, files_by_subject
+
+
+def legacy_behavior_dataset(files_by_subject, subjects):
+    ''' what the notebook did: read every block of every subject, then select '''
+    df_list = []
+    for sub, files in files_by_subject.items():
+        for cur in sorted(files):
+            temp_df = fix_behavior_block(read_behavior_block(cur), cur, get_subject_config(sub))
+            temp_df['Participant_ID'] = sub
+            df_list.append(temp_df)
+    df = pd.concat(df_list, ignore_index=True)
+    return df[df.Participant_ID.isin(subjects)].reset_index(drop=True)
+
+
+def test_read_behavior_dataset(dataset):
+    dataset_dir, files_by_subject = dataset
+    subjects, columns = ['10002', '10004'], ['rt', 'correct', 'Switch_Type', 'cue']
+    df = read_behavior_dataset(dataset_dir, subjects=subjects, columns=columns)
+    assert list(df.columns) == ['cue', 'correct', 'rt', 'Switch_Type', 'Participant_ID'] # in the order of the block csvs
+    assert set(df['cue'].cat.categories) == set(df['cue']) # unused categories are dropped
+    expected = legacy_behavior_dataset(files_by_subject, subjects)
+    pd.testing.assert_frame_equal(df[columns + ['Participant_ID']].astype({'cue': str}), expected[columns + ['Participant_ID']],
+                                  check_dtype=False)
+    # -- every subject and column
+    df = read_behavior_dataset(dataset_dir)
+    expected = legacy_behavior_dataset(files_by_subject, list(files_by_subject))
+    assert list(df['Participant_ID'].unique()) == list(files_by_subject) and 'version' in df.columns
+    pd.testing.assert_frame_equal(df[expected.columns].astype({col: str for col in ['cue', 'retrocue', 'stimulus']}), expected,
+                                  check_dtype=False)
+
+
+def test_update_behavior_dataset(dataset, tmp_path):
+    dataset_dir, files_by_subject = dataset
+    assert update_behavior_dataset(dataset_dir, files_by_subject) == []
+    # -- a re-exported block only re-writes its subject
+    stat = os.stat(files_by_subject['10003'][0])
+    os.utime(files_by_subject['10003'][0], (stat.st_atime, stat.st_mtime + 10))
+    assert update_behavior_dataset(dataset_dir, files_by_subject) == ['10003']
+    files_by_subject['10005'] = synthetic_behavior_files(str(tmp_path), '10005', n_blocks=3, seed=5)
+    assert update_behavior_dataset(dataset_dir, files_by_subject) == ['10005']
+    assert list(read_behavior_dataset(dataset_dir, columns=['rt'])['Participant_ID'].unique()) == list(files_by_subject)
@@ -0,0 +1,81 @@
+"""
+the plot aggregates (thalhiv2_behavior_plots) against what seaborn / matplotlib compute at plot time: bootstrap CIs of
+the bars (resampling the trials one bootstrap at a time), box statistics, and when the cached aggregates are re-made
+
+usage:
+    python -m pytest tests
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from matplotlib import cbook
+from thalhiv2_behavior import cache_file_for
+from thalhiv2_behavior_plots import bootstrap_mean_ci, panel_aggregates, cached_aggregates
+from thalhiv2_benchmarks import legacy_bootstrap_ci
+
+
+@pytest.fixture
+def trial_df():
+    rng = np.random.default_rng(0)
+    n = 3000
+    return pd.DataFrame({'Switch_Type': rng.choice(['Repeat', 'Stay', 'IDS', 'EDS', 'HDS'], n),
+                         'cue': rng.choice(['far', 'fab', 'dsr'], n), 'version': rng.choice(['FC', 'FS'], n),
+                         'rt': rng.gamma(4, 0.2, n), 'correct': (rng.random(n) < 0.8).astype(float)})
+
+
+@pytest.mark.parametrize('y', ['rt', 'correct']) # resampled / binomial draws
+def test_bootstrap_ci(trial_df, y):
+    values = trial_df[y].to_numpy()[:400]
+    low, high = bootstrap_mean_ci(values, n_boot=5000, seed=1)
+    legacy_low, legacy_high = legacy_bootstrap_ci(values, n_boot=5000, seed=2)
+    assert low < values.mean() < high
+    assert np.allclose([low, high], [legacy_low, legacy_high], atol=0.1 * (legacy_high - legacy_low))
+    assert bootstrap_mean_ci(values, seed=1) == bootstrap_mean_ci(values, seed=1)
+    assert np.isnan(bootstrap_mean_ci(values[:0])).all()
+
+
+def test_bar_panel(trial_df):
+    agg = panel_aggregates(trial_df, 'bar', 'cue', 'correct', 'version', n_boot=2000)
+    groups = trial_df.groupby(['cue', 'version'])['correct']
+    assert list(zip(agg['x'], agg['hue'])) == list(groups.groups)
+    np.testing.assert_allclose(agg['mean'].to_numpy(float), groups.mean().to_numpy())
+    for (_, values), low, high in zip(groups, agg['ci_low'], agg['ci_high']):
+        legacy_low, legacy_high = legacy_bootstrap_ci(values.to_numpy(), n_boot=2000, seed=0)
+        assert np.allclose([low, high], [legacy_low, legacy_high], atol=0.15 * (legacy_high - legacy_low))
+
+
+def test_box_panel(trial_df):
+    agg = panel_aggregates(trial_df, 'box', 'Switch_Type', 'rt')
+    boxes, fliers = agg[agg['kind'] == 'box'], agg[agg['kind'] == 'flier']
+    for switch, values in trial_df.groupby('Switch_Type')['rt']:
+        stats = cbook.boxplot_stats(values.to_numpy())[0]
+        row = boxes[boxes['x'] == switch].iloc[0]
+        np.testing.assert_allclose(row[['q1', 'med', 'q3', 'whislo', 'whishi']].to_numpy(float),
+                                   [stats[key] for key in ['q1', 'med', 'q3', 'whislo', 'whishi']])
+        np.testing.assert_allclose(np.sort(fliers.loc[fliers['x'] == switch, 'value'].to_numpy(float)), np.sort(stats['fliers']))
+
+
+def test_empty_panel(trial_df):
+    excluded = trial_df.assign(rt=np.nan)
+    assert panel_aggregates(excluded, 'bar', 'Switch_Type', 'rt').empty
+    assert panel_aggregates(excluded, 'box', 'Switch_Type', 'rt').empty
+
+
+def test_cached_aggregates(trial_df, tmp_path):
+    cache_file = str(tmp_path / 'plots' / 'switch.parquet')
+    panels = {'rt_switch': ('bar', trial_df, 'Switch_Type', 'rt', None), 'rt_box': ('box', trial_df, 'Switch_Type', 'rt', None),
+              'rt_empty': ('bar', trial_df.assign(rt=np.nan), 'Switch_Type', 'rt', None)}
+    aggregates = cached_aggregates(cache_file, 'subjects', panels, n_boot=200)
+    assert set(aggregates['panel']) == {'rt_switch', 'rt_box'}
+    made = os.stat(cache_file_for(cache_file)).st_mtime_ns
+    pd.testing.assert_frame_equal(cached_aggregates(cache_file, 'subjects', panels, n_boot=200), aggregates)
+    assert os.stat(cache_file_for(cache_file)).st_mtime_ns == made
+    # -- the same with jobs, every group has its own seed
+    pd.testing.assert_frame_equal(cached_aggregates(str(tmp_path / 'jobs.parquet'), 'subjects', panels, n_boot=200, jobs=2), aggregates)
+    # -- same number of rows, other trials (e.g. another filter): re-made
+    shifted = trial_df.assign(rt=trial_df['rt'] + 1)
+    panels['rt_switch'] = ('bar', shifted, 'Switch_Type', 'rt', None)
+    changed = cached_aggregates(cache_file, 'subjects', panels, n_boot=200)
+    rows = changed['panel'] == 'rt_switch'
+    np.testing.assert_allclose(changed.loc[rows, 'mean'].to_numpy(float), aggregates.loc[rows, 'mean'].to_numpy(float) + 1)
@@ -0,0 +1,77 @@
+"""
+the per-subject behavioral summary (thalhiv2_behavior_summary) against the trial table it is made from: the
+accuracy based exclusion, the trial count per switch type, means / sds per group and the update after a new subject
+
+usage:
+    python -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from thalhiv2_behavior import update_behavior_dataset, read_behavior_dataset
+from thalhiv2_behavior_summary import (update_behavior_summary, read_behavior_summary, summary_stats, subject_accuracy,
+                                       low_accuracy_subjects)
+from thalhiv2_benchmarks import synthetic_behavior_files
+
+
+switches = ['Repeat', 'Stay', 'IDS', 'EDS', 'HDS']
+
+
+@pytest.fixture
+def summary(tmp_path):
+    files_by_subject = {str(10001 + sub): synthetic_behavior_files(str(tmp_path), str(10001 + sub), n_blocks=3, seed=sub) for sub in range(8)}
+    dataset_dir = str(tmp_path / 'behavior_dataset')
+    summary_file = str(tmp_path / 'behavior_summary.parquet')
+    update_behavior_dataset(dataset_dir, files_by_subject)
+    assert update_behavior_summary(dataset_dir, summary_file) == list(files_by_subject)
+    return dataset_dir, summary_file, files_by_subject
+
+
+def test_exclusion_and_switch_counts(summary):
+    dataset_dir, summary_file, _ = summary
+    # -- what the notebook did on the trial table
+    ThalHi_df = read_behavior_dataset(dataset_dir)
+    ThalHi_df = ThalHi_df[ThalHi_df['rt'] > 0]
+    tmp_overall_acc = ThalHi_df[['Participant_ID', 'correct']].groupby(by="Participant_ID").mean().reset_index()
+    pars_to_exclude = [int(subj) for subj, acc in zip(tmp_overall_acc['Participant_ID'], tmp_overall_acc['correct']) if acc < 0.5]
+    usable_df = ThalHi_df[~ThalHi_df.Participant_ID.astype(int).isin(pars_to_exclude)]
+    expected_counts = [len(usable_df[usable_df['Switch_Type'] == switch]) for switch in switches]
+    summary_df = read_behavior_summary(summary_file)
+    pd.testing.assert_frame_equal(subject_accuracy(summary_df), tmp_overall_acc, check_dtype=False)
+    assert low_accuracy_subjects(summary_df, 0.5) == pars_to_exclude
+    switch_counts = summary_stats(summary_df, ['Switch_Type'], exclude=pars_to_exclude).set_index('Switch_Type')['n']
+    assert [int(switch_counts.get(switch, 0)) for switch in switches] == expected_counts
+
+
+@pytest.mark.parametrize('trials', ['responded', 'all'])
+def test_summary_stats(summary, trials):
+    dataset_dir, summary_file, _ = summary
+    trial_df = read_behavior_dataset(dataset_dir)
+    if trials == 'responded':
+        trial_df = trial_df[trial_df['rt'] > 0]
+    by, subjects = ['cue', 'version'], ['10002', '10003', '10005']
+    trial_df = trial_df[trial_df['Participant_ID'].isin(subjects)]
+    expected = trial_df.groupby(by, observed=True)[['rt', 'correct']].agg(['count', 'mean', 'std'])
+    stats = summary_stats(read_behavior_summary(summary_file), by, trials, subjects=subjects).set_index(by)
+    for var in ['rt', 'correct']:
+        np.testing.assert_array_equal(stats[var + '_n'].to_numpy(), expected[(var, 'count')].to_numpy())
+        np.testing.assert_allclose(stats[var + '_mean'].to_numpy(), expected[(var, 'mean')].to_numpy())
+        np.testing.assert_allclose(stats[var + '_sd'].to_numpy(), expected[(var, 'std')].to_numpy())
+    # -- no grouping: one row over all trials
+    overall = summary_stats(read_behavior_summary(summary_file), None, trials, subjects=subjects)
+    assert overall['n'].item() == len(trial_df)
+    assert np.isclose(overall['rt_sd'].item(), trial_df['rt'].std())
+
+
+def test_update_behavior_summary(summary, tmp_path):
+    dataset_dir, summary_file, files_by_subject = summary
+    before = read_behavior_summary(summary_file)
+    assert update_behavior_summary(dataset_dir, summary_file) == []
+    files_by_subject['10999'] = synthetic_behavior_files(str(tmp_path), '10999', n_blocks=3, seed=999)
+    update_behavior_dataset(dataset_dir, files_by_subject)
+    assert update_behavior_summary(dataset_dir, summary_file) == ['10999']
+    after = read_behavior_summary(summary_file)
+    pd.testing.assert_frame_equal(after[after['Participant_ID'] != '10999'].reset_index(drop=True), before)
+    trial_df = read_behavior_dataset(dataset_dir, subjects=['10999'])
+    assert after.loc[(after['Participant_ID'] == '10999') & (after['trials'] == 'all'), 'n'].sum() == len(trial_df)
+    assert read_behavior_summary(summary_file, subjects=[10999])['Participant_ID'].unique().tolist() == ['10999']
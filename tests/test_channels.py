@@ -0,0 +1,41 @@
+"""
+saved_bad_channels on preprocessingParameters csv rows as the pipeline reads them (read_preproc_params), in the
+current layout (extra_bad_channels column) and the legacy one (extra channels appended to bad_channels)
+
+usage:
+    python -m pytest tests
+"""
+import pandas as pd
+import pytest
+from thalhiv2_channels import saved_bad_channels
+
+
+def replay_row(tmp_path, row):
+    ''' write row as a one-line preprocessingParameters csv and read it back like read_preproc_params '''
+    csv_file = tmp_path / 'sub-10001_task-ThalHiV2_preprocessingParameters.csv'
+    pd.DataFrame(row, index=[0]).to_csv(csv_file, index=False)
+    return pd.read_csv(csv_file, keep_default_na=False).iloc[0].to_dict()
+
+
+def test_split_row(tmp_path):
+    prior = replay_row(tmp_path, {'Participant_ID': '10001', 'bad_channels': 'Fp1 T7', 'extra_bad_channels': 'Oz'})
+    assert saved_bad_channels(prior) == (['Fp1', 'T7'], ['Oz'])
+
+
+def test_split_row_without_extra_channels(tmp_path):
+    prior = replay_row(tmp_path, {'Participant_ID': '10001', 'bad_channels': 'Fp1', 'extra_bad_channels': ''})
+    assert saved_bad_channels(prior) == (['Fp1'], [])
+
+
+def test_legacy_row_refused(tmp_path):
+    ''' the old pipeline appended the post-ICA channels (Oz here) to bad_channels, batch mode can not split them '''
+    prior = replay_row(tmp_path, {'Participant_ID': '10001', 'bad_channels': 'Fp1 T7 Oz', 'bad_ICs': '[0, 3]'})
+    with pytest.raises(ValueError, match='extra_bad_channels'):
+        saved_bad_channels(prior)
+    assert saved_bad_channels(prior, legacy_ok=True) == (['Fp1', 'T7', 'Oz'], [])
+
+
+def test_legacy_row_without_bad_channels(tmp_path):
+    prior = replay_row(tmp_path, {'Participant_ID': '10001', 'bad_channels': '', 'bad_ICs': '[0, 3]'})
+    assert saved_bad_channels(prior) == ([], [])
+    assert saved_bad_channels({}) == ([], [])
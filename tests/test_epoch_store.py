@@ -0,0 +1,74 @@
+"""
+the memory-mapped epoch store (thalhiv2_epoch_store) against the -epo.fif file it is made from: full data, slices of
+epochs / channels / time, the bookkeeping in the sidecar and the round trip back to mne
+
+usage:
+    python -m pytest tests
+"""
+import os
+import numpy as np
+import pandas as pd
+import mne
+import pytest
+from thalhiv2_epoch_store import (save_epoch_store, store_file_for, read_epoch_store, slice_epoch_store, epoch_store_to_mne,
+                                  epoch_store_is_current)
+from thalhiv2_benchmarks import synthetic_epoch_raw
+
+
+@pytest.fixture(scope='module')
+def epo_file(tmp_path_factory):
+    raw, events = synthetic_epoch_raw(n_channels=16, sfreq=256., duration=300, n_events=40, seed=2)
+    raw.set_montage('biosemi64')
+    metadata = pd.DataFrame({'trial': np.arange(len(events)), 'cue': np.where(np.arange(len(events)) % 2, 'far', 'dsb')})
+    epochs = mne.Epochs(raw, events, tmin=-0.8, tmax=1.7, baseline=None, metadata=metadata, reject={'eeg': 150e-6},
+                        preload=True, verbose=False)
+    epo_file = str(tmp_path_factory.mktemp('store') / 'sub-00000_task-ThalHiV2_stim_eeg-epo.fif')
+    epochs.save(epo_file, verbose=False)
+    save_epoch_store(mne.read_epochs(epo_file, preload=False, verbose=False), store_file_for(epo_file), source_file=epo_file)
+    return epo_file
+
+
+def test_full_data(epo_file):
+    epochs = mne.read_epochs(epo_file, preload=True, verbose=False)
+    data, times = slice_epoch_store(store_file_for(epo_file))
+    np.testing.assert_array_equal(data, epochs.get_data())
+    np.testing.assert_allclose(times, epochs.times)
+
+
+def test_slice(epo_file):
+    epochs = mne.read_epochs(epo_file, preload=True, verbose=False)
+    trials, channels = np.arange(0, len(epochs), 3), epochs.ch_names[2:5]
+    data, times = slice_epoch_store(store_file_for(epo_file), trials, channels, 0.0, 0.5)
+    expected = epochs[trials].pick(channels).crop(0.0, 0.5)
+    np.testing.assert_array_equal(data, expected.get_data())
+    np.testing.assert_allclose(times, expected.times)
+
+
+def test_sidecar(epo_file):
+    epochs = mne.read_epochs(epo_file, preload=False, verbose=False)
+    data, sidecar = read_epoch_store(store_file_for(epo_file))
+    assert isinstance(data, np.memmap) and data.shape == (len(epochs), len(epochs.ch_names), len(epochs.times))
+    np.testing.assert_array_equal(sidecar['events'], epochs.events)
+    np.testing.assert_array_equal(sidecar['selection'], epochs.selection)
+    assert [tuple(log) for log in sidecar['drop_log']] == list(epochs.drop_log)
+    pd.testing.assert_frame_equal(sidecar['metadata'], epochs.metadata, check_index_type=False)
+
+
+def test_round_trip(epo_file, tmp_path):
+    epochs = mne.read_epochs(epo_file, preload=True, verbose=False)
+    back = epoch_store_to_mne(store_file_for(epo_file))
+    np.testing.assert_array_equal(back.get_data(), epochs.get_data())
+    np.testing.assert_array_equal(back.events, epochs.events)
+    assert back.drop_log == epochs.drop_log and back.ch_names == epochs.ch_names
+    ch = epochs.ch_names[0]
+    np.testing.assert_allclose(back.get_montage().get_positions()['ch_pos'][ch], epochs.get_montage().get_positions()['ch_pos'][ch])
+    back.save(tmp_path / 'back-epo.fif', verbose=False)
+    np.testing.assert_array_equal(mne.read_epochs(tmp_path / 'back-epo.fif', verbose=False).get_data(), epochs.get_data())
+
+
+def test_store_is_current(epo_file):
+    store_file = store_file_for(epo_file)
+    assert epoch_store_is_current(store_file, epo_file)
+    stat = os.stat(epo_file)
+    os.utime(epo_file, (stat.st_atime, stat.st_mtime + 10)) # the fif was re-made
+    assert not epoch_store_is_current(store_file, epo_file)
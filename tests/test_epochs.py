@@ -0,0 +1,68 @@
+"""
+build_epochs against mne.Epochs(..., reject=...) for the trial epoch types of one synthetic recording (same data,
+drop log, selection and metadata), with the trl peak-to-peak handed in, computed in build_epochs, or not matching
+
+usage:
+    python -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+import mne
+import pytest
+from thalhiv2_epochs import build_epochs
+from thalhiv2_rejection import epoch_ptp
+from thalhiv2_benchmarks import synthetic_epoch_raw
+
+
+reject = {'eeg': 150e-6}
+# -- offset of each event from the cue, event code and (tmin, tmax); the response window ends after the trl one
+trial_events = {'trl': (0, 111, (-1.0, 6.0)), 'cue': (0, 111, (-0.8, 1.2)), 'retro_cue': (1.3, 141, (-1.0, 2.0)),
+                'stim': (3.8, 151, (-0.8, 1.7)), 'resp': (5.3, 171, (-0.8, 1.2))}
+
+
+@pytest.fixture(scope='module')
+def recording():
+    raw, cue_events = synthetic_epoch_raw(n_channels=16, sfreq=256., duration=400, n_events=60, seed=1)
+    sfreq = raw.info['sfreq']
+    metadata = pd.DataFrame({'trial': np.arange(len(cue_events))})
+    specs = {name: {'events': cue_events + [int(offset * sfreq), 0, code - 1], 'event_id': {name: code}, 'tmin': window[0],
+                    'tmax': window[1], 'metadata': metadata} for name, (offset, code, window) in trial_events.items()}
+    return raw, cue_events, specs
+
+
+def assert_same_as_mne(raw, specs, epochs):
+    for name, spec in specs.items():
+        expected = mne.Epochs(raw, reject=reject, baseline=None, on_missing='warn', event_repeated='drop', preload=True,
+                              verbose=False, **spec)
+        assert 0 < len(expected) < len(spec['events'])
+        np.testing.assert_array_equal(epochs[name].get_data(), expected.get_data())
+        np.testing.assert_array_equal(epochs[name].selection, expected.selection)
+        np.testing.assert_array_equal(epochs[name].events, expected.events)
+        assert epochs[name].drop_log == expected.drop_log
+        pd.testing.assert_frame_equal(epochs[name].metadata, expected.metadata)
+
+
+def test_build_epochs_with_trl_ptp(recording):
+    raw, cue_events, specs = recording
+    trl_ptp = epoch_ptp(raw, cue_events, *trial_events['trl'][2])
+    assert_same_as_mne(raw, specs, build_epochs(raw, specs, reject, trl_ptp))
+
+
+def test_build_epochs_without_trl_ptp(recording):
+    raw, _, specs = recording
+    assert_same_as_mne(raw, specs, build_epochs(raw, specs, reject))
+
+
+def test_build_epochs_stale_trl_ptp(recording):
+    ''' a peak-to-peak matrix made with other bads is not used '''
+    raw, cue_events, specs = recording
+    raw.info['bads'] = [raw.ch_names[0]]
+    trl_ptp = epoch_ptp(raw, cue_events, *trial_events['trl'][2])
+    raw.info['bads'] = []
+    assert_same_as_mne(raw, specs, build_epochs(raw, specs, reject, trl_ptp))
+
+
+def test_build_epochs_without_trl(recording):
+    raw, _, specs = recording
+    wanted = {name: specs[name] for name in ['stim', 'resp']}
+    assert_same_as_mne(raw, wanted, build_epochs(raw, wanted, reject))
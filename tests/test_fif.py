@@ -0,0 +1,61 @@
+"""
+read_epochs_bookkeeping and epoch_counts (thalhiv2_fif) against mne.read_epochs(preload=False), for a plain epochs
+file, one with epochs rejected by hand and one split over several files
+
+usage:
+    python -m pytest tests
+"""
+import numpy as np
+import mne
+import pytest
+from thalhiv2_fif import read_epochs_bookkeeping, epoch_counts, epoch_counts_table
+from thalhiv2_benchmarks import synthetic_epoch_raw
+
+
+reject = {'eeg': 150e-6}
+
+
+@pytest.fixture(scope='module')
+def epochs():
+    raw, events = synthetic_epoch_raw(n_channels=64, sfreq=256., duration=900, n_events=60, seed=3)
+    epochs = mne.Epochs(raw, events, tmin=-0.8, tmax=1.7, baseline=None, reject=reject, preload=True, verbose=False)
+    assert 0 < len(epochs) < len(events)
+    return epochs
+
+
+def assert_same_as_mne(epo_file):
+    expected = mne.read_epochs(epo_file, preload=False, verbose=False)
+    selection, drop_log, file_reject = read_epochs_bookkeeping(epo_file)
+    np.testing.assert_array_equal(selection, expected.selection)
+    assert drop_log == expected.drop_log
+    assert file_reject == expected.reject
+
+
+def test_bookkeeping(epochs, tmp_path):
+    epo_file = str(tmp_path / 'sub-00000_task-ThalHiV2_stim_eeg-epo.fif')
+    epochs.save(epo_file, verbose=False)
+    assert_same_as_mne(epo_file)
+
+
+def test_bookkeeping_user_rejected(epochs, tmp_path):
+    epo_file = str(tmp_path / 'sub-00000_task-ThalHiV2_stim_eeg-epo.fif')
+    epochs.copy().drop([0, 2], reason='USER', verbose=False).save(epo_file, verbose=False)
+    assert_same_as_mne(epo_file)
+    counts = epoch_counts(epo_file)
+    assert counts['n_dropped_user'] == 2 and counts['n_kept'] == len(epochs) - 2
+    assert counts['n_events'] == len(epochs.drop_log) and counts['reject_eeg_uv'] == 150.0
+
+
+def test_bookkeeping_split_file(epochs, tmp_path):
+    epo_file = str(tmp_path / 'sub-00000_task-ThalHiV2_stim_eeg-epo.fif')
+    epochs.save(epo_file, split_size='2MB', verbose=False)
+    assert len(list(tmp_path.glob('*.fif'))) > 1
+    assert_same_as_mne(epo_file)
+
+
+def test_counts_table(epochs, tmp_path):
+    epo_file = str(tmp_path / 'sub-00000_task-ThalHiV2_stim_eeg-epo.fif')
+    epochs.save(epo_file, verbose=False)
+    table = epoch_counts_table([('00000', 'stim', epo_file), ('00000', 'trl', str(tmp_path / 'missing-epo.fif'))], jobs=2)
+    assert list(table['status']) == ['ok', 'failed'] # sorted by epoch type
+    assert table.loc[table['epoch_type'] == 'stim', 'n_kept'].item() == len(epochs)
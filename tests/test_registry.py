@@ -0,0 +1,78 @@
+"""
+the preprocessing registry (thalhiv2_registry): concurrent writers, import of the google sheet export and the
+preprocessingParameters csv files, and the export in the sheet layout
+
+usage:
+    python -m pytest tests
+"""
+import multiprocessing
+import numpy as np
+import pandas as pd
+from thalhiv2_registry import (update_subject, update_subjects, read_registry, sheet_table, import_sheet, import_param_csvs,
+                               parse_assignment, main)
+
+
+def write_fields(task):
+    ''' one writer process: n_writes single-field updates of its own subject and of a shared one '''
+    registry_file, writer, n_writes = task
+    for ind in range(n_writes):
+        update_subject(registry_file, 10001 + writer, {'field_' + str(ind): ind})
+        update_subjects(registry_file, {10000: {'writer_' + str(writer): ind}, 10001 + writer: {'last': ind}})
+
+
+def test_concurrent_writers(tmp_path):
+    registry_file = str(tmp_path / 'registry.sqlite')
+    n_writers, n_writes = 4, 25
+    with multiprocessing.get_context('spawn').Pool(n_writers) as pool:
+        pool.map(write_fields, [(registry_file, writer, n_writes) for writer in range(n_writers)])
+    registry = read_registry(registry_file).set_index('Subject_ID')
+    assert list(registry.index) == list(range(10000, 10001 + n_writers))
+    for writer in range(n_writers):
+        assert registry.at[10000, 'writer_' + str(writer)] == n_writes - 1
+        assert registry.at[10001 + writer, 'last'] == n_writes - 1
+        assert [registry.at[10001 + writer, 'field_' + str(ind)] for ind in range(n_writes)] == list(range(n_writes))
+
+
+def test_sheet_round_trip(tmp_path):
+    registry_file = str(tmp_path / 'registry.sqlite')
+    sheet = pd.DataFrame({'Subject_ID': [10001, 10002, 10003], 'Usable': [1, 0, 1], 'Usable_stim_epochs': [380, np.nan, 402],
+                          'Usable_trl_epochs': [350, np.nan, 399], 'Usable_resp_epochs': [370, np.nan, 390],
+                          'notes': ['', 'lost the last block', '']})
+    sheet_csv = tmp_path / 'Preprocessing.csv'
+    # -- the downloaded sheet also has rows that are not subjects (empty lines, totals)
+    pd.concat([sheet, pd.DataFrame({'Subject_ID': ['total'], 'Usable': [2]})]).to_csv(sheet_csv, index=False)
+    import_sheet(registry_file, sheet_csv)
+    exported = sheet_table(registry_file)
+    pd.testing.assert_frame_equal(exported[sheet.columns[:-1]], sheet[sheet.columns[:-1]], check_dtype=False)
+    assert list(exported['notes'].fillna('')) == list(sheet['notes'])
+    # -- an update only touches its own fields
+    update_subject(registry_file, 10002, {'Usable': 1})
+    exported = sheet_table(registry_file).set_index('Subject_ID')
+    assert exported.at[10002, 'Usable'] == 1 and exported.at[10002, 'notes'] == 'lost the last block'
+
+
+def test_import_param_csvs(tmp_path):
+    registry_file = str(tmp_path / 'registry.sqlite')
+    csv_files = []
+    for sub, bads in [('10001', 'Fp1 T7'), ('10002', '')]:
+        csv_files.append(str(tmp_path / ('sub-' + sub + '_task-ThalHiV2_preprocessingParameters.csv')))
+        pd.DataFrame({'Participant_ID': sub, 'bad_channels': bads, 'bad_ICs': '[0, 3]', 'epo_reject_eeg_uv': 125.0}, index=[0]).to_csv(csv_files[-1], index=False)
+    assert import_param_csvs(registry_file, csv_files) == 8
+    registry = read_registry(registry_file).set_index('Subject_ID')
+    assert registry.at[10001, 'bad_channels'] == 'Fp1 T7' and registry.at[10002, 'bad_channels'] == ''
+    assert registry.at[10001, 'epo_reject_eeg_uv'] == 125.0
+
+
+def test_parse_assignment():
+    assert parse_assignment('Usable=0') == ('Usable', 0)
+    assert parse_assignment('bad_ICs=[0, 3]') == ('bad_ICs', [0, 3])
+    assert parse_assignment('notes=lost the last block') == ('notes', 'lost the last block')
+
+
+def test_cli_set_and_export(tmp_path):
+    registry_file = str(tmp_path / 'registry.sqlite')
+    export_csv = tmp_path / 'export.csv'
+    assert main(['--registry', registry_file, '--set', '10001', 'Usable=0', 'notes=bad cap', '--export_sheet', str(export_csv)]) == 0
+    exported = pd.read_csv(export_csv)
+    assert list(exported.columns[:2]) == ['Subject_ID', 'Usable']
+    assert exported.loc[0, ['Subject_ID', 'Usable', 'notes']].tolist() == [10001, 0, 'bad cap']
@@ -0,0 +1,52 @@
+"""
+thalhiv2_rejection on a small synthetic recording: the epochs surviving_epochs keeps against mne.Epochs(..., reject=...)
+and suggested_threshold with and without usable epochs
+
+usage:
+    python -m pytest tests
+"""
+import numpy as np
+import mne
+from thalhiv2_rejection import epoch_ptp, surviving_epochs, suggested_threshold
+
+
+sfreq = 256.
+
+
+def synthetic_raw(n_events=20, seed=0):
+    ''' 8 eeg channels of noise with a few large artifacts, and one event every 2 s '''
+    rng = np.random.default_rng(seed)
+    info = mne.create_info(['E' + str(ind) for ind in range(8)], sfreq, 'eeg')
+    data = rng.normal(0, 10e-6, (8, int((n_events * 2 + 4) * sfreq)))
+    for sample in rng.integers(0, data.shape[1], 6):
+        data[rng.integers(0, 8), sample] += 300e-6
+    raw = mne.io.RawArray(data, info, verbose=False)
+    events = np.column_stack([np.arange(1, n_events + 1) * int(2 * sfreq), np.zeros(n_events, int), np.ones(n_events, int)])
+    return raw, events
+
+
+def test_surviving_epochs_match_mne():
+    raw, events = synthetic_raw()
+    raw.set_annotations(mne.Annotations([7.5], [1.], ['bad_break']))
+    reject = {'eeg': 150e-6}
+    ptp_info = epoch_ptp(raw, events, -0.2, 1.0)
+    epochs = mne.Epochs(raw, events, tmin=-0.2, tmax=1.0, baseline=None, reject=reject, preload=True, verbose=False)
+    assert 0 < len(epochs) < len(events)
+    np.testing.assert_array_equal(np.flatnonzero(surviving_epochs(ptp_info, reject)), epochs.selection)
+
+
+def test_suggested_threshold():
+    raw, events = synthetic_raw()
+    ptp_info = epoch_ptp(raw, events, -0.2, 1.0)
+    worst = ptp_info['ptp'].max(axis=1)
+    med = np.median(worst)
+    assert np.isclose(suggested_threshold(ptp_info), med + 3 * 1.4826 * np.median(np.abs(worst - med)))
+
+
+def test_suggested_threshold_without_usable_epochs():
+    ''' every epoch inside a bad annotation: no threshold instead of a ValueError from np.max of an empty array '''
+    raw, events = synthetic_raw()
+    raw.set_annotations(mne.Annotations([0.], [raw.times[-1]], ['bad_break']))
+    ptp_info = epoch_ptp(raw, events, -0.2, 1.0)
+    assert not ptp_info['usable'].any()
+    assert suggested_threshold(ptp_info) is None
@@ -0,0 +1,58 @@
+"""
+Annotations built from the ThalHiV2 trigger events
+    block_break_annotations(events, sfreq, ...) - 'bad_break' annotations covering the breaks between task blocks
+    events_in_recording(events, sfreq, sub_cfg) - events inside the part of a recording the pipeline keeps
+                                                  (registered crop / concatenate_segments), for uncropped data
+
+a break runs from pad_before seconds before a blockEnd (203) trigger until pad_after seconds after the next
+blockStart (202). Recordings that did not go as planned are described by the "block_breaks" entry of the
+subject in thalhiv2_subject_exceptions.json, whose values are passed straight through as keyword arguments:
+
+    start_offset   - which start ends the break after stop i (start i + start_offset), default 1
+    crashed_starts - indices of blockStart triggers of blocks that crashed (no blockEnd), the blocks after
+                     them pair with the start one further on and a short break is added where the task restarted
+    last_break_dur - break length (before padding) after the last stop if no start follows it, default 0
+"""
+import numpy as np
+import mne
+
+
+block_start_code = 202
+block_stop_code = 203
+
+
+def block_break_annotations(events, sfreq, orig_time=None, pad_before=0.5, pad_after=2.0, start_offset=1,
+                            crashed_starts=(), crash_pad_before=1.0, crash_dur=2.0, last_break_dur=0.0,
+                            description='bad_break'):
+    ''' 'bad_break' mne.Annotations for the breaks between blocks, from an (n_events, 3) events array '''
+    events = np.asarray(events)
+    starts = events[events[:, 2] == block_start_code, 0]
+    stops = events[events[:, 2] == block_stop_code, 0]
+    crashed_starts = np.asarray(crashed_starts, dtype=int)
+    # -- start that ends the break after each stop, skipping the starts of crashed blocks
+    start_idx = np.arange(len(stops)) + start_offset
+    start_idx = start_idx + np.sum(start_idx[:, None] > crashed_starts[None, :], axis=1)
+    has_start = start_idx < len(starts)
+    next_start = np.append(starts, 0)[np.minimum(start_idx, len(starts))]
+    onsets = stops / sfreq - pad_before
+    durations = np.where(has_start, (next_start - stops) / sfreq, last_break_dur) + pad_after
+    # -- short break where the task was restarted after a crash
+    crash_next = crashed_starts[crashed_starts + 1 < len(starts)] + 1
+    onsets = np.concatenate([onsets, starts[crash_next] / sfreq - crash_pad_before])
+    durations = np.concatenate([durations, np.full(len(crash_next), crash_dur)])
+    order = np.argsort(onsets, kind='stable')
+    return mne.Annotations(onset=onsets[order], duration=durations[order], description=[description] * len(order),
+                           orig_time=orig_time)
+
+
+def events_in_recording(events, sfreq, sub_cfg, first_samp=0):
+    ''' events that fall inside the registered crop / concatenate_segments windows of an uncropped recording '''
+    events = np.asarray(events)
+    windows = sub_cfg['concatenate_segments'] or ([sub_cfg['crop']] if sub_cfg['crop'] else [])
+    if not windows:
+        return events
+    times = (events[:, 0] - first_samp) / sfreq
+    keep = np.zeros(len(events), dtype=bool)
+    for window in windows:
+        keep |= (times >= window.get('tmin', 0)) & (times <= window.get('tmax', np.inf))
+    return events[keep]
@@ -0,0 +1,152 @@
+"""
+Lightweight readers for BioSemi (.bdf) recordings
+    read_bdf_header     - parse the fixed + per-channel header without touching the data records
+    read_status_channel - decode only the Status (trigger) channel, in chunks through a memory map
+    find_bdf_events     - same (sample, prev, code) array as mne.find_events, from the Status channel alone
+    scan_bdf_file       - header plus trigger counts for one recording (used by thalhiv2_raw_to_bids.py --scan)
+
+BDF header layout (all fields are ascii, space padded)
+    256 bytes of fixed fields, then 256 bytes per channel stored field by field
+    (all labels, then all transducer types, ...), then the data records
+"""
+import os
+import datetime
+import numpy as np
+
+
+# (field name, bytes per channel) in the order they are stored after the fixed header
+_channel_fields = [('label', 16), ('transducer', 80), ('physical_dim', 8),
+                   ('physical_min', 8), ('physical_max', 8), ('digital_min', 8), ('digital_max', 8),
+                   ('prefilter', 80), ('n_samples', 8), ('reserved', 32)]
+
+
+def read_bdf_header(fname):
+    ''' parse the header of a bdf file and return it as a dict (no data records are read) '''
+    with open(fname, 'rb') as f:
+        fixed = f.read(256)
+        n_channels = int(fixed[252:256].decode('ascii').strip())
+        ch_header = f.read(256 * n_channels)
+    header = {'file': fname,
+              'file_size': os.path.getsize(fname),
+              'subject_info': fixed[8:88].decode('ascii', 'ignore').strip(),
+              'recording_info': fixed[88:168].decode('ascii', 'ignore').strip(),
+              'header_bytes': int(fixed[184:192].decode('ascii').strip()),
+              'n_records': int(fixed[236:244].decode('ascii').strip()),
+              'record_duration': float(fixed[244:252].decode('ascii').strip()),
+              'n_channels': n_channels}
+    try:
+        header['meas_date'] = datetime.datetime.strptime(fixed[168:184].decode('ascii'), '%d.%m.%y%H.%M.%S')
+    except ValueError:
+        header['meas_date'] = None
+    offset = 0
+    for field, n_bytes in _channel_fields:
+        values = [ch_header[offset + ii * n_bytes: offset + (ii + 1) * n_bytes].decode('ascii', 'ignore').strip()
+                  for ii in range(n_channels)]
+        if field == 'n_samples':
+            values = np.asarray(values, dtype=int)
+        elif field in ['physical_min', 'physical_max', 'digital_min', 'digital_max']:
+            values = np.asarray(values, dtype=float)
+        header[field] = values
+        offset += n_bytes * n_channels
+    header['ch_names'] = header.pop('label')
+    # -- a crashed recording can leave n_records at -1, so fall back on the file size
+    record_bytes = 3 * int(header['n_samples'].sum())
+    if header['n_records'] < 0:
+        header['n_records'] = (header['file_size'] - header['header_bytes']) // record_bytes
+    header['record_bytes'] = record_bytes
+    header['sfreq'] = float(header['n_samples'][0] / header['record_duration'])
+    header['duration'] = header['n_records'] * header['record_duration']
+    header['status_idx'] = header['ch_names'].index('Status') if 'Status' in header['ch_names'] else None
+    return header
+
+
+def read_status_channel(fname, header=None, chunk_records=512):
+    ''' decode the Status channel of a bdf file without reading any of the other channels
+
+    the file is memory mapped as (n_records, record_bytes) and only the Status columns of each
+    record are pulled in, chunk_records records at a time. Values are masked to the lower 17 bits
+    exactly like mne.io.read_raw_bdf does for its stim channel.
+    '''
+    if header is None:
+        header = read_bdf_header(fname)
+    status_idx = header['status_idx']
+    if status_idx is None:
+        raise ValueError("No Status channel found in " + fname)
+    if np.any(header['n_samples'] != header['n_samples'][status_idx]):
+        raise ValueError("Status channel is not sampled at the same rate as the data channels in " + fname)
+    n_records = header['n_records']
+    col_start = 3 * int(header['n_samples'][:status_idx].sum())
+    col_stop = col_start + 3 * int(header['n_samples'][status_idx])
+    data_map = np.memmap(fname, dtype=np.uint8, mode='r', offset=header['header_bytes'],
+                         shape=(n_records, header['record_bytes']))
+    status = np.empty(n_records * int(header['n_samples'][status_idx]), dtype=np.int32)
+    n_done = 0
+    for rec_start in range(0, n_records, chunk_records):
+        raw_bytes = np.asarray(data_map[rec_start:rec_start + chunk_records, col_start:col_stop]).reshape(-1, 3).astype(np.int32)
+        values = raw_bytes[:, 0] | (raw_bytes[:, 1] << 8) | (raw_bytes[:, 2] << 16)
+        values <<= 8  # sign-extend the 24 bit samples
+        values >>= 8
+        status[n_done:n_done + len(values)] = np.bitwise_and(values, 2**17 - 1)
+        n_done += len(values)
+    del data_map
+    return status
+
+
+def find_status_events(status, first_samp=0, shortest_event=2):
+    ''' onsets of increasing steps in a trigger vector, matching mne.find_events with its default options
+
+    returns an (n_events, 3) array of [sample, previous value, new value]. Like mne, a ValueError is raised
+    if two events are closer than shortest_event samples (use shortest_event=1 to turn that check off).
+    '''
+    status = np.asarray(status, dtype=np.int64)
+    step_idx = np.flatnonzero(np.diff(status) != 0) + 1
+    if len(step_idx) == 0:
+        return np.empty((0, 3), dtype='int32')
+    steps = np.c_[step_idx + first_samp, status[step_idx - 1], status[step_idx]]
+    # -- a trigger still high at the end of the recording counts as returning to 0
+    if steps[-1, 2] != 0:
+        steps = np.vstack([steps, [len(status) + first_samp, steps[-1, 2], 0]])
+    # -- an onset is any increase, an offset is a decrease to 0 or an increase from a non-zero value
+    onsets = steps[:, 2] > steps[:, 1]
+    offsets = (onsets | (steps[:, 2] == 0)) & (steps[:, 1] > 0)
+    onset_idx = np.flatnonzero(onsets)
+    offset_idx = np.flatnonzero(offsets)
+    if len(onset_idx) == 0 or len(offset_idx) == 0:
+        return np.empty((0, 3), dtype='int32')
+    if onset_idx[-1] > offset_idx[-1]:
+        onset_idx = onset_idx[:-1]
+    events = steps[onset_idx]
+    n_short_events = np.sum(np.diff(events[:, 0]) < shortest_event)
+    if n_short_events > 0:
+        raise ValueError("You have " + str(n_short_events) + " events shorter than the shortest_event.")
+    return events
+
+
+def find_bdf_events(fname, shortest_event=2, first_samp=0, last_samp=None):
+    ''' events of a bdf recording read from its Status channel only
+
+    first_samp/last_samp restrict the search to a cropped part of the recording (pass raw.first_samp and
+    raw.last_samp of a cropped Raw to get the same events mne.find_events would return for it)
+    '''
+    status = read_status_channel(fname)
+    stop = len(status) if last_samp is None else last_samp + 1
+    return find_status_events(status[first_samp:stop], first_samp=first_samp, shortest_event=shortest_event)
+
+
+def count_triggers(events, codes):
+    ''' number of events for each trigger code in codes (dict of name: code) '''
+    return {name: int(np.sum(events[:, 2] == code)) for name, code in codes.items()}
+
+
+def scan_bdf_file(fname, codes, shortest_event=1):
+    ''' header summary plus trigger counts for one recording, reading only the header and Status channel '''
+    header = read_bdf_header(fname)
+    events = find_status_events(read_status_channel(fname, header), shortest_event=shortest_event)
+    scan = {'file': os.path.basename(fname),
+            'meas_date': header['meas_date'],
+            'duration_s': header['duration'],
+            'sfreq': header['sfreq'],
+            'n_channels': header['n_channels'],
+            'n_events': len(events)}
+    scan.update(count_triggers(events, codes))
+    return scan
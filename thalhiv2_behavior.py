@@ -0,0 +1,243 @@
+"""
+Behavioral (task output) csv files of the ThalHiV2 EEG task
+    read_behavior_block(fname, cfg)        - one block csv with explicit dtypes and the registered row fixes
+    load_behavior(files, cfg, cache_file)  - all blocks of a subject in one data frame (one concat), cached
+    cached_frame(cache_file, key, build)   - build() once, then re-load it while key still matches
+    switch_types(df, by)                   - Repeat / Stay / IDS / EDS / HDS label of every trial (Other for the first
+                                             trial of a block), from shifted columns and a lookup array
+    update_behavior_dataset(dataset_dir, files_by_subject) - (re)build the partitions of new or changed subjects
+    read_behavior_dataset(dataset_dir, subjects, columns)  - read back only the subjects and columns asked for
+
+the cache is a parquet file (pickle if neither pyarrow nor fastparquet is installed) with a thalhiv2_cache sidecar
+whose key hashes the name, size and modification time of every source csv plus the registered fixes, so editing or
+adding a block file, or changing thalhiv2_subject_exceptions.json, rebuilds it on the next load
+
+the behavioral dataset of all subjects is a directory with one partition per subject (hive layout,
+<dataset_dir>/Participant_ID=XXXXX/part-0.parquet, same format and sidecar as the cache) and categorical cue, retrocue,
+stimulus and version columns
+"""
+import os
+import importlib.util
+import numpy as np
+import pandas as pd
+from thalhiv2_cache import stage_key, source_key, sidecar_file, read_checkpoint, valid_checkpoint, write_checkpoint
+from thalhiv2_subjects import get_subject_config, fix_behavior_block
+
+
+# -- columns written by ThalHi_BEH_EEG_Task_v2-3.py (numbers are saved from float arrays, e.g. "1.0")
+behavior_dtypes = {'block': 'float64', 'trial': 'float64', 'delay': 'float64', 'retro_freq': 'float64',
+                   'cue': str, 'texture': str, 'shape': str, 'color': str, 'retrocue': str, 'stimulus': str,
+                   'image_filename': str, 'task': str,
+                   'corr_resp': 'float64', 'subj_resp': 'float64', 'correct': 'float64', 'rt': 'float64'}
+cache_format = 'parquet' if any(importlib.util.find_spec(engine) for engine in ['pyarrow', 'fastparquet']) else 'pickle'
+
+# switch_dict[retrocue][cur_cue][prev_cue]
+switch_dict = { 'texture': { 'fsr': { 'fsr': 'Stay', 'fsb': 'Stay', 'far': 'IDS', 'fab': 'IDS', 'dsr': 'EDS', 'dsb': 'EDS', 'dab': 'EDS', 'dar': 'EDS', 'Task':'Scene' },
+                            'fsb': { 'fsr': 'Stay', 'fsb': 'Stay', 'far': 'IDS', 'fab': 'IDS', 'dsr': 'EDS', 'dsb': 'EDS', 'dab': 'EDS', 'dar': 'EDS', 'Task':'Scene' },
+                            'far': { 'fsr': 'IDS', 'fsb': 'IDS', 'far': 'Stay', 'fab': 'Stay', 'dsr': 'EDS', 'dsb': 'EDS', 'dab': 'EDS', 'dar': 'EDS', 'Task':'Face' },
+                            'fab': { 'fsr': 'IDS', 'fsb': 'IDS', 'far': 'Stay', 'fab': 'Stay', 'dsr': 'EDS', 'dsb': 'EDS', 'dab': 'EDS', 'dar': 'EDS', 'Task':'Face' },
+                            'dsr': { 'fsr': 'EDS', 'fsb': 'EDS', 'far': 'EDS', 'fab': 'EDS', 'dsr': 'Stay', 'dsb': 'IDS', 'dab': 'IDS', 'dar': 'Stay', 'Task':'Face' },
+                            'dsb': { 'fsr': 'EDS', 'fsb': 'EDS', 'far': 'EDS', 'fab': 'EDS', 'dsr': 'IDS', 'dsb': 'Stay', 'dab': 'Stay', 'dar': 'IDS', 'Task':'Scene' },
+                            'dab': { 'fsr': 'EDS', 'fsb': 'EDS', 'far': 'EDS', 'fab': 'EDS', 'dsr': 'IDS', 'dsb': 'Stay', 'dab': 'Stay', 'dar': 'IDS', 'Task':'Scene' },
+                            'dar': { 'fsr': 'EDS', 'fsb': 'EDS', 'far': 'EDS', 'fab': 'EDS', 'dsr': 'Stay', 'dsb': 'IDS', 'dab': 'IDS', 'dar': 'Stay', 'Task':'Face' } },
+                'shape': { 'fsr': { 'fsr': 'Stay', 'fsb': 'IDS', 'far': 'EDS', 'fab': 'EDS', 'dsr': 'Stay', 'dsb': 'IDS', 'dab': 'EDS', 'dar': 'EDS', 'Task':'Face' },
+                           'fsb': { 'fsr': 'IDS', 'fsb': 'Stay', 'far': 'EDS', 'fab': 'EDS', 'dsr': 'IDS', 'dsb': 'Stay', 'dab': 'EDS', 'dar': 'EDS', 'Task':'Scene' },
+                           'far': { 'fsr': 'EDS', 'fsb': 'EDS', 'far': 'Stay', 'fab': 'Stay', 'dsr': 'EDS', 'dsb': 'EDS', 'dab': 'IDS', 'dar': 'IDS', 'Task':'Face' },
+                           'fab': { 'fsr': 'EDS', 'fsb': 'EDS', 'far': 'Stay', 'fab': 'Stay', 'dsr': 'EDS', 'dsb': 'EDS', 'dab': 'IDS', 'dar': 'IDS', 'Task':'Face' },
+                           'dsr': { 'fsr': 'Stay', 'fsb': 'IDS', 'far': 'EDS', 'fab': 'EDS', 'dsr': 'Stay', 'dsb': 'IDS', 'dab': 'EDS', 'dar': 'EDS', 'Task':'Face' },
+                           'dsb': { 'fsr': 'IDS', 'fsb': 'Stay', 'far': 'EDS', 'fab': 'EDS', 'dsr': 'IDS', 'dsb': 'Stay', 'dab': 'EDS', 'dar': 'EDS', 'Task':'Scene' },
+                           'dab': { 'fsr': 'EDS', 'fsb': 'EDS', 'far': 'IDS', 'fab': 'IDS', 'dsr': 'EDS', 'dsb': 'EDS', 'dab': 'Stay', 'dar': 'Stay', 'Task':'Scene' },
+                           'dar': { 'fsr': 'EDS', 'fsb': 'EDS', 'far': 'IDS', 'fab': 'IDS', 'dsr': 'EDS', 'dsb': 'EDS', 'dab': 'Stay', 'dar': 'Stay', 'Task':'Scene' } },
+                'color': { 'fsr': { 'fsr': 'Stay', 'fsb': 'EDS', 'far': 'IDS', 'fab': 'EDS', 'dsr': 'Stay', 'dsb': 'EDS', 'dab': 'EDS', 'dar': 'IDS', 'Task':'Scene' },
+                          'fsb': { 'fsr': 'EDS', 'fsb': 'Stay', 'far': 'EDS', 'fab': 'Stay', 'dsr': 'EDS', 'dsb': 'IDS', 'dab': 'IDS', 'dar': 'EDS', 'Task':'Face' },
+                          'far': { 'fsr': 'IDS', 'fsb': 'EDS', 'far': 'Stay', 'fab': 'EDS', 'dsr': 'IDS', 'dsb': 'EDS', 'dab': 'EDS', 'dar': 'Stay', 'Task':'Face' },
+                          'fab': { 'fsr': 'EDS', 'fsb': 'Stay', 'far': 'EDS', 'fab': 'Stay', 'dsr': 'EDS', 'dsb': 'IDS', 'dab': 'IDS', 'dar': 'EDS', 'Task':'Face' },
+                          'dsr': { 'fsr': 'Stay', 'fsb': 'EDS', 'far': 'IDS', 'fab': 'EDS', 'dsr': 'Stay', 'dsb': 'EDS', 'dab': 'EDS', 'dar': 'IDS', 'Task':'Scene' },
+                          'dsb': { 'fsr': 'EDS', 'fsb': 'IDS', 'far': 'EDS', 'fab': 'IDS', 'dsr': 'EDS', 'dsb': 'Stay', 'dab': 'Stay', 'dar': 'EDS', 'Task':'Scene' },
+                          'dab': { 'fsr': 'EDS', 'fsb': 'IDS', 'far': 'EDS', 'fab': 'IDS', 'dsr': 'EDS', 'dsb': 'Stay', 'dab': 'Stay', 'dar': 'EDS', 'Task':'Scene' },
+                          'dar': { 'fsr': 'IDS', 'fsb': 'EDS', 'far': 'Stay', 'fab': 'EDS', 'dsr': 'IDS', 'dsb': 'EDS', 'dab': 'EDS', 'dar': 'Stay', 'Task':'Face' } } }
+switch_labels = np.array(['Other', 'Repeat', 'Stay', 'IDS', 'EDS', 'HDS'], dtype=object)
+switch_retrocues = list(switch_dict.keys())
+switch_cues = [cue for cue in switch_dict['texture'] if cue != 'Task']
+# -- label index for [retrocue, cue, previous cue], a repeated cue is a Repeat whatever switch_dict says
+switch_lookup = np.array([[[list(switch_labels).index(switch_dict[retrocue][cue][prev_cue]) for prev_cue in switch_cues]
+                           for cue in switch_cues] for retrocue in switch_retrocues])
+switch_lookup[:, np.arange(len(switch_cues)), np.arange(len(switch_cues))] = list(switch_labels).index('Repeat')
+
+
+def read_behavior_block(fname, cfg=None):
+    ''' one behavioral block csv (index 0 .. n-1 like pd.read_csv) with its Switch_Type column and, if cfg is given,
+    the registered fixes for its block (switch types are worked out before rows are dropped, like the notebook did)
+    '''
+    df = pd.read_csv(fname, dtype=behavior_dtypes)
+    df['Switch_Type'] = switch_types(df)
+    return fix_behavior_block(df, fname, cfg) if cfg is not None else df
+
+
+def switch_types(df, by=None):
+    ''' switch type label of every row of df (one or more blocks in trial order), the same labels as the row loop
+    over switch_dict[retrocue][cue][prev_cue] the notebook used
+
+    by - column(s) whose value changes at the first trial of a block (e.g. ['Participant_ID', 'block']), default
+         is to treat df as a single block
+    '''
+    cue = df['cue'].to_numpy(dtype=object)
+    retrocue = df['retrocue'].to_numpy(dtype=object)
+    first = np.zeros(len(df), dtype=bool)
+    first[:1] = True
+    if by is not None:
+        keys = df[[by] if isinstance(by, str) else list(by)]
+        first |= (keys != keys.shift()).any(axis=1).to_numpy()
+    prev_cue = np.roll(cue, 1)
+    same_retrocue = ~first & (retrocue == np.roll(retrocue, 1))
+    repeat = same_retrocue & (cue == prev_cue)
+    looked_up = same_retrocue & ~repeat
+    retro_idx = pd.Categorical(retrocue, categories=switch_retrocues).codes
+    cue_idx = pd.Categorical(cue, categories=switch_cues).codes
+    prev_idx = np.roll(cue_idx, 1)
+    unknown = looked_up & ((retro_idx < 0) | (cue_idx < 0) | (prev_idx < 0))
+    if unknown.any():
+        row = np.flatnonzero(unknown)[0]
+        raise KeyError("no switch type for retrocue " + repr(retrocue[row]) + ", cue " + repr(cue[row]) + " after cue " + repr(prev_cue[row]))
+    labels = np.full(len(df), list(switch_labels).index('HDS'))
+    labels[same_retrocue] = switch_lookup[retro_idx, cue_idx, prev_idx][same_retrocue]
+    labels[first] = list(switch_labels).index('Other')
+    return switch_labels[labels]
+
+
+def behavior_key(files, fixes, params=None):
+    ''' cache key of data built from files (name, size and mtime of each) with these fixes and extra params '''
+    return stage_key('behavior', None, {'files': [source_key(fname) for fname in sorted(files)], 'fixes': fixes,
+                                        'dtypes': {col: str(dtype) for col, dtype in behavior_dtypes.items()},
+                                        'derived': ['Switch_Type'], 'params': params})
+
+
+def cache_file_for(fname):
+    ''' <name>.parquet -> <name>.pkl when parquet can not be written here '''
+    return fname if cache_format == 'parquet' else os.path.splitext(fname)[0] + '.pkl'
+
+
+def write_frame(df, fname):
+    ''' df -> fname (parquet or pickle, see cache_format), swapped in only once it is complete '''
+    tmp_file = fname + '.tmp'
+    if cache_format == 'parquet':
+        df.to_parquet(tmp_file)
+    else:
+        df.to_pickle(tmp_file)
+    os.replace(tmp_file, fname)
+
+
+def read_frame(fname, columns=None):
+    ''' data frame written by write_frame, parquet only reads the requested columns from disk '''
+    if cache_format == 'parquet':
+        return pd.read_parquet(fname, columns=columns)
+    df = pd.read_pickle(fname)
+    return df if columns is None else df[columns]
+
+
+def cached_frame(cache_file, key, build):
+    ''' the data frame saved in cache_file if it was made with key, else build() (saved for next time) '''
+    cache_file = cache_file_for(cache_file)
+    if valid_checkpoint(cache_file, 'behavior', key, adopt=False):
+        return read_frame(cache_file)
+    df = build()
+    write_frame(df, cache_file)
+    write_checkpoint(cache_file, 'behavior', key, details={'n_rows': len(df), 'format': cache_format})
+    return df
+
+
+def load_behavior(files, cfg, cache_file=None):
+    ''' all block files of one subject, fixed and concatenated once (each block keeps its own 0 .. n-1 index) '''
+    build = lambda: pd.concat([read_behavior_block(fname, cfg) for fname in files]) if files else pd.DataFrame()
+    if cache_file is None:
+        return build()
+    return cached_frame(cache_file, behavior_key(files, cfg['behavior_fixes']), build)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# behavioral dataset of all subjects, one partition per subject
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# -- categorical columns with fixed levels, so every partition has the same categories and they concatenate as categoricals
+category_levels = {'cue': switch_cues, 'retrocue': switch_retrocues, 'stimulus': ['Face', 'Scene'],
+                   'version': ['FC', 'FS', 'SC', 'ERROR']}
+
+
+def task_version(retrocues):
+    ''' FC / FS / SC from the two retrocues used in a block, ERROR if it is not one of those pairs '''
+    retrocues = set(retrocues)
+    for version, pair in [('FC', {'texture', 'color'}), ('FS', {'texture', 'shape'}), ('SC', {'shape', 'color'})]:
+        if pair <= retrocues:
+            return version
+    return 'ERROR'
+
+
+def subject_behavior_table(sub, files, cfg):
+    ''' every block file of a subject with Switch_Type, the registered fixes, Participant_ID and version (per block) '''
+    blocks = []
+    for fname in sorted(files):
+        block_df = read_behavior_block(fname, cfg)
+        block_df['Participant_ID'] = str(sub)
+        block_df['version'] = task_version(block_df['retrocue'].unique())
+        blocks.append(block_df)
+    df = pd.concat(blocks, ignore_index=True)
+    for col, levels in category_levels.items():
+        df[col] = pd.Categorical(df[col], categories=levels)
+    return df
+
+
+def partition_file(dataset_dir, sub):
+    return cache_file_for(os.path.join(dataset_dir, 'Participant_ID=' + str(sub), 'part-0.parquet'))
+
+
+def dataset_subjects(dataset_dir):
+    ''' subjects with a complete partition (the sidecar is written last) '''
+    if not os.path.isdir(dataset_dir):
+        return []
+    subs = [name.split('=', 1)[1] for name in os.listdir(dataset_dir) if name.startswith('Participant_ID=')]
+    return sorted(sub for sub in subs if os.path.exists(sidecar_file(partition_file(dataset_dir, sub))))
+
+
+def update_behavior_dataset(dataset_dir, files_by_subject, cfg_func=get_subject_config):
+    ''' (re)write the partition of every subject that is new or whose files / fixes changed, returns those subjects
+
+    files_by_subject - {subject: [block csv files]}, the other partitions are left as they are
+    '''
+    updated = []
+    for sub, files in sorted(files_by_subject.items()):
+        cfg = cfg_func(sub)
+        key = behavior_key(files, cfg['behavior_fixes'], {'dataset': 'subject_partition', 'categories': category_levels})
+        part_file = partition_file(dataset_dir, sub)
+        if valid_checkpoint(part_file, 'behavior', key, adopt=False):
+            continue
+        df = subject_behavior_table(sub, files, cfg)
+        os.makedirs(os.path.dirname(part_file), exist_ok=True)
+        # -- the partition column is stored in the directory name only (hive layout, readable by pyarrow datasets too)
+        write_frame(df.drop(columns='Participant_ID'), part_file)
+        write_checkpoint(part_file, 'behavior', key, details={'n_rows': len(df), 'format': cache_format, 'columns': list(df.columns)})
+        updated.append(sub)
+    return updated
+
+
+def read_behavior_dataset(dataset_dir, subjects=None, columns=None):
+    ''' one data frame with the requested subjects (default all) and columns (default all), only those are read
+
+    Participant_ID (the partition) is always included, unused categories are dropped, so e.g. plots only show the
+    versions that are in the selection
+    '''
+    subs = dataset_subjects(dataset_dir)
+    if subjects is not None:
+        subs = [sub for sub in subs if sub in {str(subject) for subject in subjects}]
+    parts = []
+    for sub in subs:
+        part_file = partition_file(dataset_dir, sub)
+        all_columns = read_checkpoint(part_file)['details']['columns']
+        wanted = all_columns if columns is None else [col for col in all_columns if col in columns or col == 'Participant_ID']
+        part_df = read_frame(part_file, [col for col in wanted if col != 'Participant_ID'])
+        part_df.insert(wanted.index('Participant_ID'), 'Participant_ID', sub)
+        parts.append(part_df)
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(parts, ignore_index=True)
+    for col in df.columns.intersection(list(category_levels)):
+        df[col] = df[col].cat.remove_unused_categories()
+    return df
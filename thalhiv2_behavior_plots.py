@@ -0,0 +1,177 @@
+"""
+Plot-ready aggregates for the box and bar plots of the behavioral notebook
+    panel_aggregates(df, kind, x, y, hue)          - box statistics (quartiles, whiskers, fliers) or mean and bootstrap CI
+                                                     of y for every x (and hue) group of the trial table
+    cached_aggregates(cache_file, key, panels)     - the aggregates of several panels, computed once and then re-loaded
+                                                     while key (the subjects' dataset partitions, panel settings and a
+                                                     hash of each panel's data) matches
+    subset_key(dataset_dir, subjects)              - key of the trial data of some subjects, for cached_aggregates
+    draw_aggregates(ax, aggregates, panel, order)  - box or bar plot of one panel from its aggregates
+
+the figures only draw these small tables (a few rows per x / hue group), the trial table is only needed when the
+subjects or panels change. The box statistics are the ones seaborn / matplotlib boxplots use (linear interpolated
+quartiles, whiskers at the furthest point within 1.5 IQR) and the bars show the mean with a 95% percentile bootstrap
+CI over trials like sns.barplot (same method, its own random draws, so CI bounds differ from seaborn's within the
+bootstrap noise). Bootstraps are vectorized per group (binomial draws for 0/1 columns such as correct, which have the
+same distribution as resampling the trials) and groups can be spread over jobs processes.
+"""
+import os
+import contextlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from thalhiv2_cache import stage_key, read_checkpoint
+from thalhiv2_behavior import cached_frame, partition_file
+
+
+aggregate_columns = ['panel', 'kind', 'x', 'hue', 'n', 'mean', 'ci_low', 'ci_high', 'q1', 'med', 'q3', 'whislo', 'whishi', 'value']
+boot_chunk = 2**22 # bootstrap indices drawn at a time (32 MB of int64)
+
+
+def bootstrap_mean_ci(values, n_boot=1000, ci=95, seed=None):
+    ''' (low, high) percentile bootstrap CI of the mean of values '''
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n == 0:
+        return np.nan, np.nan
+    rng = np.random.default_rng(seed)
+    if np.isin(values, [0, 1]).all():
+        boot = rng.binomial(n, values.mean(), n_boot) / n
+    else:
+        boot = np.empty(n_boot)
+        step = max(1, boot_chunk // n)
+        for start in range(0, n_boot, step):
+            stop = min(start + step, n_boot)
+            boot[start:stop] = values[rng.integers(0, n, (stop - start, n))].mean(axis=1)
+    return tuple(np.percentile(boot, [50 - ci / 2, 50 + ci / 2]))
+
+
+def bootstrap_task(task):
+    return bootstrap_mean_ci(*task)
+
+
+def group_columns(x, hue):
+    return [x] if hue is None else [x, hue]
+
+
+def box_aggregates(df, x, y, hue=None):
+    ''' box rows (quartiles and whiskers per group) and flier rows (one per point beyond the whiskers) '''
+    keys = group_columns(x, hue)
+    data = df[keys + [y]].dropna(subset=[y])
+    groups = data.groupby(keys, observed=True, sort=True)[y]
+    boxes = groups.quantile([0.25, 0.5, 0.75]).unstack()
+    boxes.columns = ['q1', 'med', 'q3']
+    boxes['n'] = groups.size()
+    boxes = boxes.reset_index()
+    data = data.merge(boxes[keys + ['q1', 'q3']], on=keys, how='left')
+    iqr = data['q3'] - data['q1']
+    inside = data[y].between(data['q1'] - 1.5 * iqr, data['q3'] + 1.5 * iqr)
+    whiskers = data[inside].groupby(keys, observed=True)[y].agg(whislo='min', whishi='max').reset_index()
+    boxes = boxes.merge(whiskers, on=keys, how='left')
+    boxes['kind'] = 'box'
+    fliers = data.loc[~inside, keys + [y]].rename(columns={y: 'value'})
+    fliers['kind'] = 'flier'
+    return pd.concat([boxes, fliers], ignore_index=True)
+
+
+def bar_aggregates(df, x, y, hue=None, n_boot=1000, ci=95, seed=0, pool=None):
+    ''' mean and bootstrap CI of y per group, each group with its own seed (so the same with or without a pool) '''
+    keys = group_columns(x, hue)
+    data = df[keys + [y]].dropna(subset=[y])
+    groups = data.groupby(keys, observed=True, sort=True)[y]
+    bars = groups.agg(n='size', mean='mean').reset_index()
+    seeds = np.random.SeedSequence(seed).spawn(len(bars))
+    tasks = [(values.to_numpy(), n_boot, ci, group_seed) for (_, values), group_seed in zip(groups, seeds)]
+    if pool is not None and len(tasks) > 1:
+        cis = list(pool.map(bootstrap_task, tasks))
+    else:
+        cis = [bootstrap_task(task) for task in tasks]
+    bars['ci_low'] = [low for low, _ in cis]
+    bars['ci_high'] = [high for _, high in cis]
+    bars['kind'] = 'bar'
+    return bars
+
+
+def panel_aggregates(df, kind, x, y, hue=None, n_boot=1000, ci=95, seed=0, pool=None):
+    ''' aggregate rows of one box ('box') or bar ('bar') panel, with the x / hue groups as strings '''
+    if df[y].isna().all():
+        # -- e.g., every subject of the subset was excluded, the panel stays empty
+        return pd.DataFrame(columns=aggregate_columns)
+    if kind == 'box':
+        agg = box_aggregates(df, x, y, hue)
+    else:
+        agg = bar_aggregates(df, x, y, hue, n_boot, ci, seed, pool)
+    agg = agg.rename(columns={x: 'x'} if hue is None else {x: 'x', hue: 'hue'})
+    agg['x'] = agg['x'].astype(str)
+    agg['hue'] = agg['hue'].astype(str) if hue is not None else None
+    return agg.reindex(columns=aggregate_columns)
+
+
+def subset_key(dataset_dir, subjects):
+    ''' key of the dataset partitions of these subjects (changes when one of them is re-built or a subject is added) '''
+    return stage_key('plot_subset', None, {str(sub): read_checkpoint(partition_file(dataset_dir, sub))['output_key']
+                                           for sub in sorted(str(sub) for sub in subjects)})
+
+
+def data_hash(df, columns):
+    ''' hash of the values (and row order) of these columns, so a changed filter or subset re-computes the panel '''
+    return str(int(pd.util.hash_pandas_object(df[columns], index=False).to_numpy().astype(np.uint64).dot(
+        np.arange(1, len(df) + 1, dtype=np.uint64))))
+
+
+def cached_aggregates(cache_file, key, panels, n_boot=1000, ci=95, seed=0, jobs=1):
+    ''' aggregates of every panel in panels ({name: (kind, df, x, y, hue)}), in one table with a panel column
+
+    key should identify the trial data (see subset_key); the panel settings, a hash of the data of every panel (so
+    a different filter with the same number of rows is noticed too) and the bootstrap parameters are added to it
+    '''
+    settings = {name: [kind, x, y, hue, data_hash(df, group_columns(x, hue) + [y])] for name, (kind, df, x, y, hue) in panels.items()}
+    full_key = stage_key('plot_aggregates', key, {'panels': settings, 'n_boot': n_boot, 'ci': ci, 'seed': seed})
+    def build():
+        # -- one pool for the bootstrap groups of all panels
+        with (ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else contextlib.nullcontext()) as pool:
+            aggs = [panel_aggregates(df, kind, x, y, hue, n_boot, ci, seed, pool).assign(panel=name)
+                    for name, (kind, df, x, y, hue) in panels.items()]
+        return pd.concat(aggs, ignore_index=True)[aggregate_columns]
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    return cached_frame(cache_file, full_key, build)
+
+
+def draw_aggregates(ax, aggregates, panel, order=None, hue_order=None, xlabel=None, ylabel=None):
+    ''' box or bar plot of one panel, groups at the positions of order (default: all x in sorted order) '''
+    import matplotlib.pyplot as plt
+    rows = aggregates[aggregates['panel'] == panel]
+    kind = 'box' if (rows['kind'] == 'box').any() else 'bar'
+    order = list(order) if order is not None else list(dict.fromkeys(rows.loc[rows['kind'] != 'flier', 'x']))
+    hues = list(hue_order) if hue_order is not None else list(dict.fromkeys(rows['hue'].dropna()))
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    width = 0.8 / max(len(hues), 1)
+    for hue_ind, hue in enumerate(hues or [None]):
+        hue_rows = rows if hue is None else rows[rows['hue'] == hue]
+        groups = hue_rows[hue_rows['kind'] == kind].set_index('x')
+        xs = [x for x in order if x in groups.index]
+        positions = np.array([order.index(x) for x in xs]) - 0.4 + width * (hue_ind + 0.5)
+        group_colors = [colors[(hue_ind if hue is not None else order.index(x)) % len(colors)] for x in xs]
+        if kind == 'box':
+            fliers = hue_rows[hue_rows['kind'] == 'flier']
+            stats = [{'med': groups.at[x, 'med'], 'q1': groups.at[x, 'q1'], 'q3': groups.at[x, 'q3'], 'whislo': groups.at[x, 'whislo'],
+                      'whishi': groups.at[x, 'whishi'], 'fliers': fliers.loc[fliers['x'] == x, 'value'].to_numpy()} for x in xs]
+            boxes = ax.bxp(stats, positions=positions, widths=width * 0.8, patch_artist=True, manage_ticks=False,
+                           medianprops={'color': '0.2'}, flierprops={'marker': 'd', 'markersize': 4})
+            for patch, color in zip(boxes['boxes'], group_colors):
+                patch.set_facecolor(color)
+            if hue is not None and boxes['boxes']:
+                boxes['boxes'][0].set_label(hue)
+        else:
+            means = groups.loc[xs, 'mean'].to_numpy()
+            ax.bar(positions, means, width=width, color=group_colors, label=hue)
+            ax.errorbar(positions, means, yerr=[means - groups.loc[xs, 'ci_low'].to_numpy(), groups.loc[xs, 'ci_high'].to_numpy() - means],
+                        fmt='none', ecolor='0.26', elinewidth=1.5)
+    ax.set_xticks(np.arange(len(order)))
+    ax.set_xticklabels(order)
+    ax.set_xlim(-0.5, len(order) - 0.5)
+    ax.set_xlabel(xlabel or '')
+    ax.set_ylabel(ylabel or '')
+    if hues:
+        ax.legend()
+    return ax
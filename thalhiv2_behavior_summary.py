@@ -0,0 +1,130 @@
+"""
+Per-subject summary statistics of the behavioral dataset (see thalhiv2_behavior.py), for the accuracy based exclusion
+and the group-level numbers of the behavioral notebook
+    update_behavior_summary(dataset_dir, summary_file)      - summarize the subjects that are new or whose partition changed
+    read_behavior_summary(summary_file, subjects)           - the summary table (of some subjects)
+    summary_stats(summary, by, trials, subjects, exclude)   - trial count, mean and sd of rt and correct per group
+    subject_accuracy(summary, trials)                       - overall accuracy of every subject
+    low_accuracy_subjects(summary, thresh, trials)          - subjects below the exclusion threshold (int ids)
+
+the summary has one row per subject, trial set and (cue, Switch_Type, version) cell with the count, sum and sum of
+squares of rt and correct, so any coarser grouping (by subject, switch type, cue x version, ...) is a sum over rows;
+a few thousand rows for all subjects instead of the trial table. The trial sets are 'responded' (rt > 0, ThalHi_df in
+the notebook) and 'all' (ThalHi_df_all_trls, missed trials included).
+
+it is saved next to the dataset (same format as the behavior cache) with a sidecar holding the dataset partition key
+each subject was summarized from, so adding a subject only summarizes that subject's trials
+"""
+import os
+import numpy as np
+import pandas as pd
+from thalhiv2_cache import stage_key, read_checkpoint, write_checkpoint
+from thalhiv2_behavior import (category_levels, cache_format, cache_file_for, write_frame, read_frame, partition_file,
+                               dataset_subjects, read_behavior_dataset)
+
+
+cell_columns = ['cue', 'Switch_Type', 'version']
+summary_variables = ['rt', 'correct']
+trial_sets = {'responded': lambda df: df[df['rt'] > 0], 'all': lambda df: df}
+sum_columns = ['n'] + [var + suffix for var in summary_variables for suffix in ['_n', '_sum', '_sumsq']]
+summary_params = {'cells': cell_columns, 'variables': summary_variables, 'trial_sets': list(trial_sets)}
+
+
+def subject_summary(sub, df):
+    ''' summary rows of one subject's trial table '''
+    sets = []
+    for trial_set, select in trial_sets.items():
+        set_df = select(df)
+        cells = set_df[cell_columns].copy()
+        cells['n'] = 1
+        for var in summary_variables:
+            values = set_df[var].astype(float)
+            cells[var + '_n'] = values.notna().astype(int)
+            cells[var + '_sum'] = values.fillna(0)
+            cells[var + '_sumsq'] = values.fillna(0) ** 2
+        cells = cells.groupby(cell_columns, observed=True, dropna=False)[sum_columns].sum().reset_index()
+        cells.insert(0, 'trials', trial_set)
+        sets.append(cells)
+    summary = pd.concat(sets, ignore_index=True)
+    summary.insert(0, 'Participant_ID', str(sub))
+    return summary
+
+
+def with_categories(summary):
+    ''' the fixed cue / version levels of the dataset, so summaries of different subjects concatenate as categoricals '''
+    for col in cell_columns:
+        if col in category_levels:
+            summary[col] = pd.Categorical(summary[col], categories=category_levels[col])
+    return summary
+
+
+def update_behavior_summary(dataset_dir, summary_file):
+    ''' (re)summarize every subject of the dataset that is new or changed, drop subjects no longer in it,
+    returns the (re)summarized subjects
+    '''
+    summary_file = cache_file_for(summary_file)
+    current = {sub: stage_key('behavior_summary', read_checkpoint(partition_file(dataset_dir, sub))['output_key'], summary_params)
+               for sub in dataset_subjects(dataset_dir)}
+    info = read_checkpoint(summary_file) if os.path.exists(summary_file) else None
+    previous = info['details']['subject_keys'] if info else {}
+    changed = [sub for sub, key in current.items() if previous.get(sub) != key]
+    if not changed and set(previous) == set(current):
+        return []
+    parts = []
+    if previous:
+        summary = read_frame(summary_file)
+        parts.append(summary[summary['Participant_ID'].isin([sub for sub in current if sub not in changed])])
+    for sub in changed:
+        parts.append(subject_summary(sub, read_behavior_dataset(dataset_dir, subjects=[sub], columns=cell_columns + summary_variables)))
+    summary = with_categories(pd.concat(parts, ignore_index=True)) if parts else pd.DataFrame(columns=['Participant_ID', 'trials'] + cell_columns + sum_columns)
+    summary = summary.sort_values(by=['Participant_ID', 'trials'], kind='stable').reset_index(drop=True)
+    os.makedirs(os.path.dirname(os.path.abspath(summary_file)), exist_ok=True)
+    write_frame(summary, summary_file)
+    write_checkpoint(summary_file, 'behavior_summary', stage_key('behavior_summary', None, summary_params),
+                     details={'subject_keys': current, 'n_rows': len(summary), 'format': cache_format})
+    return changed
+
+
+def read_behavior_summary(summary_file, subjects=None):
+    summary = read_frame(cache_file_for(summary_file))
+    if subjects is not None:
+        summary = summary[summary['Participant_ID'].isin([str(sub) for sub in subjects])].reset_index(drop=True)
+    return summary
+
+
+def summary_stats(summary, by, trials='responded', subjects=None, exclude=None):
+    ''' n (trials), <var>_n, <var>_mean and <var>_sd (like DataFrame.std, ddof=1) of rt and correct for each group in by
+
+    trials   - 'responded' or 'all'
+    subjects - only these subjects (default all), exclude - leave these subjects out (e.g., pars_to_exclude)
+    '''
+    rows = summary[summary['trials'] == trials]
+    if subjects is not None:
+        rows = rows[rows['Participant_ID'].isin([str(sub) for sub in subjects])]
+    if exclude:
+        rows = rows[~rows['Participant_ID'].isin([str(sub) for sub in exclude])]
+    if by:
+        sums = rows.groupby(by, observed=True, dropna=False)[sum_columns].sum()
+    else:
+        sums = rows[sum_columns].sum().to_frame().T
+    stats = pd.DataFrame({'n': sums['n']}, index=sums.index)
+    for var in summary_variables:
+        n = sums[var + '_n']
+        mean = sums[var + '_sum'] / n.where(n > 0)
+        var_sd = (sums[var + '_sumsq'] - n * mean ** 2) / (n - 1).where(n > 1)
+        stats[var + '_n'] = n
+        stats[var + '_mean'] = mean
+        stats[var + '_sd'] = np.sqrt(var_sd.clip(lower=0))
+    return stats.reset_index() if by else stats.reset_index(drop=True)
+
+
+def subject_accuracy(summary, trials='responded'):
+    ''' Participant_ID, correct (mean accuracy) of every subject, like df.groupby("Participant_ID").mean() '''
+    stats = summary_stats(summary, ['Participant_ID'], trials)
+    return stats[['Participant_ID', 'correct_mean']].rename(columns={'correct_mean': 'correct'})
+
+
+def low_accuracy_subjects(summary, thresh, trials='responded'):
+    ''' (int) ids of the subjects whose overall accuracy is below thresh '''
+    accuracy = subject_accuracy(summary, trials)
+    return [int(sub) for sub in accuracy.loc[accuracy['correct'] < thresh, 'Participant_ID']]
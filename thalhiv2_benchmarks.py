@@ -0,0 +1,522 @@
+"""
+Micro-benchmarks for the ThalHiV2 EEG preprocessing helpers
+    each benchmark times the original (loop based) code path against the current one on synthetic data; the
+    events and rejection benchmarks also check that both give the same answer, the checks of the others are in
+    tests/ (python -m pytest tests), which import the synthetic data and the original code paths from here
+
+    the ica benchmark instead fits every ICA backend in thalhiv2_eeg_pipeline.ica_methods on the same data
+    (a subject's preICA file, or synthetic mixed sources) and compares the components to the infomax ones
+
+usage:
+    python thalhiv2_benchmarks.py events
+    python thalhiv2_benchmarks.py breaks
+    python thalhiv2_benchmarks.py rejection
+    python thalhiv2_benchmarks.py epoching
+    python thalhiv2_benchmarks.py epoch_store
+    python thalhiv2_benchmarks.py epoch_nums
+    python thalhiv2_benchmarks.py behavior
+    python thalhiv2_benchmarks.py switch
+    python thalhiv2_benchmarks.py dataset
+    python thalhiv2_benchmarks.py summary
+    python thalhiv2_benchmarks.py plots
+    python thalhiv2_benchmarks.py ica --preica_file sub-10001_task-ThalHiV2_eeg-preICA.fif --ica_decim 4
+"""
+import argparse
+import sys
+import time
+import timeit
+import importlib.util
+import numpy as np
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Benchmark ThalHiV2 EEG helpers on synthetic data",
+        usage="[benchmark] [OPTIONS] ... ",
+    )
+    parser.add_argument("benchmark", choices=list(benchmarks.keys()), help="which benchmark to run")
+    parser.add_argument("--n_repeats", type=int, default=None, help="number of timed repeats, default is 20 (3 for rejection, epoching, epoch_store, switch, dataset, summary and plots, 1 for ica)")
+    parser.add_argument("--preica_file", default=None, help="ica: preICA fif file of the subject to fit, default is synthetic data")
+    parser.add_argument("--ica_decim", type=int, default=1, help="ica: fit on every Nth sample, default is 1")
+    return parser
+
+
+def report(name, legacy_times, new_times):
+    legacy_ms = np.median(legacy_times) * 1000
+    new_ms = np.median(new_times) * 1000
+    print(name)
+    print("\tlegacy path: %10.3f ms (median)" % legacy_ms)
+    print("\tnew path:    %10.3f ms (median)" % new_ms)
+    print("\tspeed up:    %10.1f x" % (legacy_ms / new_ms))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# event filtering in thalhiv2_raw_to_bids.generate_events
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def synthetic_events(n_events=10000, seed=0):
+    ''' (sample, prev, code) array with a mix of task codes and codes that should be filtered out '''
+    rng = np.random.default_rng(seed)
+    codes = np.array([111, 113, 121, 123, 211, 221, 213, 223, 131, 133, 141, 143, 145, 151, 153,
+                      171, 173, 175, 177, 181, 185, 191, 202, 203, 201, 255, 65280, 1, 7])
+    samples = np.cumsum(rng.integers(100, 2000, size=n_events))
+    return np.column_stack([samples, np.zeros(n_events, dtype=int), rng.choice(codes, size=n_events)])
+
+
+def legacy_filter_events(events_data, eligible_codes):
+    eligible_events = set(eligible_codes)
+    ev_data_excludeIneligibleEvents = []
+    for ev in events_data:
+        if ev[2] in eligible_events:
+            ev_data_excludeIneligibleEvents.append(ev)
+    return np.asarray(ev_data_excludeIneligibleEvents)
+
+
+def bench_events(args):
+    n_repeats = args.n_repeats or 20
+    from thalhiv2_raw_to_bids import filter_eligible_events, trigDict
+    eligible_codes = [code for code in trigDict.values() if isinstance(code, int)]
+    events_data = synthetic_events()
+    assert np.array_equal(legacy_filter_events(events_data, eligible_codes), filter_eligible_events(events_data, eligible_codes))
+    legacy_times = timeit.repeat(lambda: legacy_filter_events(events_data, eligible_codes), number=1, repeat=n_repeats)
+    new_times = timeit.repeat(lambda: filter_eligible_events(events_data, eligible_codes), number=1, repeat=n_repeats)
+    report("event filtering (" + str(len(events_data)) + " events)", legacy_times, new_times)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# block break annotations (thalhiv2_annotations.block_break_annotations)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def bench_breaks(args):
+    import mne
+    from thalhiv2_annotations import block_break_annotations
+    from thalhiv2_subjects import get_subject_config
+    from tests.test_annotations import synthetic_block_events, legacy_block_breaks # checked to agree in tests/test_annotations.py
+    n_repeats = args.n_repeats or 20
+    sfreq = 2048.
+    # -- 10263 started on a later block (first stop pairs with the first start), 10264 crashed in block 2
+    cases = {'10001': synthetic_block_events(sfreq=sfreq), '10263': synthetic_block_events(sfreq=sfreq, seed=1)[1:],
+             '10264': synthetic_block_events(sfreq=sfreq, crashed_block=1, seed=2)}
+    for sub, events in cases.items():
+        block_breaks = get_subject_config(sub)['block_breaks']
+        new = block_break_annotations(events, sfreq, **block_breaks)
+        legacy_times = timeit.repeat(lambda: mne.Annotations(*legacy_block_breaks(events, sfreq, sub)), number=1, repeat=n_repeats)
+        new_times = timeit.repeat(lambda: block_break_annotations(events, sfreq, **block_breaks), number=1, repeat=n_repeats)
+        report("block break annotations, sub-" + sub + " " + str(block_breaks) + " (" + str(len(new)) + " breaks)", legacy_times, new_times)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# epoch rejection options (thalhiv2_rejection) vs re-epoching for every option
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def synthetic_epoch_raw(n_channels=64, sfreq=512., duration=900, n_events=300, seed=0):
+    ''' noisy eeg with artifacts on a few channels, a bad break annotation and cue-like events '''
+    import mne
+    rng = np.random.default_rng(seed)
+    montage = mne.channels.make_standard_montage('biosemi64')
+    n_times = int(duration * sfreq)
+    data = rng.normal(scale=8e-6, size=(n_channels, n_times))
+    for ch, n_artifacts in zip(rng.choice(n_channels, 6, replace=False), [80, 60, 40, 30, 20, 10]):
+        for onset in rng.integers(0, n_times - 200, n_artifacts):
+            data[ch, onset:onset + 200] += rng.uniform(50e-6, 300e-6)
+    raw = mne.io.RawArray(data, mne.create_info(montage.ch_names[:n_channels], sfreq, 'eeg'), verbose=False)
+    raw.set_annotations(mne.Annotations([duration / 2], [60.0], ['bad_break']))
+    samples = np.sort(rng.choice(np.arange(int(2 * sfreq), n_times - int(7 * sfreq)), n_events, replace=False))
+    return raw, np.c_[samples, np.zeros(n_events, dtype=int), np.ones(n_events, dtype=int)]
+
+def legacy_kept_epochs(raw, events, window, reject, interpolate):
+    ''' what the old checking_auto_rej loop did for every option: build the trl epochs again '''
+    import mne
+    raw.info['bads'] = list(interpolate)
+    epochs = mne.Epochs(raw, events, tmin=window[0], tmax=window[1], reject=reject, baseline=None,
+                        event_repeated='drop', preload=True, verbose=False)
+    raw.info['bads'] = []
+    return len(epochs)
+
+def bench_rejection(args):
+    from thalhiv2_rejection import epoch_ptp, surviving_epochs, best_channels_to_interpolate
+    n_repeats = args.n_repeats or 3
+    window = (-1.0, 6.0)
+    raw, events = synthetic_epoch_raw()
+    ptp_info = epoch_ptp(raw, events, *window)
+    options = []
+    for threshold in [100e-6, 125e-6, 150e-6, 200e-6]:
+        reject = {'eeg': threshold}
+        best = best_channels_to_interpolate(ptp_info, reject, 3)
+        options += [(reject, best[:n_interp]) for n_interp in range(len(best) + 1)]
+    for reject, interpolate in options:
+        assert legacy_kept_epochs(raw, events, window, reject, interpolate) == surviving_epochs(ptp_info, reject, interpolate).sum()
+    legacy_times = timeit.repeat(lambda: [legacy_kept_epochs(raw, events, window, reject, interp) for reject, interp in options],
+                                 number=1, repeat=n_repeats)
+    new_times = timeit.repeat(lambda: [surviving_epochs(epoch_ptp(raw, events, *window), reject, interp) for reject, interp in options[:1]]
+                              + [surviving_epochs(ptp_info, reject, interp) for reject, interp in options[1:]], number=1, repeat=n_repeats)
+    report("trl epochs kept for " + str(len(options)) + " threshold / interpolation options (" + str(len(events)) + " events, 64 channels)",
+           legacy_times, new_times)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# single pass epoching of every event type (thalhiv2_epochs.build_epochs) vs one mne.Epochs per type
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def bench_epoching(args):
+    import mne
+    import pandas as pd
+    from thalhiv2_epochs import build_epochs
+    from thalhiv2_rejection import epoch_ptp
+    n_repeats = args.n_repeats or 3
+    raw, cue_events = synthetic_epoch_raw()
+    # -- a trial's later events at the ThalHiV2 offsets from the cue (retro cue 1.3 s, stim 3.8 s, response 5.3 s)
+    sfreq = raw.info['sfreq']
+    trial_events = {'trl': (0, 111, (-1.0, 6.0)), 'cue': (0, 111, (-0.8, 1.2)), 'retro_cue': (1.3, 141, (-1.0, 2.0)),
+                    'stim': (3.8, 151, (-0.8, 1.7)), 'resp': (5.3, 171, (-0.8, 1.2))}
+    metadata = pd.DataFrame({'trial': np.arange(len(cue_events))})
+    specs = {name: {'events': cue_events + [int(offset * sfreq), 0, code - 1], 'event_id': {name: code}, 'tmin': window[0],
+                    'tmax': window[1], 'metadata': metadata} for name, (offset, code, window) in trial_events.items()}
+    reject = {'eeg': 150e-6}
+    # -- the pipeline has the trl peak-to-peak from the rejection review already (tests/test_epochs.py checks the result)
+    trl_ptp = epoch_ptp(raw, cue_events, -1.0, 6.0)
+    legacy = lambda: {name: mne.Epochs(raw, reject=reject, baseline=None, on_missing='warn', event_repeated='drop', preload=True,
+                                       verbose=False, **spec) for name, spec in specs.items()}
+    new = lambda: build_epochs(raw, specs, reject, trl_ptp)
+    legacy_times = timeit.repeat(legacy, number=1, repeat=n_repeats)
+    new_times = timeit.repeat(new, number=1, repeat=n_repeats)
+    report("trl, cue, retro_cue, stim and resp epochs (" + str(len(cue_events)) + " trials, 64 channels)", legacy_times, new_times)
+    # -- the pipeline used to make every epoch type, now only the ones in epochs_wanted (default trl, stim and resp)
+    wanted = {name: specs[name] for name in ['trl', 'stim', 'resp']}
+    new_times = timeit.repeat(lambda: build_epochs(raw, wanted, reject, trl_ptp), number=1, repeat=n_repeats)
+    report("all epoch types (old pipeline) vs only the default epochs_wanted (trl, stim, resp)", legacy_times, new_times)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# reading epochs back: -epo.fif vs the memory-mapped store (thalhiv2_epoch_store)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def bench_epoch_store(args):
+    import os
+    import tempfile
+    import mne
+    import pandas as pd
+    from thalhiv2_epoch_store import save_epoch_store, store_file_for, slice_epoch_store
+    n_repeats = args.n_repeats or 3
+    raw, events = synthetic_epoch_raw()
+    metadata = pd.DataFrame({'trial': np.arange(len(events))})
+    epochs = mne.Epochs(raw, events, tmin=-0.8, tmax=1.7, baseline=None, metadata=metadata, preload=True, verbose=False)
+    channels = ['Fz', 'Cz', 'Pz', 'Oz']
+    trials = np.arange(0, len(epochs), 10)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        epo_file = os.path.join(tmp_dir, 'sub-00000_task-ThalHiV2_stim_eeg-epo.fif')
+        epochs.save(epo_file, verbose=False)
+        store_file = save_epoch_store(epochs, store_file_for(epo_file), source_file=epo_file)
+        legacy_full = lambda: mne.read_epochs(epo_file, preload=True, verbose=False).get_data()
+        new_full = lambda: slice_epoch_store(store_file)[0]
+        legacy_slice = lambda: mne.read_epochs(epo_file, preload=True, verbose=False)[trials].pick(channels).crop(0.0, 0.5).get_data()
+        new_slice = lambda: slice_epoch_store(store_file, trials, channels, 0.0, 0.5)[0] # same data, see tests/test_epoch_store.py
+        legacy_times = timeit.repeat(legacy_full, number=1, repeat=n_repeats)
+        new_times = timeit.repeat(new_full, number=1, repeat=n_repeats)
+        report("all stim epochs (" + str(len(epochs)) + " x 64 channels x " + str(len(epochs.times)) + " samples)", legacy_times, new_times)
+        legacy_times = timeit.repeat(legacy_slice, number=1, repeat=n_repeats)
+        new_times = timeit.repeat(new_slice, number=1, repeat=n_repeats)
+        report("every 10th stim epoch, " + str(len(channels)) + " channels, 0 - 0.5 s", legacy_times, new_times)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# --get_epoch_nums: mne.read_epochs(preload=False) vs the selection / drop log tags only (thalhiv2_fif)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def bench_epoch_nums(args):
+    import os
+    import tempfile
+    import mne
+    from thalhiv2_fif import read_epochs_bookkeeping
+    n_repeats = args.n_repeats or 20
+    raw, events = synthetic_epoch_raw()
+    epochs = mne.Epochs(raw, events, tmin=-1.0, tmax=6.0, baseline=None, reject={'eeg': 150e-6}, preload=True, verbose=False)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        epo_file = os.path.join(tmp_dir, 'sub-00000_task-ThalHiV2_trl_eeg-epo.fif')
+        epochs.save(epo_file, verbose=False)
+        # -- same selection and drop log, see tests/test_fif.py
+        legacy = lambda: mne.read_epochs(epo_file, proj=True, preload=False, verbose=False)
+        legacy_times = timeit.repeat(lambda: legacy().selection.shape[0], number=1, repeat=n_repeats)
+        new_times = timeit.repeat(lambda: len(read_epochs_bookkeeping(epo_file)[0]), number=1, repeat=n_repeats)
+        report("usable trl epochs of one file (" + str(len(epochs)) + " of " + str(len(events)) + " kept, "
+               + str(round(os.path.getsize(epo_file) / 1024**2)) + " MB)", legacy_times, new_times)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# behavioral block csvs: per-block append vs thalhiv2_behavior.load_behavior (one concat, cached)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def synthetic_behavior_files(data_dir, sub='10264', n_blocks=7, n_trials=80, seed=0):
+    ''' block csvs with the columns ThalHi_BEH_EEG_Task_v2-3.py writes '''
+    import os
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    cues = ['far', 'fab', 'fsr', 'fsb', 'dar', 'dsr', 'dab', 'dsb']
+    files = []
+    for block in range(1, n_blocks + 1):
+        block_df = pd.DataFrame({'block': np.full(n_trials, float(block)), 'trial': np.arange(1.0, n_trials + 1),
+                                 'delay': np.ones(n_trials), 'retro_freq': np.full(n_trials, 0.5), 'cue': rng.choice(cues, n_trials),
+                                 'texture': 'Filled', 'shape': 'Square', 'color': 'Red', 'retrocue': rng.choice(['texture', 'shape'], n_trials),
+                                 'stimulus': rng.choice(['Face', 'Scene'], n_trials), 'image_filename': 'img.png', 'task': rng.choice(['Face', 'Scene'], n_trials),
+                                 'corr_resp': rng.choice([1.0, 2.0], n_trials), 'subj_resp': rng.choice([-1.0, 1.0, 2.0], n_trials),
+                                 'correct': rng.choice([0.0, 1.0], n_trials), 'rt': rng.uniform(0.3, 1.5, n_trials)})
+        files.append(os.path.join(data_dir, 'sub-' + sub + '_task-ThalHiV2_block-%03d_date-01_01_2023.csv' % block))
+        block_df.to_csv(files[-1], index=False)
+    return files
+
+def bench_behavior(args):
+    import os
+    import tempfile
+    import pandas as pd
+    from thalhiv2_subjects import get_subject_config, fix_behavior_block
+    from thalhiv2_behavior import load_behavior
+    n_repeats = args.n_repeats or 20
+    sub_cfg = get_subject_config('10264') # drops rows of block 2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = synthetic_behavior_files(tmp_dir)
+        cache_file = os.path.join(tmp_dir, 'sub-10264_task-ThalHiV2_behavior.parquet')
+        def legacy():
+            beh_df = pd.DataFrame()
+            for bf in files:
+                beh_df = pd.concat([beh_df, fix_behavior_block(pd.read_csv(bf), bf, sub_cfg)]) # what DataFrame.append did
+            return beh_df
+        # -- same rows with and without the cache, see tests/test_behavior.py
+        load_behavior(files, sub_cfg, cache_file)
+        legacy_times = timeit.repeat(legacy, number=1, repeat=n_repeats)
+        new_times = timeit.repeat(lambda: load_behavior(files, sub_cfg), number=1, repeat=n_repeats)
+        report("behavior of one subject (" + str(len(files)) + " block csvs), no cache", legacy_times, new_times)
+        new_times = timeit.repeat(lambda: load_behavior(files, sub_cfg, cache_file), number=1, repeat=n_repeats)
+        report("behavior of one subject, cached", legacy_times, new_times)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# switch types of the multi-subject behavioral table: notebook row loop vs thalhiv2_behavior.switch_types
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def legacy_switch_types(temp_df, switch_dict):
+    ''' the row loop the behavioral notebook ran on every block file '''
+    Trial_type_Correct = ['Other']
+    for cur_row in list(range(0,len(temp_df))):
+        cur_cue = temp_df['cue'][cur_row]
+        cur_retrocue = temp_df['retrocue'][cur_row]
+        if (cur_row > 0):
+            prev_cue = temp_df['cue'][(cur_row-1)]
+            if cur_retrocue == temp_df['retrocue'][(cur_row-1)]:
+                if cur_cue == prev_cue:
+                    Trial_type_Correct.append('Repeat')
+                else:
+                    Trial_type_Correct.append(switch_dict[cur_retrocue][cur_cue][prev_cue])
+            else:
+                Trial_type_Correct.append('HDS')
+    return Trial_type_Correct
+
+def bench_switch(args):
+    import pandas as pd
+    from thalhiv2_behavior import switch_dict, switch_types
+    n_repeats = args.n_repeats or 3
+    rng = np.random.default_rng(0)
+    cues = ['far', 'fab', 'fsr', 'fsb', 'dar', 'dsr', 'dab', 'dsb']
+    n_subjects, n_blocks, n_trials = 60, 7, 80
+    # -- each subject sees two of the three retrocues (their task version), runs of the same retrocue like the task
+    blocks = []
+    for sub in range(n_subjects):
+        version = rng.choice(3, 2, replace=False)
+        for block in range(1, n_blocks + 1):
+            retrocue = np.array(['texture', 'shape', 'color'])[version][np.cumsum(rng.random(n_trials) < 0.3) % 2]
+            blocks.append(pd.DataFrame({'Participant_ID': str(10001 + sub), 'block': float(block),
+                                        'cue': rng.choice(cues, n_trials), 'retrocue': retrocue}))
+    table = pd.concat(blocks, ignore_index=True)
+    legacy = lambda: np.concatenate([legacy_switch_types(block_df, switch_dict) for block_df in blocks])
+    new = lambda: switch_types(table, by=['Participant_ID', 'block'])
+    # -- same labels, see tests/test_behavior.py
+    legacy_times = timeit.repeat(legacy, number=1, repeat=n_repeats)
+    new_times = timeit.repeat(new, number=1, repeat=n_repeats)
+    report("switch types of " + str(len(table)) + " trials (" + str(n_subjects) + " subjects x " + str(n_blocks) + " blocks)", legacy_times, new_times)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# behavioral dataset: every block csv of every subject vs thalhiv2_behavior.read_behavior_dataset (subset of subjects / columns)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def bench_dataset(args):
+    import os
+    import tempfile
+    import pandas as pd
+    from thalhiv2_subjects import get_subject_config, fix_behavior_block
+    from thalhiv2_behavior import read_behavior_block, update_behavior_dataset, read_behavior_dataset
+    n_repeats = args.n_repeats or 3
+    n_subjects = 30
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files_by_subject = {str(10001 + sub): synthetic_behavior_files(tmp_dir, str(10001 + sub), seed=sub) for sub in range(n_subjects)}
+        dataset_dir = os.path.join(tmp_dir, 'behavior_dataset')
+        update_behavior_dataset(dataset_dir, files_by_subject)
+        subjects, columns = list(files_by_subject)[:5], ['rt', 'correct', 'Switch_Type', 'version']
+        def legacy():
+            # -- what the notebook did: read every block of every subject, then select
+            df_list = []
+            for sub, files in files_by_subject.items():
+                for cur in sorted(files):
+                    temp_df = fix_behavior_block(read_behavior_block(cur), cur, get_subject_config(sub))
+                    temp_df['Participant_ID'] = sub
+                    df_list.append(temp_df)
+            df = pd.concat(df_list, ignore_index=True)
+            return df[df.Participant_ID.isin(subjects)].reset_index(drop=True)[['rt', 'correct', 'Switch_Type', 'Participant_ID']]
+        new = lambda: read_behavior_dataset(dataset_dir, subjects=subjects, columns=columns)
+        # -- same rows, see tests/test_behavior.py
+        legacy_times = timeit.repeat(legacy, number=1, repeat=n_repeats)
+        new_times = timeit.repeat(new, number=1, repeat=n_repeats)
+        report(str(len(columns)) + " columns of " + str(len(subjects)) + " of " + str(n_subjects) + " subjects", legacy_times, new_times)
+        new_times = timeit.repeat(lambda: update_behavior_dataset(dataset_dir, files_by_subject), number=1, repeat=n_repeats)
+        report("checking the dataset is up to date (no new subjects)", legacy_times, new_times)
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# exclusion and group numbers: trial table vs thalhiv2_behavior_summary (per-subject sums, updated per subject)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def bench_summary(args):
+    import os
+    import shutil
+    import tempfile
+    from thalhiv2_cache import sidecar_file
+    from thalhiv2_behavior import cache_file_for, update_behavior_dataset, read_behavior_dataset
+    from thalhiv2_behavior_summary import update_behavior_summary, read_behavior_summary, summary_stats, low_accuracy_subjects
+    n_repeats = args.n_repeats or 3
+    n_subjects = 30
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files_by_subject = {str(10001 + sub): synthetic_behavior_files(tmp_dir, str(10001 + sub), seed=sub) for sub in range(n_subjects)}
+        dataset_dir = os.path.join(tmp_dir, 'behavior_dataset')
+        summary_file = os.path.join(tmp_dir, 'behavior_summary.parquet')
+        update_behavior_dataset(dataset_dir, files_by_subject)
+        update_behavior_summary(dataset_dir, summary_file)
+        def legacy():
+            # -- what the notebook did: read the trial table, then the accuracy loop and a filter per switch type
+            ThalHi_df = read_behavior_dataset(dataset_dir)
+            ThalHi_df = ThalHi_df[ThalHi_df['rt'] > 0]
+            tmp_overall_acc = ThalHi_df[['Participant_ID', 'correct']].groupby(by="Participant_ID").mean().reset_index()
+            pars_to_exclude = [int(subj) for subj, acc in zip(tmp_overall_acc['Participant_ID'], tmp_overall_acc['correct']) if acc < 0.5]
+            usable_df = ThalHi_df[~ThalHi_df.Participant_ID.astype(int).isin(pars_to_exclude)]
+            return pars_to_exclude, [len(usable_df[usable_df['Switch_Type'] == switch]) for switch in ['Repeat', 'Stay', 'IDS', 'EDS', 'HDS']]
+        def new():
+            summary_df = read_behavior_summary(summary_file)
+            pars_to_exclude = low_accuracy_subjects(summary_df, 0.5)
+            switch_counts = summary_stats(summary_df, ['Switch_Type'], exclude=pars_to_exclude).set_index('Switch_Type')['n']
+            return pars_to_exclude, [int(switch_counts.get(switch, 0)) for switch in ['Repeat', 'Stay', 'IDS', 'EDS', 'HDS']]
+        # -- same exclusions and counts, see tests/test_behavior_summary.py
+        legacy_times = timeit.repeat(legacy, number=1, repeat=n_repeats)
+        new_times = timeit.repeat(new, number=1, repeat=n_repeats)
+        report("exclusion and switch type counts of " + str(n_subjects) + " subjects", legacy_times, new_times)
+        # -- one more subject: summarize everyone again vs only the new subject (from the 30 subject summary)
+        summary_file = cache_file_for(summary_file)
+        for fname in [summary_file, sidecar_file(summary_file)]:
+            shutil.copy(fname, fname + '.bak')
+        def restore():
+            for fname in [summary_file, sidecar_file(summary_file)]:
+                shutil.copy(fname + '.bak', fname)
+        def remove():
+            for fname in [summary_file, sidecar_file(summary_file)]:
+                os.remove(fname)
+        files_by_subject['10999'] = synthetic_behavior_files(tmp_dir, '10999', seed=999)
+        update_behavior_dataset(dataset_dir, files_by_subject)
+        update_behavior_summary(dataset_dir, summary_file)
+        legacy_times = timeit.repeat(lambda: update_behavior_summary(dataset_dir, summary_file), setup=remove, number=1, repeat=n_repeats)
+        new_times = timeit.repeat(lambda: update_behavior_summary(dataset_dir, summary_file), setup=restore, number=1, repeat=n_repeats)
+        report("summary after adding one subject (all " + str(n_subjects + 1) + " subjects vs the new one)", legacy_times, new_times)
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# plot aggregates: bootstrap at plot time (what sns.barplot does) vs thalhiv2_behavior_plots (vectorized, cached)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def legacy_bootstrap_ci(values, n_boot=1000, ci=95, seed=None):
+    ''' seaborn.algorithms.bootstrap + percentile CI: one resample of the rows (and np.mean call) per bootstrap '''
+    rng = np.random.default_rng(seed)
+    n = len(values)
+    boot = [np.mean(values[rng.integers(0, n, n)]) for _ in range(n_boot)]
+    return tuple(np.percentile(boot, [50 - ci / 2, 50 + ci / 2]))
+
+def bench_plots(args):
+    import os
+    import tempfile
+    from thalhiv2_behavior import cache_file_for, update_behavior_dataset, read_behavior_dataset
+    from thalhiv2_behavior_plots import cached_aggregates, subset_key
+    n_repeats = args.n_repeats or 3
+    n_subjects = 30
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files_by_subject = {str(10001 + sub): synthetic_behavior_files(tmp_dir, str(10001 + sub), seed=sub) for sub in range(n_subjects)}
+        dataset_dir = os.path.join(tmp_dir, 'behavior_dataset')
+        update_behavior_dataset(dataset_dir, files_by_subject)
+        ThalHi_df_all_trls = read_behavior_dataset(dataset_dir)
+        ThalHi_df = ThalHi_df_all_trls[ThalHi_df_all_trls['rt'] > 0]
+        # -- the bar panels of the switch type and cue x version figures
+        panels = {'rt_switch': ('bar', ThalHi_df, 'Switch_Type', 'rt', None), 'correct_switch': ('bar', ThalHi_df, 'Switch_Type', 'correct', None),
+                  'correct_switch_all_trls': ('bar', ThalHi_df_all_trls, 'Switch_Type', 'correct', None),
+                  'rt_cue': ('bar', ThalHi_df, 'cue', 'rt', 'version'), 'correct_cue': ('bar', ThalHi_df, 'cue', 'correct', 'version')}
+        def legacy():
+            return {name: [legacy_bootstrap_ci(values.to_numpy()) for _, values in df.groupby([x] if hue is None else [x, hue], observed=True)[y]]
+                    for name, (kind, df, x, y, hue) in panels.items()}
+        key = subset_key(dataset_dir, files_by_subject)
+        cache_file = os.path.join(tmp_dir, 'plots', 'bench.parquet')
+        # -- same CIs up to the bootstrap noise (different random draws), see tests/test_behavior_plots.py
+        cached_aggregates(cache_file, key, panels)
+        n_rows = sum(len(df) for _, df, _, _, _ in panels.values())
+        legacy_times = timeit.repeat(legacy, number=1, repeat=n_repeats)
+        for jobs in [1, 4]:
+            new_times = timeit.repeat(lambda: cached_aggregates(cache_file, key + 'x', panels, jobs=jobs), setup=lambda: os.remove(cache_file_for(cache_file)), number=1, repeat=n_repeats)
+            report("bootstrap CIs of " + str(len(panels)) + " bar panels (" + str(n_rows) + " trial rows), computed, jobs=" + str(jobs), legacy_times, new_times)
+        cached_aggregates(cache_file, key, panels)
+        new_times = timeit.repeat(lambda: cached_aggregates(cache_file, key, panels), number=1, repeat=n_repeats)
+        report("bootstrap CIs of " + str(len(panels)) + " bar panels, cached", legacy_times, new_times)
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# ICA backends in thalhiv2_eeg_pipeline.ica_methods
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+ica_method_requires = {'infomax': None, 'picard': 'picard', 'fastica': 'sklearn'}
+
+def synthetic_ica_raw(n_sources=16, sfreq=256., duration=300, seed=0):
+    ''' mne Raw of randomly mixed super- and sub-gaussian sources (blink like spikes, oscillations, noise) '''
+    import mne
+    rng = np.random.default_rng(seed)
+    times = np.arange(int(sfreq * duration)) / sfreq
+    sources = [rng.laplace(size=len(times)) for ii in range(n_sources // 2)]
+    sources += [np.sin(2 * np.pi * rng.uniform(2, 30) * times + rng.uniform(0, np.pi)) for ii in range(n_sources // 4)]
+    sources += [rng.uniform(-1, 1, size=len(times)) for ii in range(n_sources - len(sources))]
+    data = rng.standard_normal((n_sources, n_sources)) @ np.array(sources) * 1e-5
+    info = mne.create_info(['EEG%03d' % ii for ii in range(n_sources)], sfreq, 'eeg')
+    return mne.io.RawArray(data, info, verbose=False)
+
+def match_components(ref_sources, sources):
+    ''' best one-to-one match (by absolute correlation of the IC time courses) of each reference IC
+
+    returns (matched IC index, |r|) for every reference IC
+    '''
+    from scipy.optimize import linear_sum_assignment
+    n_ref = len(ref_sources)
+    corr = np.abs(np.corrcoef(ref_sources, sources)[:n_ref, n_ref:])
+    ref_idx, match_idx = linear_sum_assignment(-corr)
+    return match_idx[np.argsort(ref_idx)], corr[ref_idx, match_idx][np.argsort(ref_idx)]
+
+def bench_ica(args):
+    import mne
+    from thalhiv2_eeg_pipeline import ica_fit_copy, fit_ica, ica_methods
+    n_repeats = args.n_repeats or 1
+    if args.preica_file:
+        eeg_copy = ica_fit_copy(mne.io.read_raw_fif(args.preica_file, preload=True), low_mem=True)
+    else:
+        eeg_copy = synthetic_ica_raw().filter(l_freq=1.0, h_freq=None, verbose=False)
+    rows = []
+    fits = {}
+    for method in ica_methods:
+        if ica_method_requires[method] and importlib.util.find_spec(ica_method_requires[method]) is None:
+            print("skipping " + method + " (" + ica_method_requires[method] + " is not installed)")
+            continue
+        fit_times = []
+        for rep in range(n_repeats):
+            fits[method], fit_details = fit_ica(eeg_copy, args.ica_decim, method)
+            fit_times.append(fit_details['fit_seconds'])
+        rows.append({'method': method, 'fit_seconds': np.median(fit_times), 'n_iter': fit_details['n_iter'], 'converged': fit_details['converged']})
+    # -- how well does each backend recover the infomax components
+    ref_sources = fits['infomax'].get_sources(eeg_copy).get_data()
+    for row in rows:
+        match_idx, match_r = match_components(ref_sources, fits[row['method']].get_sources(eeg_copy).get_data())
+        row['median_match_r'] = np.median(match_r)
+        row['min_match_r'] = np.min(match_r)
+        row['n_ics_r_below_0.9'] = int(np.sum(match_r < 0.9))
+    import pandas as pd
+    print("\nICA backends (" + str(eeg_copy.info['nchan']) + " channels, decim=" + str(args.ica_decim) + ", median of " + str(n_repeats) + " fit(s))")
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+benchmarks = {'events': bench_events, 'breaks': bench_breaks, 'rejection': bench_rejection, 'epoching': bench_epoching, 'epoch_store': bench_epoch_store, 'epoch_nums': bench_epoch_nums, 'behavior': bench_behavior, 'switch': bench_switch, 'dataset': bench_dataset, 'summary': bench_summary, 'plots': bench_plots, 'ica': bench_ica}
+
+
+if __name__ == '__main__':
+    args = init_argparse().parse_args(sys.argv[1:])
+    benchmarks[args.benchmark](args)
@@ -0,0 +1,90 @@
+"""
+Content addressed checkpoints for the ThalHiV2 preprocessing stages
+    every stage (load, filter, reref, annotate, interpolate, ICA fit, ICA apply, epoch) gets a cache key that
+    hashes the key of the stage it depends on plus its own parameters. Stages that save a file (a checkpoint)
+    write a small json sidecar next to it (<file>.json) with
+
+        key        - the stage key the file was made with
+        decisions  - choices made during the stage (bad channels, bad ICs, ...)
+        output_key - key + decisions, this is what the next stage hashes
+        details    - anything else worth keeping about the run (timings, convergence, ...), not hashed
+
+    a checkpoint is only re-used when the key in its sidecar matches the key computed from the current
+    parameters, so changing e.g. high_pass or epo_reject_dict re-runs that stage and everything after it
+
+    remove_checkpoint(fname) deletes a checkpoint and its sidecar before the stage re-makes it, so files can keep
+    being saved with overwrite=False
+"""
+import os
+import glob
+import json
+import hashlib
+import datetime
+
+
+def stage_key(stage, parent_key, params):
+    ''' hash of the stage name, the key of the stage it depends on and its parameters '''
+    payload = json.dumps([stage, parent_key, params], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def source_key(fname):
+    ''' key for a raw input file, based on its name, size and modification time '''
+    stat = os.stat(fname)
+    return stage_key('source', None, {'file': os.path.basename(fname), 'size': stat.st_size, 'mtime': stat.st_mtime})
+
+
+def sidecar_file(fname):
+    return fname + '.json'
+
+
+def read_checkpoint(fname):
+    if not os.path.exists(sidecar_file(fname)):
+        return None
+    with open(sidecar_file(fname)) as f:
+        return json.load(f)
+
+
+def write_checkpoint(fname, stage, key, decisions=None, adopted=False, details=None):
+    ''' write the sidecar for a checkpoint file that was just saved and return its info '''
+    decisions = decisions or {}
+    info = {'stage': stage, 'key': key, 'decisions': decisions,
+            'output_key': stage_key(stage + '_output', key, decisions),
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'adopted': adopted, 'details': details or {}}
+    with open(sidecar_file(fname), 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+    return info
+
+
+def valid_checkpoint(fname, stage, key, decisions=None, legacy_decisions=None, adopt=True):
+    ''' checkpoint info if fname exists and was made with this key, otherwise None
+
+    decisions - if given (e.g. the saved choices used in --batch mode) they also have to match the checkpoint
+    adopt     - files saved before checkpoints had sidecars are adopted as-is (with legacy_decisions) instead
+                of being thrown away, since re-making them can mean re-doing the manual inspection. Only do
+                this when every stage before it was re-used too.
+    '''
+    if not os.path.exists(fname):
+        return None
+    info = read_checkpoint(fname)
+    if info is None and adopt:
+        print("\n\tadopting " + os.path.basename(fname) + " (saved before checkpoints were tracked) as the current " + stage + " stage\n")
+        return write_checkpoint(fname, stage, key, legacy_decisions, adopted=True)
+    if info is None or info['key'] != key:
+        print("\n\t" + os.path.basename(fname) + " is out of date (" + stage + " inputs or parameters changed), re-running this stage\n")
+        return None
+    if decisions is not None and info['decisions'] != decisions:
+        print("\n\t" + os.path.basename(fname) + " was made with different " + stage + " decisions, re-running this stage\n")
+        return None
+    return info
+
+
+def remove_checkpoint(fname):
+    ''' delete a checkpoint file that is about to be re-made, its sidecar and the split parts mne saves for fif
+    files over 2 GB (<name>-1.fif, <name>-2.fif, ...)
+    '''
+    root, ext = os.path.splitext(fname)
+    for path in [fname, sidecar_file(fname)] + glob.glob(glob.escape(root) + '-[0-9]*' + ext):
+        if os.path.exists(path):
+            os.remove(path)
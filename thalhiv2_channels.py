@@ -0,0 +1,131 @@
+"""
+Automated bad channel detection for the ThalHiV2 preprocessing
+    detect_bad_channels(raw, ...) - proposes bad eeg channels from robust per-channel statistics
+
+the continuous data is read in chunks (chunk_duration seconds, segments annotated as bad are left out) and for
+every chunk and channel we compute
+
+    deviation       - robust amplitude (0.7413 * interquartile range), flags channels that are much noisier
+                      or much flatter than the others
+    variance        - log variance, picks up channels with large spikes/jumps the robust amplitude ignores
+    neighbour_corr  - median correlation with the n_neighbours closest channels (montage positions), flags
+                      channels that do not look like the channels around them (bridging excluded, that needs a
+                      different test)
+    hf_noise        - robust amplitude of the first difference relative to the robust amplitude of the
+                      signal, flags channels dominated by high frequency (muscle / bad contact) noise
+
+the per-chunk values are summarised by their median over chunks, then turned into robust z-scores across
+channels (median / MAD). A channel is proposed as bad if |z deviation|, z variance or z hf_noise is above
+z_threshold, its neighbour correlation is below corr_threshold, or it is flat. At most max_bads channels are
+proposed (the ones failing the most criteria, then with the highest z-score), the rest are marked over_cap.
+
+in thalhiv2_eeg_pipeline.py the proposed channels are pre-selected in the channel browser before ICA (and again in
+the post-ICA data when extra channels are interpolated, within max_interp_channels, 6 in total), --batch uses them
+for subjects without saved bad channels; the scores of every channel go to
+sub-XXXXX_task-ThalHiV2_channel-scores.csv and the proposed channels to the preprocessingParameters csv
+(auto_bad_channels)
+
+    saved_bad_channels(prior)     - the channels interpolated before and after ICA in a previous run (--batch)
+"""
+import numpy as np
+import pandas as pd
+import mne
+
+
+def robust_z(values):
+    ''' (values - median) / (1.4826 * MAD), 0 where all channels agree '''
+    values = np.asarray(values, dtype=float)
+    med = np.nanmedian(values)
+    mad = 1.4826 * np.nanmedian(np.abs(values - med))
+    if not mad > 0:
+        return np.zeros_like(values)
+    return (values - med) / mad
+
+
+def robust_std(data, axis=-1):
+    ''' 0.7413 * interquartile range (= std for gaussian data, insensitive to outliers) '''
+    q25, q75 = np.percentile(data, [25, 75], axis=axis)
+    return 0.7413 * (q75 - q25)
+
+
+def neighbour_indices(info, picks, n_neighbours=6):
+    ''' indices (into picks) of the n_neighbours closest channels of each pick, None without montage positions '''
+    pos = np.array([info['chs'][pick]['loc'][:3] for pick in picks])
+    if not np.all(np.isfinite(pos)) or np.allclose(pos, 0):
+        return None
+    dist = np.linalg.norm(pos[:, None, :] - pos[None, :, :], axis=-1)
+    np.fill_diagonal(dist, np.inf)
+    return np.argsort(dist, axis=1)[:, :min(n_neighbours, len(picks) - 1)]
+
+
+def chunk_channel_stats(data, neighbours, n_neighbours=6):
+    ''' deviation, log variance, neighbour correlation and hf noise of each channel in one (n_channels, n_times) chunk '''
+    amp = robust_std(data)
+    log_var = np.log(np.maximum(np.var(data, axis=1), 1e-30))
+    hf_noise = robust_std(np.diff(data, axis=1)) / np.maximum(amp, 1e-30)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.corrcoef(data)
+    corr = np.nan_to_num(corr)
+    np.fill_diagonal(corr, np.nan)
+    if neighbours is None:
+        # -- no positions, use the channels each channel correlates with most instead
+        neighbour_corr = np.median(-np.sort(-np.where(np.isnan(corr), -1, corr), axis=1)[:, :n_neighbours], axis=1)
+    else:
+        neighbour_corr = np.median(np.take_along_axis(corr, neighbours, axis=1), axis=1)
+    return np.stack([amp, log_var, neighbour_corr, hf_noise])
+
+
+def detect_bad_channels(raw, picks='eeg', chunk_duration=30.0, n_neighbours=6, z_threshold=5.0, corr_threshold=0.4,
+                        flat_threshold=1e-7, max_bads=6, exclude=()):
+    ''' proposed bad channels (at most max_bads) and a data frame with the scores of every channel
+
+    exclude - channels that can not be proposed (e.g., ones that were already interpolated)
+    '''
+    picks = mne.pick_types(raw.info, eeg=True, exclude=[]) if picks == 'eeg' else mne.pick_channels(raw.ch_names, picks, ordered=True)
+    ch_names = [raw.ch_names[pick] for pick in picks]
+    neighbours = neighbour_indices(raw.info, picks, n_neighbours)
+    chunk_len = int(round(chunk_duration * raw.info['sfreq']))
+    min_len = int(round(min(chunk_duration / 2, 5.0) * raw.info['sfreq']))
+    stats = []
+    for start in range(0, raw.n_times, chunk_len):
+        # -- only this chunk is copied out of the raw data, annotated bad samples come back as NaN and are dropped
+        data = raw.get_data(picks=picks, start=start, stop=min(start + chunk_len, raw.n_times), reject_by_annotation='NaN')
+        data = data[:, ~np.isnan(data).any(axis=0)]
+        if data.shape[1] >= min_len:
+            stats.append(chunk_channel_stats(data, neighbours, n_neighbours))
+    if not stats:
+        raise RuntimeError("no clean data to detect bad channels on (every chunk is shorter than " + str(min_len) + " samples)")
+    amp, log_var, neighbour_corr, hf_noise = np.median(np.stack(stats), axis=0)
+
+    scores = pd.DataFrame({'channel': ch_names, 'robust_std_uv': amp * 1e6, 'z_deviation': robust_z(amp),
+                           'z_variance': robust_z(log_var), 'neighbour_corr': neighbour_corr,
+                           'z_hf_noise': robust_z(hf_noise), 'n_chunks': len(stats)})
+    criteria = pd.DataFrame({'flat': amp < flat_threshold, 'deviation': scores['z_deviation'].abs() > z_threshold,
+                             'variance': scores['z_variance'] > z_threshold, 'correlation': neighbour_corr < corr_threshold,
+                             'hf_noise': scores['z_hf_noise'] > z_threshold})
+    scores['criteria'] = criteria.apply(lambda row: ' '.join(row.index[row]), axis=1)
+    scores['n_criteria'] = criteria.sum(axis=1)
+    scores['max_z'] = scores[['z_deviation', 'z_variance', 'z_hf_noise']].abs().max(axis=1)
+    candidates = scores[(scores['n_criteria'] > 0) & ~scores['channel'].isin(list(exclude))]
+    candidates = candidates.sort_values(by=['n_criteria', 'max_z'], ascending=False)
+    bads = list(candidates['channel'][:max(max_bads, 0)])
+    scores['proposed'] = scores['channel'].isin(bads)
+    scores['over_cap'] = scores['channel'].isin(candidates['channel']) & ~scores['proposed']
+    return bads, scores
+
+
+def saved_bad_channels(prior, legacy_ok=False):
+    ''' (bad channels interpolated before ICA, extra channels interpolated after ICA) from the decisions saved in a
+    subject's preprocessingParameters csv (prior, a dict of its row)
+
+    csv files from before extra_bad_channels had its own column list the extra channels in bad_channels too, which
+    can not be split again: those raise a ValueError (re-run the subject interactively once, or move the post-ICA
+    channels to an extra_bad_channels column) unless legacy_ok, then all of them count as pre-ICA
+    '''
+    bads = str(prior.get('bad_channels', "")).split()
+    if 'extra_bad_channels' not in prior and bads and not legacy_ok:
+        raise ValueError("bad_channels " + str(bads) + " were saved without an extra_bad_channels column, so the channels "
+                         "interpolated before ICA can not be told apart from the ones interpolated after it; re-run the "
+                         "subject interactively once or move the post-ICA channels to an extra_bad_channels column")
+    extra_bads = str(prior.get('extra_bad_channels', "")).split()
+    return [ch for ch in bads if ch not in extra_bads], extra_bads
@@ -12,13 +12,25 @@ Overview of sections
         * high pass of 0.1 Hz
         * low pass of 50 Hz
     3. plot and inspect filtered data for bad channels
-        * manually mark bad channels to remove at this point
+        * bad channels are proposed automatically (thalhiv2_channels.py), check and adjust them at this point
         * manually mark bad chunks of data as bad at this point
     4. run ICA on the copy of the data (task data only)
         * will view ICs and manually reject artefactual ICs
     5. re-reference (avg. re-ref) again and then epoch data
     6. inspect and reject remaining bad epochs (blinks, saccades, muscle, etc.)
 
+Headless runs (--batch)
+    --preproc --batch re-runs the steps above without plots or prompts, taking every decision (bad channels, extra
+    channels interpolated after ICA, bad ICs, ICA settings, epoch rejection threshold and the epochs rejected by hand)
+    from the subject's preprocessingParameters csv of an earlier interactive run, so e.g. a changed filter setting can
+    be applied to all subjects again. Subjects without a csv get the automatically detected bad channels and ICs. A
+    csv from before the extra_bad_channels column stops the subject (its pre- and post-ICA channels can not be told
+    apart), re-run it interactively once. --gen_vis_erp_plots --batch saves the figures instead of showing them.
+
+    the --batch stages run --jobs N subjects at once through thalhiv2_scheduler.py: every subject writes its own log
+    (<output_path>/logs or --log_dir), one failing or killed subject does not stop the others, --max_mem_gb caps the
+    resident memory of each worker and a table of every subject's status and run time is printed at the end
+
 dylan script link: https://github.com/HwangLabNeuroCogDynamics/TaskRep/blob/main/preprocess.py
 
 """
@@ -40,7 +52,20 @@ import pickle
 import fnmatch
 import argparse
 import datetime
-from df2gspread import df2gspread as d2g
+import functools
+import time
+from thalhiv2_bdf import find_bdf_events
+from thalhiv2_subjects import get_subject_config, behavior_files
+from thalhiv2_behavior import load_behavior
+from thalhiv2_cache import stage_key, source_key, valid_checkpoint, write_checkpoint, remove_checkpoint
+from thalhiv2_scheduler import run_subjects, peak_rss_mb
+from thalhiv2_annotations import block_break_annotations
+from thalhiv2_channels import detect_bad_channels, saved_bad_channels
+from thalhiv2_epochs import build_epochs
+from thalhiv2_fif import epoch_counts_table
+from thalhiv2_registry import update_subject, update_subjects, sheet_table
+from thalhiv2_epoch_store import save_epoch_store, store_file_for, epoch_store_is_current
+from thalhiv2_rejection import epoch_ptp, update_ptp, surviving_epochs, rejection_table, suggested_threshold
 plt.ion()
 
 def init_argparse() -> argparse.ArgumentParser:
@@ -60,8 +85,27 @@ def init_argparse() -> argparse.ArgumentParser:
                         help="create and display primary visual erp plots, default is false",
                         default=False, action="store_true")
     parser.add_argument("--get_epoch_nums", 
-                        help="get epoch numbers and add to google sheets file",
+                        help="get epoch numbers and add them to the preprocessing registry (thalhiv2_registry.py), also exported in the old google sheet layout to <output_path>/scripts/temp.csv (read from the selection / drop log of the epoch files only, the kept and dropped counts of every subject and epoch type go to <output_path>/preproc/epoch_counts.csv)",
+                        default=False, action="store_true")
+    parser.add_argument("--batch",
+                        help="run --preproc headless (no plots or prompts) re-using the decisions saved in each subject's preprocessingParameters csv (automatically detected bad channels and ICs for subjects without one), with --gen_vis_erp_plots save the plots instead of showing them, default is false",
+                        default=False, action="store_true")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of subjects to run in parallel for the non-interactive stages (--preproc --batch, --get_epoch_nums, --gen_vis_erp_plots --batch), default is 1 (serial)")
+    parser.add_argument("--low_mem",
+                        help="memory-aware preprocessing: interpolate in place and only copy the eeg channels for ICA (same results, less memory), default is false",
                         default=False, action="store_true")
+    parser.add_argument("--ica_method", choices=list(ica_methods.keys()), default=ica_method,
+                        help="ICA backend, default is infomax (extended); --batch uses the backend saved with the subject's bad ICs")
+    parser.add_argument("--ica_decim", type=int, default=ica_decim,
+                        help="fit the ICA on every Nth sample of the 1-35 Hz copy of the data (much faster, 35 Hz does not need the full sampling rate), default is 1 (full rate); --batch uses the value saved with the subject's bad ICs")
+    parser.add_argument("--epoch_store",
+                        help="with --preproc also write each epoch file as a memory-mapped .npy store (see thalhiv2_epoch_store.py), default is false",
+                        default=False, action="store_true")
+    parser.add_argument("--max_mem_gb", type=float, default=None,
+                        help="with --batch, resident memory cap (in GB, memory-mapped files do not count) for each worker process (also with --jobs 1), a subject going over it fails instead of the whole run, default is no cap")
+    parser.add_argument("--log_dir", default=None,
+                        help="where the per-subject logs of the non-interactive stages go, default is <output_path>/logs")
     return parser
 
 def generate_subj_list(subj_opt, data_path, filename_end_pattern):
@@ -71,26 +115,61 @@ def generate_subj_list(subj_opt, data_path, filename_end_pattern):
         subjects = glob.glob( os.path.join( data_path,("sub-"+str(subj_opt)+"*task-ThalHiV2_"+filename_end_pattern) ) )
     return subjects
 
-# ------------ Set Options --------------
-#generate_plots = False
-parser = init_argparse()
-args = parser.parse_args(sys.argv[1:])
-#generate_plots = args.generate_plots
-subj_opt = args.subject
+def subject_id(fname):
+    ''' 5-digit subject id in a file name '''
+    return re.search("[0-9]{5}", os.path.basename(fname)).group(0)
+
+def epoched_subjects(subj_opt):
+    ''' sorted ids of the subjects that already have epoch files '''
+    epo_subjects = generate_subj_list(subj_opt, os.path.join(output_path,"preproc"), 'stim_eeg-epo.fif')
+    sub_list = sorted(subject_id(epo_file) for epo_file in epo_subjects)
+    print(sub_list)
+    return sub_list
+
+def find_subject_events(sub_cfg, raw_file, inst):
+    ''' pull out the events (triggers) for the part of the recording kept in inst
+
+    events are decoded from the Status channel of the raw bdf file only (see thalhiv2_bdf.py), restricted to
+    the samples inst covers, so this gives the same events as mne.find_events(inst) without touching the eeg data
+    '''
+    if sub_cfg['concatenate_segments']:
+        # recording was cut and re-joined, so the samples are no longer contiguous
+        events = mne.find_events(inst, shortest_event=sub_cfg['shortest_event'])
+    else:
+        events = find_bdf_events(raw_file, shortest_event=sub_cfg['shortest_event'], first_samp=inst.first_samp, last_samp=inst.last_samp)
+    return np.delete(events, sub_cfg['drop_event_rows'], axis=0)
 
 
+# ------------ Set Options --------------
 high_pass = 0.15 # in Hz
 low_pass = 50.0 # in Hz
 pre_ica_reject_dict = {'eeg': 450e-6, 'eog':500e-6, 'emg': 1000e-6} # in Volts (e-6 converts from microvolts to volts)
 
 epo_baseline = None #(-0.8, -0.3) # in seconds
 epo_reject_dict = {'eeg': 125e-6, 'emg':500e-6} # in Volts (e-6 converts from microvolts to volts)
+max_interp_channels = 6 # most channels that can be interpolated in total (before and after ICA)
+epo_reject_candidates = [100e-6, 125e-6, 150e-6, 200e-6] # eeg thresholds compared (with the data-driven one) before picking one per subject
+ica_random_state = 97 # fixed seed so a re-fit (e.g., in --batch mode) gives the same ICs and the saved bad IC numbers still apply
+# ICA backends for --ica_method (picard needs the python-picard package, fastica needs scikit-learn)
+#   picard with ortho=False, extended=True fits the same model as extended infomax, just with a faster solver
+ica_methods = {'infomax': {'method': 'infomax', 'max_iter': 500, 'fit_params': {'extended': True}, 'random_state': ica_random_state},
+               'picard': {'method': 'picard', 'max_iter': 500, 'fit_params': {'ortho': False, 'extended': True}, 'random_state': ica_random_state},
+               'fastica': {'method': 'fastica', 'max_iter': 500, 'random_state': ica_random_state}}
+ica_method = 'infomax' # default for --ica_method
+eog_channels = ['EXG3', 'EXG4', 'EXG5', 'EXG6'] # eye channels the ICs are scored against
+ecg_channels = ['EXG7'] # heart channel the ICs are scored against
+ica_score_threshold = 3.0 # an IC is flagged when its (z-scored) correlation with an EOG/ECG channel is above this
+ica_filter = {'l_freq': 1.0, 'h_freq': 35.0} # filter applied to the copy of the data the ICA is fit on
+ica_decim = 1 # default for --ica_decim, the ICA is fit on every ica_decim-th sample of the filtered copy (1 = full rate)
+break_pad = {'before': 0.5, 'after': 2.0} # in seconds, block breaks are marked bad from 'before' the block end until 'after' the next block start
+epo_windows = {'trl': (-1.0, 6.0), 'cue': (-0.8, 1.2), 'retro_cue': (-1.0, 2.0), 'stim': (-0.8, 1.7), 'resp': (-0.8, 1.2), 'feedback': (-0.85, 0.65)} # (tmin, tmax) in seconds
 
 
 # --------------- SETUP -----------------
 output_path = '/data/backed_up/shared/ThalHiV2/EEG_data/'
 raw_bids = '/data/backed_up/shared/ThalHiV2/EEG_data/BIDS/'
 raw_behav = '/mnt/cifs/rdss/rdss_kahwang/ThalHi_data/v2_EEG_data/'
+registry_file = os.path.join(output_path,"preproc","thalhiv2_registry.sqlite") # per-subject parameters and usability (thalhiv2_registry.py)
 
 resp_keys = {'yes_key':['num_1',1],'no_key':['num_2',2]}
 trigDict = {'startSaveflag':bytes([201]), 'stopSaveflag':bytes([255]), 'blockStart':202, 'blockEnd':203, 
@@ -118,448 +197,649 @@ all_codes = {'far':111,'fab':113,'fsr':121,'fsb':123, 'dar':211,'dsr':221,'dab':
 # - - - - - - - - - - - - - - - - - - Preprocess Data - - - - - - - - - - - - - - - - - - - - - - 
 # ----------------------------------------------------------------------------------------------- 
 # ----------------------------------------------------------------------------------------------- 
-if args.preproc:
-    # -- generate raw subjects list
-    subjects = generate_subj_list(subj_opt, os.path.join(raw_bids,"sub-*","ses-01","eeg"), 'eeg.bdf')
-    print(subjects)
-    for raw_file in subjects:
-        # pull out subject id number from raw file string
-        sid = re.search("[0-9]{5}",raw_file)
-        if sid:
-            sub = sid.group(0)
-        print("\ncurrently working on subject ", str(sub), "...")
-        # pull out session number
-        sid = re.search("ses-[0-2]{2}",raw_file)
-        if sid:
-            session_num = sid.group(0)
-            session_num = int(session_num[-2:])
-        print("\tsession ", str(session_num), "...\n")
-
-        
-        # load and add subject behavioral data
-        if int(sub) == 10162:
-            beh_files = glob.glob(os.path.join(raw_behav, ("sub-"+str(sub)+"_task-ThalHi_v2_block-00[1-4]_date-*.csv")))
-        elif int(sub) == 10263:
-            beh_files = glob.glob(os.path.join(raw_behav,("sub-"+str(sub)+"_task-ThalHiV2_block-00[3-7]_*.csv"))) # only use blocks 3-7
-        elif int(sub) ==10287:
-            beh_files = glob.glob(os.path.join(raw_behav,("sub-"+str(sub)+"_task-ThalHiV2_block-00[1-2]_*.csv")))
-        elif int(sub) ==10292:
-            beh_files = glob.glob(os.path.join(raw_behav,("sub-"+str(sub)+"_task-ThalHiV2_block-00[1-2]_*.csv")))
-        elif int(sub) ==10218:
-            beh_files = glob.glob(os.path.join(raw_behav,("sub-"+str(sub)+"_task-ThalHiV2_block-00[1-3]_*.csv")))
-        elif int(sub) ==10305:
-            beh_files = glob.glob(os.path.join(raw_behav,("sub-"+str(sub)+"_task-ThalHiV2_block-00[1-5]_*.csv")))
-        else:
-            beh_files = glob.glob(os.path.join(raw_behav,("sub-"+str(sub)+"_task-ThalHiV2_block-00[1-7]_*.csv")))
-        beh_files = sorted(beh_files)
-        print(beh_files)
-        beh_df = pd.DataFrame() # create empty df to fill in
-        for bf in beh_files:
-            if int(sub) == 10264:
-                if bf == beh_files[1]:
-                    tmp_beh_df = pd.read_csv(bf)
-                    tmp_beh_df.drop(range(33,72), inplace=True) # drop last half of 2nd block
-                    print(tmp_beh_df)
-                    beh_df = beh_df.append(tmp_beh_df) # add each block to full df
-                else:
-                    beh_df = beh_df.append(pd.read_csv(bf)) # add each block to full df
-            elif int(sub) == 10263:
-                if bf == beh_files[0]:
-                    tmp_beh_df = pd.read_csv(bf)
-                    tmp_beh_df.drop([0,1,2], inplace=True)
-                    beh_df = beh_df.append(tmp_beh_df) # add each block to full df
-                else:
-                    beh_df = beh_df.append(pd.read_csv(bf)) # add each block to full df
-            elif int(sub) == 10273:
-                if bf == beh_files[4]:
-                    tmp_beh_df = pd.read_csv(bf)
-                    print(tmp_beh_df.loc[46, ["rt"]])
-                    tmp_beh_df.loc[46, ["rt"]] = -1
-                    tmp_beh_df.loc[46, ["subj_resp"]] = -1
-                    beh_df = beh_df.append(tmp_beh_df) # add each block to full df
-                else:
-                    beh_df = beh_df.append(pd.read_csv(bf)) # add each block to full df
-            else: 
-                beh_df = beh_df.append(pd.read_csv(bf)) # add each block to full df
-        print("current behavioral output file looks like...\n", beh_df, "\n")
-        resp_df = beh_df[beh_df['subj_resp']!=-1] # reduce to just rows with responses
-        # make a data frame with preproc parameters so we can save out a csv with details
-        cur_csv = {'Participant_ID': sub, 'low_pass_filt': low_pass, 'high_pass_filt': high_pass, 'erp_baseline': str(epo_baseline), 'trl_baseline': 'None'}
+def preproc_param_file(sub):
+    return os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_preprocessingParameters.csv"))
 
+def read_preproc_params(sub):
+    ''' decisions saved in the subject's preprocessingParameters csv as a dict (empty if nothing was saved yet) '''
+    if not os.path.exists(preproc_param_file(sub)):
+        return {}
+    return pd.read_csv(preproc_param_file(sub), keep_default_na=False).iloc[0].to_dict()
 
-        if not(os.path.exists( os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_eeg-preICA.fif")) )):
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # 1) load raw data and set channel types and montage
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            raw = mne.io.read_raw_bdf(raw_file, preload = True)
-            raw.set_channel_types({'EXG1':'emg', 'EXG2':'emg', 'EXG3':'eog', 'EXG4':'eog', 'EXG5':'eog', 'EXG6':'eog', 'EXG7':'ecg', 'EXG8':'emg'})
-            if int(sub) != 10162:
-                raw.drop_channels(['EXG8'])
-            if int(sub) == 10263:
-                raw.crop(tmin=64.5) # crop out first 64.5 seconds
-            if int(sub) == 10264:
-                raw_p1 = raw.copy().crop(tmax=871)
-                raw_p2 = raw.copy().crop(tmin=1092) # crop out time where it crashed during block 2
-                raw, events = mne.concatenate_raws(raws=[raw_p1, raw_p2], events_list = [mne.find_events(raw_p1), mne.find_events(raw_p2)])
-            if int(sub) == 10287:
-                raw=raw.crop(tmax=1193)
-            if int(sub) == 10292:
-                raw=raw.crop(tmax=1192)
-            if int(sub) == 10218:
-                raw=raw.crop(tmax=1784)
-            if int(sub) == 10305:
-                raw=raw.crop(tmax=2982)
-            raw.set_montage(montage = "biosemi64")
-            # make a note of which EXG electrodes are eog and ecg for later
-            EOG_channels=[['EXG3', 'EXG4'], ['EXG5', 'EXG6', 'FP1', 'FP2']]
-            ECG_channels=['EXG7']
-            # -- find events in the raw data file
-            if int(sub) == 10273:
-                events = mne.find_events(raw, shortest_event=1) # pull out the events (triggers) from the data file
-                print(events.shape)
-                events = np.delete(events, (2684), axis=0)
-                print(events.shape)
-                print(events[2683:26866,:])
-            elif int(sub) != 10264:
-                events = mne.find_events(raw) # pull out the events (triggers) from the data file
-            # -- save out some raw data variables into our preprocessing csv file
-            cur_csv['sampling_rate'] = raw.info['sfreq'] # get sampling rate
-            cur_csv['ica_method'] = "input a copy of the continuous data with 1Hz highpass and 35Hz lowpass with no segment rejection THEN applied back to raw after selecting artefactual ICs"
+def save_preproc_params(sub, cur_csv):
+    print(cur_csv)
+    pd.DataFrame(cur_csv, index=[0]).to_csv(preproc_param_file(sub), index=False)
+    update_subject(registry_file, sub, cur_csv, source='preproc')
 
+def channel_list(value):
+    ''' space separated channel names from the csv -> list '''
+    return str(value).split()
 
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # 2) Filter data
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            print('\n\n - - - - - Filtering Data - - - - - -\n')
-            # -- filter the data
-            raw.filter(l_freq=high_pass, h_freq=low_pass)
-            eeg_filt_reref, _ = mne.set_eeg_reference(inst=raw, ref_channels='average') #['EXG1','EXG2'])
-            # -- draw a psd plot so we can make sure there is no weird freq. noise (e.g., line noise)
+def ic_list(value):
+    ''' saved IC list (e.g. "[0, 3, 12]") -> list of ints '''
+    return [int(ic) for ic in re.findall("[0-9]+", str(value))]
+
+def saved_user_rejected_epochs(prior, cur_epo, epo_file):
+    ''' indices (into the original events) of the epochs rejected by hand in a previous run
+
+    read from the csv if it was saved there, otherwise from the drop log of the previously saved epoch file
+    '''
+    col = 'user_rejected_'+cur_epo+'_epochs'
+    if col in prior:
+        return [int(ind) for ind in str(prior[col]).split()]
+    if os.path.exists(epo_file):
+        old_epochs = mne.read_epochs(epo_file, preload=False)
+        return [ind for ind, log in enumerate(old_epochs.drop_log) if 'USER' in log]
+    return []
+
+def saved_epo_reject(prior):
+    ''' epo_reject_dict with the eeg threshold picked for this subject in a previous run (if one was saved) '''
+    if prior.get('epo_reject_eeg_uv', "") == "":
+        return dict(epo_reject_dict)
+    return dict(epo_reject_dict, eeg=float(prior['epo_reject_eeg_uv']) * 1e-6)
+
+def reject_decision(epo_reject):
+    ''' the per-subject eeg threshold as an epoch decision, left out when it is the default so older checkpoints still match '''
+    if epo_reject['eeg'] == epo_reject_dict['eeg']:
+        return {}
+    return {'reject_eeg_uv': round(epo_reject['eeg'] * 1e6, 3)}
+
+def saved_epoch_decisions(prior, cur_epo, epo_file):
+    ''' extra interpolated channels, user rejected epochs and eeg threshold from a previous run, as stored in the epoch checkpoints '''
+    return dict({'extra_bad_channels': ' '.join(channel_list(prior.get('extra_bad_channels', ""))),
+                 'user_rejected_epochs': ' '.join(str(ind) for ind in saved_user_rejected_epochs(prior, cur_epo, epo_file))},
+                **reject_decision(saved_epo_reject(prior)))
+
+def report_memory(stage):
+    print("\n\tpeak memory (RSS) after " + stage + ": %.0f MB\n" % peak_rss_mb())
+
+def ica_fit_copy(raw, low_mem=False):
+    ''' copy of the data filtered for fitting the ICA
+
+    with low_mem=True only the eeg channels (the only ones the ICA is fit on) are copied, which gives the same fit
+    '''
+    if not low_mem:
+        return raw.copy().filter(**ica_filter)
+    eeg_picks = mne.pick_types(raw.info, meg=False, eeg=True)
+    eeg_copy = mne.io.RawArray(raw.get_data(picks=eeg_picks), mne.pick_info(raw.info, eeg_picks), first_samp=raw.first_samp)
+    annots = raw.annotations.copy()
+    if annots.orig_time is None:
+        annots.onset -= raw.first_time # set_annotations adds first_time back for annotations without an orig_time
+    eeg_copy.set_annotations(annots)
+    return eeg_copy.filter(**ica_filter)
+
+def fit_ica(eeg_copy, decim=1, method=ica_method):
+    ''' fit the ICA (backend from ica_methods) on the eeg channels of the filtered copy, returns the fit plus its wall time and convergence '''
+    if eeg_copy.info['sfreq'] / decim < 3 * ica_filter['h_freq']:
+        raise ValueError("ica_decim=" + str(decim) + " leaves " + str(eeg_copy.info['sfreq'] / decim) + " Hz, too little for data low-passed at " + str(ica_filter['h_freq']) + " Hz")
+    our_picks = mne.pick_types(eeg_copy.info, meg=False, eeg=True) #exclude=['EXG1', 'EXG2', 'EXG3', 'EXG4', 'EXG5', 'EXG6', 'EXG7', 'EXG8'])
+    ICA_method = mne.preprocessing.ICA(**ica_methods[method])
+    print("\nfitting " + method + " ICA to the copy of the data (decim=" + str(decim) + ")\nstarted running ICA on the data at ", datetime.datetime.now().strftime('%I:%M:%S %p'),"\n")
+    start = time.time()
+    ica_output = ICA_method.fit(eeg_copy, picks=our_picks, decim=decim, reject_by_annotation=True)
+    fit_details = {'method': method, 'fit_seconds': round(time.time() - start, 1), 'n_iter': int(ica_output.n_iter_),
+                   'max_iter': ica_methods[method]['max_iter'], 'converged': bool(ica_output.n_iter_ < ica_methods[method]['max_iter'])}
+    return ica_output, fit_details
+
+def report_ica_fit(fit_details):
+    print("\n\t" + fit_details.get('method', ica_method) + " ICA fit took " + str(fit_details['fit_seconds']) + " s, " + str(fit_details['n_iter']) + " iterations"
+          + ("" if fit_details['converged'] else " (did NOT converge before max_iter=" + str(fit_details.get('max_iter', '')) + ")") + "\n")
+
+def ica_scores_file(sub):
+    return os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_ica-scores.csv"))
+
+def channel_scores_file(sub):
+    return os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_channel-scores.csv"))
+
+def flagged_channel_scores(ch_scores):
+    ''' compact "channel:criteria" summary of the flagged channels for the preprocessingParameters csv '''
+    flagged = ch_scores[ch_scores['n_criteria'] > 0]
+    return ' '.join(ch + ':' + crit.replace(' ', '+') for ch, crit in zip(flagged['channel'], flagged['criteria']))
+
+def score_artifact_ics(ica_output, inst):
+    ''' flag eye and heart ICs from the correlation of their time courses with the EOG and ECG channels
+
+    uses mne's find_bads_eog / find_bads_ecg (correlation method); returns the flagged ICs and a data frame
+    with one row per IC and its correlation with each EOG/ECG channel
+    '''
+    scores = pd.DataFrame({'IC': np.arange(ica_output.n_components_)})
+    flagged = []
+    eog_picks = [ch for ch in eog_channels if ch in inst.ch_names]
+    if eog_picks:
+        eog_inds, eog_scores = ica_output.find_bads_eog(inst, ch_name=eog_picks, threshold=ica_score_threshold, reject_by_annotation=True)
+        for ch, ch_scores in zip(eog_picks, np.atleast_2d(eog_scores)):
+            scores['r_'+ch] = ch_scores
+        flagged += eog_inds
+    for ch in [ch for ch in ecg_channels if ch in inst.ch_names]:
+        ecg_inds, ecg_scores = ica_output.find_bads_ecg(inst, ch_name=ch, method='correlation', threshold=ica_score_threshold, reject_by_annotation=True)
+        scores['r_'+ch] = ecg_scores
+        flagged += ecg_inds
+    flagged = sorted(set(int(ic) for ic in flagged))
+    scores['flagged'] = scores['IC'].isin(flagged)
+    return flagged, scores
+
+def preprocess_subject(raw_file, batch=False, low_mem=False, ica_decim=ica_decim, ica_method=ica_method, epoch_store=False):
+    ''' run the full preprocessing (raw bdf -> epoch fif files) for one subject
+
+    with batch=True nothing is plotted and nothing is asked; the bad channels, bad ICs, extra interpolated
+    channels and user rejected epochs are all taken from the subject's saved preprocessingParameters csv
+
+    with low_mem=True bad channels are interpolated in place (only the bad channels are kept for the
+    before/after plots) and only the eeg channels are copied for the ICA fit
+
+    ica_method picks the ICA backend (see ica_methods) and ica_decim fits it on every ica_decim-th sample; the fit (with the selected ICs) is saved as a -ica.fif
+    file and re-applied on later runs instead of being re-fit
+
+    with epoch_store=True every epoch file also gets an -epo.npy store next to it (see thalhiv2_epoch_store.py)
+    '''
+    # pull out subject id number from raw file string
+    sid = re.search("[0-9]{5}",raw_file)
+    if sid:
+        sub = sid.group(0)
+    print("\ncurrently working on subject ", str(sub), "...")
+    # pull out session number
+    sid = re.search("ses-[0-2]{2}",raw_file)
+    if sid:
+        session_num = sid.group(0)
+        session_num = int(session_num[-2:])
+    print("\tsession ", str(session_num), "...\n")
+    # subject specific fixes (see thalhiv2_subject_exceptions.json)
+    sub_cfg = get_subject_config(sub)
+    # decisions from a previous (interactive) run, used instead of plots/prompts in batch mode
+    prior = read_preproc_params(sub)
+    if batch and not prior:
+        print("\n\tsub-" + sub + " has no saved preprocessingParameters csv, using the automatically detected bad channels and ICs\n")
+
+    # load and add subject behavioral data
+    beh_files = behavior_files(sub, raw_behav, sub_cfg)
+    print(beh_files)
+    # -- (includes the Switch_Type of every trial, so it ends up in the epoch metadata)
+    beh_df = load_behavior(beh_files, sub_cfg, os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_behavior.parquet")))
+    print("current behavioral output file looks like...\n", beh_df, "\n")
+    resp_df = beh_df[beh_df['subj_resp']!=-1] # reduce to just rows with responses
+    # make a data frame with preproc parameters so we can save out a csv with details
+    cur_csv = {'Participant_ID': sub, 'low_pass_filt': low_pass, 'high_pass_filt': high_pass, 'erp_baseline': str(epo_baseline), 'trl_baseline': 'None'}
+
+    # - - checkpoints (see thalhiv2_cache.py): each stage key hashes the key of the stage before it plus the stage's own
+    #     parameters, so a saved file is only re-used if nothing upstream of it changed
+    preICA_file = os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_eeg-preICA.fif"))
+    ica_file = os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2-ica.fif"))
+    postICA_file = os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_eeg-postICA.fif"))
+    stage_keys = {}
+    stage_keys['load'] = stage_key('load', source_key(raw_file), {key: sub_cfg[key] for key in ['drop_channels', 'crop', 'concatenate_segments']})
+    stage_keys['filter'] = stage_key('filter', stage_keys['load'], {'l_freq': high_pass, 'h_freq': low_pass})
+    stage_keys['reref'] = stage_key('reref', stage_keys['filter'], {'ref_channels': 'average'})
+    annotate_params = {'break_pad': break_pad, 'shortest_event': sub_cfg['shortest_event'], 'drop_event_rows': sub_cfg['drop_event_rows']}
+    if sub_cfg['block_breaks']:
+        annotate_params['block_breaks'] = sub_cfg['block_breaks']
+    stage_keys['annotate'] = stage_key('annotate', stage_keys['reref'], annotate_params)
+    stage_keys['interpolate'] = stage_key('interpolate', stage_keys['annotate'], {'method': 'spline'})
+    # -- bad channels are picked during the interpolate stage, in batch mode we already know them (a csv that mixes
+    #    the pre- and post-ICA channels stops batch mode here, interactive runs pick them again anyway)
+    pre_ica_bads, extra_bads = saved_bad_channels(prior, legacy_ok=not batch)
+    preICA_info = valid_checkpoint(preICA_file, 'interpolate', stage_keys['interpolate'],
+                                   decisions={'bad_channels': ' '.join(pre_ica_bads)} if batch and 'bad_channels' in prior else None,
+                                   legacy_decisions={'bad_channels': ' '.join(pre_ica_bads)})
+    reused_upstream = preICA_info is not None # old files without a sidecar are only adopted if nothing before them was re-made
+
+    if preICA_info is None:
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # 1) load raw data and set channel types and montage
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        raw = mne.io.read_raw_bdf(raw_file, preload = True)
+        raw.set_channel_types({'EXG1':'emg', 'EXG2':'emg', 'EXG3':'eog', 'EXG4':'eog', 'EXG5':'eog', 'EXG6':'eog', 'EXG7':'ecg', 'EXG8':'emg'})
+        raw.drop_channels(sub_cfg['drop_channels'])
+        if sub_cfg['crop']:
+            raw.crop(**sub_cfg['crop']) # crop out bad start/end of recording
+        if sub_cfg['concatenate_segments']:
+            # crop out time where the task crashed and join the remaining parts
+            raw_parts = [raw.copy().crop(**seg) for seg in sub_cfg['concatenate_segments']]
+            raw, events = mne.concatenate_raws(raws=raw_parts, events_list = [mne.find_events(rp) for rp in raw_parts])
+        raw.set_montage(montage = "biosemi64")
+        # -- find events in the raw data file
+        if not sub_cfg['concatenate_segments']:
+            events = find_subject_events(sub_cfg, raw_file, raw) # pull out the events (triggers) from the data file
+        # -- save out some raw data variables into our preprocessing csv file
+        cur_csv['sampling_rate'] = raw.info['sfreq'] # get sampling rate
+        cur_csv['ica_method'] = "input a copy of the continuous data with 1Hz highpass and 35Hz lowpass with no segment rejection THEN applied back to raw after selecting artefactual ICs"
+
+
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # 2) Filter data
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        print('\n\n - - - - - Filtering Data - - - - - -\n')
+        # -- filter the data
+        raw.filter(l_freq=high_pass, h_freq=low_pass)
+        eeg_filt_reref, _ = mne.set_eeg_reference(inst=raw, ref_channels='average', copy=False) #['EXG1','EXG2'])
+        # -- draw a psd plot so we can make sure there is no weird freq. noise (e.g., line noise)
+        if not batch:
             eeg_filt_reref.plot_psd(fmin=0.01, fmax=65.0)
 
 
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # 3) Annotate block breaks, inspect channels, reject bad channels, and interpolate
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # -- automatically mark breaks between blocks
-            dur_list = []
-            break_onsets = []
-            descript_list = []
-            start_blk_trigs = events[(events[:,2] == 202)] # find starts of task blocks
-            stop_blk_trigs = events[(events[:,2] == 203)] # find stops of task blocks
-            print(start_blk_trigs)
-            print(stop_blk_trigs)
-            if int(sub) == 10263:
-                # code didn't start properly on block 3
-                for ind, cblkt in enumerate(stop_blk_trigs):
-                    if (ind) < len(start_blk_trigs[:,0]):
-                        cur_dur = (start_blk_trigs[(ind),0] - cblkt[0])/eeg_filt_reref.info['sfreq']
-                    else:
-                        cur_dur = 0
-                    dur_list.append(cur_dur + 2) # get time inbetween stop of one block and start of the next and add 2 seconds to this duration
-                    break_onsets.append(cblkt[0]/eeg_filt_reref.info['sfreq'] - 0.5) 
-                    descript_list.append('bad_break')
-            elif int(sub) == 10264:
-                # code crashed halfway through block 2 and we just moved onto the next block after fixing
-                adj_num=1
-                for ind, cblkt in enumerate(stop_blk_trigs):
-                    if ind == 1:
-                        # add missing break
-                        cur_dur = 2 # just set at 3 seconds
-                        dur_list.append(cur_dur) # get time inbetween stop of one block and start of the next and add 2 seconds to this duration
-                        break_onsets.append(start_blk_trigs[(ind+adj_num),0]/eeg_filt_reref.info['sfreq'] - 1) # add onset of next block start and set it to start 13 seconds before
-                        descript_list.append('bad_break')
-                        adj_num=2 # change to 2 for following block breaks
-                    if (ind+adj_num) < len(start_blk_trigs[:,0]):
-                        cur_dur = (start_blk_trigs[(ind+adj_num),0] - cblkt[0])/eeg_filt_reref.info['sfreq']
-                    else:
-                        cur_dur = 2
-                    dur_list.append(cur_dur + 2) # get time inbetween stop of one block and start of the next and add 2 seconds to this duration
-                    break_onsets.append(cblkt[0]/eeg_filt_reref.info['sfreq'] - 0.5) # add onset of block end to list and set start as half a second before the block end
-                    descript_list.append('bad_break')
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # 3) Annotate block breaks, inspect channels, reject bad channels, and interpolate
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # -- automatically mark breaks between blocks (per subject exceptions are in the "block_breaks" registry entry)
+        block_annots = block_break_annotations(events, eeg_filt_reref.info['sfreq'], orig_time=eeg_filt_reref.info['meas_date'],
+                                               pad_before=break_pad['before'], pad_after=break_pad['after'], **sub_cfg['block_breaks'])
+        print('break_onsets: ', block_annots.onset, '\ndur_list: ', block_annots.duration)
+        eeg_filt_reref.set_annotations(block_annots)
+        # -- propose bad channels from robust per-channel statistics of the continuous data (see thalhiv2_channels.py)
+        auto_bads, ch_scores = detect_bad_channels(eeg_filt_reref, max_bads=max_interp_channels)
+        ch_scores.to_csv(channel_scores_file(sub), index=False)
+        cur_csv['auto_bad_channels'] = ' '.join(auto_bads)
+        cur_csv['bad_channel_scores'] = flagged_channel_scores(ch_scores)
+        print('\nchannels flagged by the bad channel detection: ' + str(auto_bads) + ' (scores saved to ' + os.path.basename(channel_scores_file(sub)) + ')\n')
+        if ch_scores['over_cap'].any():
+            print('\tnot proposed because of the ' + str(max_interp_channels) + ' channel limit: ' + ' '.join(ch_scores['channel'][ch_scores['over_cap']]) + '\n')
+        if batch:
+            if 'bad_channels' in prior:
+                # -- re-use the bad channels selected in the previous run (extra channels interpolated after ICA are handled in step 6)
+                eeg_filt_reref.info['bads'] = pre_ica_bads
+                print('\n\n - - - - - Using saved bad channels: ', eeg_filt_reref.info['bads'], ' - - - - - -\n')
             else:
-                for ind, cblkt in enumerate(stop_blk_trigs):
-                    if (ind+1) < len(start_blk_trigs[:,0]):
-                        cur_dur = (start_blk_trigs[(ind+1),0] - cblkt[0])/eeg_filt_reref.info['sfreq']
-                    else:
-                        cur_dur = 0
-                    dur_list.append(cur_dur + 2) # get time inbetween stop of one block and start of the next and add 2 seconds to this duration
-                    break_onsets.append(cblkt[0]/eeg_filt_reref.info['sfreq'] - 0.5) # add onset of block end to list and set start as half a second before the block end
-                    descript_list.append('bad_break')
-            print('break_onsets: ', break_onsets, '\ndur_list: ', dur_list, '\ndescrpt_list: ', descript_list)
-            block_annots = mne.Annotations(onset=break_onsets, duration=dur_list, description=descript_list, orig_time=eeg_filt_reref.info['meas_date'])
-            eeg_filt_reref.set_annotations(block_annots)
+                eeg_filt_reref.info['bads'] = list(auto_bads)
+                print('\n\n - - - - - No saved bad channels, using the detected ones: ', eeg_filt_reref.info['bads'], ' - - - - - -\n')
+        else:
             print('\n\n - - - - - Inspecting for bad channels and segments of data - - - - - -\n')
+            # -- the detected channels are already marked bad in the browser, click to add or remove channels
+            eeg_filt_reref.info['bads'] = list(auto_bads)
             # -- plot the filtered data with events visible so we can inspect for bad channels and note if any artefacts seem to regularly happen around certain events
             eeg_filt_reref.plot(events=events, n_channels = 71, scalings= {'eeg': 20e-6, 'emg': 40e-6, 'eog': 20e-6}, block=True )
             i = input("Press Enter to Continue if you have finished selecting all bad channels and bad segments (if any): ")
-            if eeg_filt_reref.info['bads']: 
+            if len(eeg_filt_reref.info['bads']) > max_interp_channels:
+                print("\n * * * * * " + str(len(eeg_filt_reref.info['bads'])) + " bad channels selected, more than the " + str(max_interp_channels) + " that can be interpolated in total * * * * *\n")
+        if eeg_filt_reref.info['bads']: 
+            cur_csv['bad_channels'] = ' '.join(eeg_filt_reref.info['bads'])
+            if batch:
+                preICA_eeg = eeg_filt_reref.interpolate_bads() # nothing to compare against, so interpolate in place
+            elif low_mem:
+                # -- only keep the bad channels for the before/after plots
+                eeg_orig = eeg_filt_reref.copy().pick(eeg_filt_reref.info['bads'])
+                preICA_eeg = eeg_filt_reref.interpolate_bads()
+                eeg_interp = preICA_eeg.copy().pick(eeg_orig.ch_names)
+            else:
                 preICA_eeg = eeg_filt_reref.copy().interpolate_bads()
-                for title, data in zip(['orig.', 'interp.'], [eeg_filt_reref, preICA_eeg]): 
+                eeg_orig, eeg_interp = eeg_filt_reref, preICA_eeg
+            if not batch:
+                for title, data in zip(['orig.', 'interp.'], [eeg_orig, eeg_interp]): 
                     with mne.viz.use_browser_backend('matplotlib'):
                         fig = data.plot(butterfly = True, color = '#00000022', bad_color = 'r')
                     fig.subplots_adjust(top = 0.9)
                     fig.suptitle(title, size = 'xx-large', weight = 'bold')
-                cur_csv['bad_channels'] = ' '.join(eeg_filt_reref.info['bads'])
                 i = input("Press Enter to Continue if the interpolation plots look OK: ")
-            else:
-                preICA_eeg = eeg_filt_reref.copy()
-                cur_csv['bad_channels'] = ""
-            # -- save out data at this point so if we want to change later parameters we can
-            print(" \n\tsaving pre-ica data ...\n")
-            preICA_eeg.save(fname = os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_eeg-preICA.fif")), overwrite=True)
-            print(cur_csv)
-            tmp_df = pd.DataFrame(cur_csv, index=[0])
-            tmp_df.to_csv(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_preprocessingParameters.csv")), index=False)
-            # --- epoch the data to the trial period (7 second epochs)
-            #     cue ........ 0 ms (make cue onset the start of the trial)
-            #     delay1 ..... 500 ms
-            #     retro cue .. 1300 ms
-            #     delay2 ..... 1800 ms
-            #     stim ....... 3800 ms
-            #     feedback ... 5300 ms (lasts for 500 ms... trl end is 5800 ms)
-            # cue_inds = ( ((np.asarray(events[:,2]) > 110) & (np.asarray(events[:,2]) < 124)) | ((np.asarray(events[:,2]) > 210) & (np.asarray(events[:,2]) < 224)) )
-            # cue_events = events[cue_inds]
-            # print("total of ", len(cue_events), " cue events found\n")
-            # if raw.info['bads']: 
-            #     trl_epochs = mne.Epochs(raw = eeg_data_interp, events = cue_events, event_id = cue_codes, tmin = -1.0, tmax = 6.0, reject=pre_ica_reject_dict,
-            #                     baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
-            # else:    
-            #     trl_epochs = mne.Epochs(raw = raw, events = cue_events, event_id = cue_codes, tmin = -1.0, tmax = 6.0, reject=pre_ica_reject_dict,
-            #                     baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
         else:
-            # load preICA file
-            preICA_eeg = mne.io.read_raw_fif(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_eeg-preICA.fif")), preload = True)
-            if int(sub) == 10273:
-                events = mne.find_events(preICA_eeg, shortest_event=1) # pull out the events (triggers) from the data file
-                events = np.delete(events, (2684), axis=0)
-            else:
-                events = mne.find_events(preICA_eeg) # pull out the events (triggers) from the data file
-            cur_csv = {'Participant_ID': sub, 'low_pass_filt': low_pass, 'high_pass_filt': high_pass, 'erp_baseline': str(epo_baseline), 'trl_baseline': 'None', 'sampling_rate': preICA_eeg.info['sfreq']}
-            cur_csv['ica_method'] = "input a copy of the continuous data with 1Hz highpass and 35Hz lowpass with no segment rejection THEN applied back to raw after selecting artefactual ICs"
-            tmp_df = pd.read_csv(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_preprocessingParameters.csv")))
-            cur_csv['bad_channels'] = list(tmp_df['bad_channels'])
-            print(cur_csv)
-            EOG_channels=['EXG3', 'EXG4', 'EXG5', 'EXG6']
-            ECG_channels=['EXG7']
+            preICA_eeg = eeg_filt_reref
+            cur_csv['bad_channels'] = ""
+        # -- save out data at this point so if we want to change later parameters we can
+        print(" \n\tsaving pre-ica data ...\n")
+        preICA_eeg.save(fname = preICA_file, overwrite=True)
+        preICA_info = write_checkpoint(preICA_file, 'interpolate', stage_keys['interpolate'], {'bad_channels': cur_csv['bad_channels']},
+                                       details={key: cur_csv[key] for key in ['auto_bad_channels', 'bad_channel_scores']})
+        save_preproc_params(sub, cur_csv)
+        report_memory("filtering and interpolation")
+        # --- epoch the data to the trial period (7 second epochs)
+        #     cue ........ 0 ms (make cue onset the start of the trial)
+        #     delay1 ..... 500 ms
+        #     retro cue .. 1300 ms
+        #     delay2 ..... 1800 ms
+        #     stim ....... 3800 ms
+        #     feedback ... 5300 ms (lasts for 500 ms... trl end is 5800 ms)
+        # cue_inds = ( ((np.asarray(events[:,2]) > 110) & (np.asarray(events[:,2]) < 124)) | ((np.asarray(events[:,2]) > 210) & (np.asarray(events[:,2]) < 224)) )
+        # cue_events = events[cue_inds]
+        # print("total of ", len(cue_events), " cue events found\n")
+        # if raw.info['bads']: 
+        #     trl_epochs = mne.Epochs(raw = eeg_data_interp, events = cue_events, event_id = cue_codes, tmin = -1.0, tmax = 6.0, reject=pre_ica_reject_dict,
+        #                     baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
+        # else:    
+        #     trl_epochs = mne.Epochs(raw = raw, events = cue_events, event_id = cue_codes, tmin = -1.0, tmax = 6.0, reject=pre_ica_reject_dict,
+        #                     baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
+    else:
+        # preICA file is only loaded if the ICA stage has to be re-run (see below)
+        preICA_eeg = None
+        cur_csv = {'Participant_ID': sub, 'low_pass_filt': low_pass, 'high_pass_filt': high_pass, 'erp_baseline': str(epo_baseline), 'trl_baseline': 'None'}
+        cur_csv['ica_method'] = "input a copy of the continuous data with 1Hz highpass and 35Hz lowpass with no segment rejection THEN applied back to raw after selecting artefactual ICs"
+        cur_csv['bad_channels'] = preICA_info['decisions']['bad_channels']
+        cur_csv.update(preICA_info['details']) # bad channel detection results
+        print(cur_csv)
 
 
-        if not(os.path.exists( os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_eeg-postICA.fif")) )):
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # 4) run ICA on the data
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            print('\n\n - - - - - Running ICA - - - - - -\n')
+    if batch:
+        # -- the saved bad IC numbers only apply to an ICA fit with the same settings
+        saved_decim = int(prior.get('ica_decim') or 1)
+        saved_method = prior.get('ica_backend') or 'infomax'
+        if (saved_decim, saved_method) != (ica_decim, ica_method):
+            print("\n\tusing the saved ICA settings (" + saved_method + ", ica_decim=" + str(saved_decim) + ") so the saved bad ICs still apply\n")
+        ica_decim, ica_method = saved_decim, saved_method
+    ica_key_params = {'ica': ica_methods[ica_method], 'filter': ica_filter, 'picks': 'eeg', 'reject_by_annotation': True}
+    if ica_decim != 1:
+        ica_key_params['decim'] = ica_decim # only hashed when used, so full rate fits keep their existing keys
+    stage_keys['ica_fit'] = stage_key('ica_fit', preICA_info['output_key'], ica_key_params)
+    stage_keys['ica_apply'] = stage_key('ica_apply', stage_keys['ica_fit'], {})
+    saved_bad_ics = str(ic_list(prior.get('bad_ICs', "")))
+    postICA_info = valid_checkpoint(postICA_file, 'ica_apply', stage_keys['ica_apply'],
+                                    decisions={'bad_ICs': saved_bad_ics} if batch and 'bad_ICs' in prior else None,
+                                    legacy_decisions={'bad_ICs': saved_bad_ics}, adopt=reused_upstream and ica_decim == 1 and ica_method == 'infomax')
+    reused_upstream = reused_upstream and postICA_info is not None
+    epoch_params = {'ref_channels': 'average', 'windows': epo_windows, 'reject': epo_reject_dict, 'baseline': epo_baseline,
+                    'behavior': [source_key(bf) for bf in beh_files], 'behavior_fixes': sub_cfg['behavior_fixes'],
+                    'reconstruct_resp_from_rt': sub_cfg['reconstruct_resp_from_rt']}
+    epo_files = {cur_epo: os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_"+cur_epo+"_eeg-epo.fif")) for cur_epo in sub_cfg['epochs_wanted']}
+    if postICA_info is not None:
+        # -- nothing to do if every epoch file was already made from this postICA data with the current epoch parameters
+        stage_keys['epoch'] = stage_key('epoch', postICA_info['output_key'], epoch_params)
+        epo_up_to_date = True
+        for cur_epo, epo_file in epo_files.items():
+            epo_decisions = saved_epoch_decisions(prior, cur_epo, epo_file) if os.path.exists(epo_file) else None
+            epo_info = valid_checkpoint(epo_file, 'epoch', stage_keys['epoch'], decisions=epo_decisions if batch else None,
+                                        legacy_decisions=epo_decisions, adopt=reused_upstream)
+            epo_up_to_date = epo_up_to_date and epo_info is not None
+        if epo_up_to_date:
+            if epoch_store:
+                for epo_file in epo_files.values():
+                    if not epoch_store_is_current(store_file_for(epo_file), epo_file):
+                        save_epoch_store(mne.read_epochs(epo_file, preload=False), store_file_for(epo_file), source_file=epo_file)
+            print("\n\tall epoch files for sub-" + sub + " are up to date, nothing to re-run\n")
+            return
+
+    if postICA_info is None:
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # 4) run ICA on the data
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        print('\n\n - - - - - Running ICA - - - - - -\n')
+        if preICA_eeg is None:
+            # load preICA file
+            preICA_eeg = mne.io.read_raw_fif(preICA_file, preload = True)
+            events = find_subject_events(sub_cfg, raw_file, preICA_eeg) # pull out the events (triggers) from the data file
+            cur_csv['sampling_rate'] = preICA_eeg.info['sfreq']
+        ica_info = valid_checkpoint(ica_file, 'ica_fit', stage_keys['ica_fit'], adopt=False)
+        if ica_info is None:
             # -- now that we have removed bad channels and re-referenced, make a copy with a 1Hz high pass filter for ICA
             print('\nmaking a copy of the data and applying a ** 1 Hz ** high pass and ** 35 Hz ** low pass filter for ICA\n')
-            eeg_copy = preICA_eeg.copy().filter(l_freq=1.0, h_freq=35.0)
-            eeg_copy.plot(events=events, n_channels=71, scalings= {'eeg': 20e-6, 'emg': 40e-6, 'eog': 20e-6}, block=True )
-            i = input("Press Enter to Continue if the copy of the eeg data looks OK: ")
-            # -- set up to run ICA on the copied data
-            our_picks = mne.pick_types(eeg_copy.info, meg=False, eeg=True) #exclude=['EXG1', 'EXG2', 'EXG3', 'EXG4', 'EXG5', 'EXG6', 'EXG7', 'EXG8'])
-            ICA_method = mne.preprocessing.ICA(method = 'infomax', max_iter=500, fit_params=dict(extended=True))
+            eeg_copy = ica_fit_copy(preICA_eeg, low_mem)
+            if not batch:
+                eeg_copy.plot(events=events, n_channels=71, scalings= {'eeg': 20e-6, 'emg': 40e-6, 'eog': 20e-6}, block=True )
+                i = input("Press Enter to Continue if the copy of the eeg data looks OK: ")
             # -- fit ICA
-            print("\nfitting ICA to the copy of the data\nstarted running ICA on the data at ", datetime.datetime.now().strftime('%I:%M:%S %p'),"\n")
-            ica_output = ICA_method.fit(eeg_copy, picks=our_picks, reject_by_annotation=True)
-            # -- manually inspect and select artifactual ICs
-            print("\nplotting the properties using the data after running the copy of the data through ICA\n")
-            still_inspecting = True
-            while still_inspecting:
-                for pick_groups in [range(0,20), range(20,40), range(40, min(60, ica_output.n_components_))]:
-                    mne.viz.plot_ica_sources(ica_output, picks=pick_groups, inst=preICA_eeg)
-                    mne.viz.plot_ica_components(ica_output, picks=pick_groups, inst=preICA_eeg)
-                print('The ICs marked for rejection are: ' + str(ica_output.exclude))
-                i1 = input('Are you ready to move on to double checking that the bad IC selection was saved? [y/n]: ')
-                if i1 == 'y':
-                    still_inspecting = False
-            still_selecting = True
-            while still_selecting:
-                ica_output.plot_components() # here is where we actually mark for rejection
-                mne.viz.plot_ica_overlay(ica_output, inst=preICA_eeg, title='Signal before (in red) and after (in black) rejecting selected ICs')
-                print('The ICs marked for rejection are: ' + str(ica_output.exclude))
-                i2 = input('Are you sure you want to proceed? [y/n]: ' )
-                if i2 == 'y':
-                    cur_csv['bad_ICs'] = str(ica_output.exclude)
-                    still_selecting = False
-            # -- apply ICA back to original data
-            ica_output.apply(preICA_eeg) 
-            postICA_eeg = preICA_eeg.copy()
-            postICA_eeg.plot(events=events, n_channels=71, scalings= {'eeg': 20e-6, 'emg': 40e-6, 'eog': 20e-6}, block=True )
-            i = input("Press Enter to Continue if the post-ica data looks OK: ")
-            # -- save out data at this point so if we want to change later parameters we can
-            print(" \n\tsaving post-ica data ...\n")
-            postICA_eeg.save(fname = os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_eeg-postICA.fif")), overwrite=True)
-            print(cur_csv)
-            cur_df = pd.DataFrame(cur_csv, index=[0])
-            cur_df.to_csv(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_preprocessingParameters.csv")), index=False)
+            ica_output, fit_details = fit_ica(eeg_copy, ica_decim, ica_method)
+            del eeg_copy # not needed once the ICA is fit
+            # -- save the fit so a new IC selection does not need a re-fit
+            ica_output.save(ica_file, overwrite=True)
+            write_checkpoint(ica_file, 'ica_fit', stage_keys['ica_fit'], details=fit_details)
         else:
-            # load postICA file
-            postICA_eeg = mne.io.read_raw_fif(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_eeg-postICA.fif")), preload = True)
-            if int(sub) == 10273:
-                events = mne.find_events(postICA_eeg, shortest_event=1) # pull out the events (triggers) from the data file
-                events = np.delete(events, (2684), axis=0)
+            fit_details = ica_info['details']
+            ica_output = mne.preprocessing.read_ica(ica_file)
+            print("\nre-using the saved ICA fit (" + os.path.basename(ica_file) + "), previously selected ICs: " + str(ica_output.exclude) + "\n")
+        if fit_details:
+            report_ica_fit(fit_details)
+            cur_csv['ica_fit_seconds'] = fit_details['fit_seconds']
+            cur_csv['ica_n_iter'] = fit_details['n_iter']
+        cur_csv['ica_decim'] = ica_decim
+        cur_csv['ica_backend'] = ica_method
+        # -- score the ICs against the EOG/ECG channels so the review starts from a list of candidates
+        auto_bad_ics, ic_scores = score_artifact_ics(ica_output, preICA_eeg)
+        ic_scores.to_csv(ica_scores_file(sub), index=False)
+        cur_csv['auto_bad_ICs'] = str(auto_bad_ics)
+        print('\nICs flagged by their EOG/ECG correlation: ' + str(auto_bad_ics) + ' (scores saved to ' + os.path.basename(ica_scores_file(sub)) + ')\n')
+        if batch:
+            if 'bad_ICs' in prior:
+                # -- re-use the ICs selected in the previous run
+                ica_output.exclude = ic_list(prior['bad_ICs'])
+                print('The saved ICs marked for rejection are: ' + str(ica_output.exclude))
             else:
-                events = mne.find_events(postICA_eeg) # pull out the events (triggers) from the data file
-            sampling_rate = postICA_eeg.info['sfreq'] # get sampling rate
-            cur_csv = {'Participant_ID': sub, 'low_pass_filt': low_pass, 'high_pass_filt': high_pass, 'erp_baseline': str(epo_baseline), 'trl_baseline': 'None', 'sampling_rate': preICA_eeg.info['sfreq']}
-            cur_csv['ica_method'] = "input a copy of the continuous data with 1Hz highpass and 35Hz lowpass with no segment rejection THEN applied back to raw after selecting artefactual ICs"
-            tmp_df = pd.read_csv(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_preprocessingParameters.csv")))
-            cur_csv['bad_channels'] = list(tmp_df['bad_channels'])
-            cur_csv['bad_ICs'] = tmp_df['bad_ICs'].to_list()
-            print(cur_csv)
+                ica_output.exclude = list(auto_bad_ics)
+                print('No saved bad_ICs, rejecting the automatically flagged ICs: ' + str(ica_output.exclude))
+            cur_csv['bad_ICs'] = str([int(ic) for ic in ica_output.exclude])
+            still_inspecting = False
+        else:
+            if not ica_output.exclude:
+                ica_output.exclude = list(auto_bad_ics) # a re-used fit keeps its previous selection instead
+            # -- look at the pre-selected ICs first, the full review is only needed if they are not right
+            if ica_output.exclude:
+                ica_output.plot_properties(preICA_eeg, picks=ica_output.exclude)
+            print('The ICs marked for rejection are: ' + str(ica_output.exclude))
+            i0 = input('Are these all the artifactual ICs (skips the review of every component)? [y/n]: ')
+            still_inspecting = i0 != 'y'
+            if still_inspecting:
+                # -- manually inspect and select artifactual ICs
+                print("\nplotting the properties using the data after running the copy of the data through ICA\n")
+        while still_inspecting:
+            for pick_groups in [range(0,20), range(20,40), range(40, min(60, ica_output.n_components_))]:
+                mne.viz.plot_ica_sources(ica_output, picks=pick_groups, inst=preICA_eeg)
+                mne.viz.plot_ica_components(ica_output, picks=pick_groups, inst=preICA_eeg)
+            print('The ICs marked for rejection are: ' + str(ica_output.exclude))
+            i1 = input('Are you ready to move on to double checking that the bad IC selection was saved? [y/n]: ')
+            if i1 == 'y':
+                still_inspecting = False
+        still_selecting = not batch
+        while still_selecting:
+            ica_output.plot_components() # here is where we actually mark for rejection
+            mne.viz.plot_ica_overlay(ica_output, inst=preICA_eeg, title='Signal before (in red) and after (in black) rejecting selected ICs')
+            print('The ICs marked for rejection are: ' + str(ica_output.exclude))
+            i2 = input('Are you sure you want to proceed? [y/n]: ' )
+            if i2 == 'y':
+                cur_csv['bad_ICs'] = str([int(ic) for ic in ica_output.exclude])
+                still_selecting = False
+        # -- keep the selected ICs with the fit, so a later run starts from this selection
+        ica_output.save(ica_file, overwrite=True)
+        # -- apply ICA back to original data
+        postICA_eeg = ica_output.apply(preICA_eeg) # in place, preICA_eeg is not used after this
+        if not batch:
+            postICA_eeg.plot(events=events, n_channels=71, scalings= {'eeg': 20e-6, 'emg': 40e-6, 'eog': 20e-6}, block=True )
+            i = input("Press Enter to Continue if the post-ica data looks OK: ")
+        # -- save out data at this point so if we want to change later parameters we can
+        print(" \n\tsaving post-ica data ...\n")
+        postICA_eeg.save(fname = postICA_file, overwrite=True)
+        postICA_info = write_checkpoint(postICA_file, 'ica_apply', stage_keys['ica_apply'], {'bad_ICs': cur_csv['bad_ICs']})
+        save_preproc_params(sub, cur_csv)
+        report_memory("ICA")
+    else:
+        # load postICA file
+        postICA_eeg = mne.io.read_raw_fif(postICA_file, preload = True)
+        events = find_subject_events(sub_cfg, raw_file, postICA_eeg) # pull out the events (triggers) from the data file
+        cur_csv = {'Participant_ID': sub, 'low_pass_filt': low_pass, 'high_pass_filt': high_pass, 'erp_baseline': str(epo_baseline), 'trl_baseline': 'None', 'sampling_rate': postICA_eeg.info['sfreq']}
+        cur_csv['ica_method'] = "input a copy of the continuous data with 1Hz highpass and 35Hz lowpass with no segment rejection THEN applied back to raw after selecting artefactual ICs"
+        cur_csv['bad_channels'] = preICA_info['decisions']['bad_channels']
+        cur_csv.update(preICA_info['details']) # bad channel detection results
+        cur_csv['bad_ICs'] = postICA_info['decisions']['bad_ICs']
+        cur_csv['ica_decim'] = ica_decim
+        cur_csv['ica_backend'] = ica_method
+        print(cur_csv)
+    sampling_rate = postICA_eeg.info['sfreq'] # get sampling rate
+    stage_keys['epoch'] = stage_key('epoch', postICA_info['output_key'], epoch_params)
 
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-        # 5) re-reference data to average of all electrodes
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-        print('\n\n - - - - - Re-referencing Data - - - - - -\n\n')
-        eeg_reref, _ = mne.set_eeg_reference(inst=postICA_eeg, ref_channels='average', ch_type='eeg')
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # 5) re-reference data to average of all electrodes
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    print('\n\n - - - - - Re-referencing Data - - - - - -\n\n')
+    eeg_reref, _ = mne.set_eeg_reference(inst=postICA_eeg, ref_channels='average', ch_type='eeg', copy=False)
+    if not batch:
         eeg_reref.plot_psd(fmin=0.01, fmax=55.0) # plot psd again
         eeg_reref.plot(events=events, n_channels=71, scalings= {'eeg': 20e-6, 'emg': 40e-6, 'eog': 520e-6}, block=True )
         i = input("Press Enter to Continue if the re-referenced data looks OK: ")
-        # add behavioral data to eeg file 
-        #raw_reref.metadata = beh_df.reset_index()
+    # add behavioral data to eeg file 
+    #raw_reref.metadata = beh_df.reset_index()
 
 
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-        # 6) epoch data
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-        # - - get events from the data file
-        #     * epoching to the following (as of 7-10-2022)
-        #        1) cue onset
-        #        2) stimulus onset
-        #        3) response/fixation onset (feedback happens right after resp is made)
-        print('\n\n - - - - - Epoching Data - - - - - -\n')
-        all_inds = (np.asarray(events[:,2]) < 255)
-        all_events = events[all_inds]
-        # get events (triggers) related to the cue (trial onset)
-        # cue_codes = {'far':111,'fab':113,'fsr':121,'fsb':123, 'dar':211,'dsr':221,'dab':213,'dsb':223}
-        cue_inds = ( ((np.asarray(events[:,2]) > 110) & (np.asarray(events[:,2]) < 124)) | ((np.asarray(events[:,2]) > 210) & (np.asarray(events[:,2]) < 224)) )
-        cue_events = events[cue_inds]
-        print("total of ", len(cue_events), " cue events found\n")
-
-        # get events (triggers) related to the retro cue
-        # retrocue_codes = {'texture': 141, 'shape': 143, 'color': 145}
-        retrocue_inds = ((np.asarray(events[:,2]) > 140) & (np.asarray(events[:,2]) < 146))
-        retrocue_events = events[retrocue_inds]
-        print("total of ", len(cue_events), " retro cue events found\n")
-
-        # get events (triggers) related to the stimulus (face/scene)
-        # stim_codes = {'Face':151, 'Scene':153}
-        stim_inds = (((np.asarray(events[:,2]) == 151) | (np.asarray(events[:,2]) == 153)))
-        stim_events = events[stim_inds]
-        print("total of ", len(stim_events), " stim events found\n")
-
-        # get events (triggers) related to the response onset
-        # resp_codes =  {'correct/yes':171, 'correct/no': 173, 'incorrect/yes':175, 'incorrect/no':177}
-        if (int(sub) != 10106):
-            resp_inds = ((np.asarray(events[:,2]) > 170) & (np.asarray(events[:,2]) < 180))
-            resp_events = events[resp_inds]
-        else:
-            copy_of_events = mne.find_events(eeg_reref)
-            print(copy_of_events) # tuple where (sampling_rate, ?, trigger_code)... [(),(),(),...]
-            resp_inds = ((np.asarray(events[:,2]) > 170) & (np.asarray(events[:,2]) < 180))
-            resp_inds_tmp = [idx for idx, x in enumerate(resp_inds) if x]
-            for bindx, cur_ri in enumerate(resp_inds_tmp):
-                # change sampling rate value to what it should be based on BEH file
-                cur_sr = copy_of_events[cur_ri,0]
-                cur_ts = resp_df['rt'].tolist()[bindx]
-                mod_val = (1.5-cur_ts)*sampling_rate # calculate how much to subtract from original sample point value (and make sure it is in sample rate NOT seconds)
-                copy_of_events[cur_ri,0] = cur_sr - mod_val
-            print(copy_of_events)
-            resp_inds = ((np.asarray(copy_of_events[:,2]) > 170) & (np.asarray(copy_of_events[:,2]) < 180))
-            resp_events = copy_of_events[resp_inds]
-        print("total of ", len(resp_events), " resp events found\n")
-
-        if int(sub) != 10162:
-            # get events (triggers) related to the feedback onset
-            # feedback_codes = {'correct':181, 'incorrect':185}
-            feed_inds = ((np.asarray(events[:,2]) > 180) & (np.asarray(events[:,2]) < 190))
-            feed_events = events[feed_inds]
-            print("total of ", len(feed_events), " feed events found\n")
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # 6) epoch data
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # - - get events from the data file
+    #     * epoching to the following (as of 7-10-2022)
+    #        1) cue onset
+    #        2) stimulus onset
+    #        3) response/fixation onset (feedback happens right after resp is made)
+    print('\n\n - - - - - Epoching Data - - - - - -\n')
+    all_inds = (np.asarray(events[:,2]) < 255)
+    all_events = events[all_inds]
+    # get events (triggers) related to the cue (trial onset)
+    # cue_codes = {'far':111,'fab':113,'fsr':121,'fsb':123, 'dar':211,'dsr':221,'dab':213,'dsb':223}
+    cue_inds = ( ((np.asarray(events[:,2]) > 110) & (np.asarray(events[:,2]) < 124)) | ((np.asarray(events[:,2]) > 210) & (np.asarray(events[:,2]) < 224)) )
+    cue_events = events[cue_inds]
+    print("total of ", len(cue_events), " cue events found\n")
 
-        # --- epoch the data to the trial period (7 second epochs)
-        #     cue ........ 0 ms (make cue onset the start of the trial)
-        #     delay1 ..... 500 ms
-        #     retro cue .. 1300 ms
-        #     delay2 ..... 1800 ms
-        #     stim ....... 3800 ms
-        #     feedback ... 5300 ms (lasts for 500 ms... trl end is 5800 ms)
-        checking_auto_rej = True
-        while checking_auto_rej:
-            print('top of while loop')
-            trl_epochs = mne.Epochs(raw = eeg_reref, events = cue_events, event_id = cue_codes, tmin = -1.0, tmax = 6.0, reject=epo_reject_dict,
-                                    baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
-            trl_epochs.plot_drop_log() # so we can see if a certain channel is causing lots of data loss
-            try:
-                num_interp_already = len(str(cur_csv['bad_channels'][0]).split(' '))
-            except:
-                num_interp_already = 0
-            new_bad_num = 7 # set high here so it stays in the while loop
-            print("\nReminder!!! You have already interpolated " + str(num_interp_already) + " channels (" + str(cur_csv['bad_channels'][0]) + ")\n")
-            i4 = input("Is there a channel causing lots of data loss that we should interpolate? [y/n]: ")
-            if i4 == 'y':
-                eeg_reref.plot(events=events, n_channels = 71, scalings= {'eeg': 20e-6, 'emg': 50e-6, 'eog': 50e-6}, block=True) # plot continuous data
-                i = input("Press Enter to Continue if you are finished selecting extra channels to interpolate (REMINDER: you cannot interpolate more than 6 in total): ")
-                new_bad_num = len(eeg_reref.info['bads'])
-                if (num_interp_already+new_bad_num)>6:
-                    print("\nReminder!!! You have already interpolated " + str(num_interp_already) + " channels (" + str(cur_csv['bad_channels'][0]) + ")\n")
-                    print("\n * * * * * The code will not interpolate the selected channels because more than 6 in total have been selected * * * * *\n")
-                elif eeg_reref.info['bads']: 
-                    eeg_reref_interp = eeg_reref.copy().interpolate_bads()
-                    eeg_reref_interp.plot(events=events, n_channels = 71, scalings= {'eeg': 20e-6, 'emg': 50e-6, 'eog': 50e-6}, block=True) # plot continuous data
-                    check_choice = True
-                    while check_choice:
-                        i5 = input("Should we use the interpolated version for epoching? [y/n]: ")
-                        if i5 == 'y':
-                            cur_csv['bad_channels'] = (str(cur_csv['bad_channels'][0]) + ' ' + ' '.join(eeg_reref.info['bads']))
-                            eeg_reref = eeg_reref_interp # make this our reref file
-                            check_choice = False
-                        elif i5 == 'n':
-                            eeg_reref.info['bads'] = []
-                            check_choice = False
-                        else:
-                            print('Unrecognized response... Please try again')
-            else:
-                checking_auto_rej = False
-        print(cur_csv)
-        cur_df = pd.DataFrame(cur_csv, index=[0])
-        cur_df.to_csv(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_preprocessingParameters.csv")), index=False)
-
-        # --- epoch trl epochs further into their specific events
-        cue_epochs = mne.Epochs(raw = eeg_reref, events = cue_events, event_id = cue_codes, tmin = -0.8, tmax = 1.2, reject=epo_reject_dict,
-                                baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
-        
-        retrocue_epochs = mne.Epochs(raw = eeg_reref, events = retrocue_events, event_id = retrocue_codes, tmin = -1.0, tmax = 2.0, reject=epo_reject_dict,
-                                baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
-    
-        stim_epochs = mne.Epochs(raw = eeg_reref, events = stim_events, event_id = stim_codes, tmin = -0.8, tmax = 1.7, reject=epo_reject_dict,
-                                baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
-        
-        resp_epochs = mne.Epochs(raw = eeg_reref, events = resp_events, event_id = resp_codes, tmin = -0.8, tmax = 1.2, reject=epo_reject_dict,
-                                baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = resp_df, preload = True)
-            
-        if int(sub) != 10162:
-            feed_epochs = mne.Epochs(raw = eeg_reref, events = feed_events, event_id = feed_codes, tmin = -0.85, tmax = 0.65, reject=epo_reject_dict,
-                                    baseline = None, on_missing = 'warn', event_repeated = 'drop', metadata = beh_df, preload = True)
-            
-            epo_dict = {'trl':trl_epochs, 'cue':cue_epochs, 'retro_cue':retrocue_epochs, 'stim':stim_epochs, 'resp':resp_epochs, 'feedback':feed_epochs}
+    # get events (triggers) related to the retro cue
+    # retrocue_codes = {'texture': 141, 'shape': 143, 'color': 145}
+    retrocue_inds = ((np.asarray(events[:,2]) > 140) & (np.asarray(events[:,2]) < 146))
+    retrocue_events = events[retrocue_inds]
+    print("total of ", len(cue_events), " retro cue events found\n")
+
+    # get events (triggers) related to the stimulus (face/scene)
+    # stim_codes = {'Face':151, 'Scene':153}
+    stim_inds = (((np.asarray(events[:,2]) == 151) | (np.asarray(events[:,2]) == 153)))
+    stim_events = events[stim_inds]
+    print("total of ", len(stim_events), " stim events found\n")
+
+    # get events (triggers) related to the response onset
+    # resp_codes =  {'correct/yes':171, 'correct/no': 173, 'incorrect/yes':175, 'incorrect/no':177}
+    if not sub_cfg['reconstruct_resp_from_rt']:
+        resp_inds = ((np.asarray(events[:,2]) > 170) & (np.asarray(events[:,2]) < 180))
+        resp_events = events[resp_inds]
+    else:
+        copy_of_events = mne.find_events(eeg_reref)
+        print(copy_of_events) # tuple where (sampling_rate, ?, trigger_code)... [(),(),(),...]
+        resp_inds = ((np.asarray(events[:,2]) > 170) & (np.asarray(events[:,2]) < 180))
+        resp_inds_tmp = [idx for idx, x in enumerate(resp_inds) if x]
+        for bindx, cur_ri in enumerate(resp_inds_tmp):
+            # change sampling rate value to what it should be based on BEH file
+            cur_sr = copy_of_events[cur_ri,0]
+            cur_ts = resp_df['rt'].tolist()[bindx]
+            mod_val = (1.5-cur_ts)*sampling_rate # calculate how much to subtract from original sample point value (and make sure it is in sample rate NOT seconds)
+            copy_of_events[cur_ri,0] = cur_sr - mod_val
+        print(copy_of_events)
+        resp_inds = ((np.asarray(copy_of_events[:,2]) > 170) & (np.asarray(copy_of_events[:,2]) < 180))
+        resp_events = copy_of_events[resp_inds]
+    print("total of ", len(resp_events), " resp events found\n")
+
+    if sub_cfg['feedback_epochs']:
+        # get events (triggers) related to the feedback onset
+        # feedback_codes = {'correct':181, 'incorrect':185}
+        feed_inds = ((np.asarray(events[:,2]) > 180) & (np.asarray(events[:,2]) < 190))
+        feed_events = events[feed_inds]
+        print("total of ", len(feed_events), " feed events found\n")
+
+    # --- epoch the data to the trial period (7 second epochs)
+    #     cue ........ 0 ms (make cue onset the start of the trial)
+    #     delay1 ..... 500 ms
+    #     retro cue .. 1300 ms
+    #     delay2 ..... 1800 ms
+    #     stim ....... 3800 ms
+    #     feedback ... 5300 ms (lasts for 500 ms... trl end is 5800 ms)
+    cur_csv['extra_bad_channels'] = ""
+    if batch:
+        # -- re-use the extra channels that were interpolated after ICA in the previous run
+        if extra_bads:
+            eeg_reref.info['bads'] = extra_bads
+            eeg_reref.interpolate_bads()
+        cur_csv['extra_bad_channels'] = ' '.join(extra_bads)
+    # -- peak-to-peak of every trl epoch and channel, computed once; thresholds and extra channels to interpolate
+    #    are tried out on this matrix instead of re-epoching the data for every option (see thalhiv2_rejection.py)
+    epo_reject = saved_epo_reject(prior) if batch else dict(epo_reject_dict)
+    trl_ptp = epoch_ptp(eeg_reref, cue_events, epo_windows['trl'][0], epo_windows['trl'][1])
+    checking_auto_rej = not batch
+    while checking_auto_rej:
+        interp_already = channel_list(cur_csv['bad_channels']) + channel_list(cur_csv['extra_bad_channels'])
+        num_interp_already = len(interp_already)
+        new_bad_num = max_interp_channels + 1 # set high here so it stays in the while loop
+        data_threshold = suggested_threshold(trl_ptp)
+        print("\ntrl epochs kept (out of " + str(len(cue_events)) + ") for each eeg threshold, interpolating 0, 1, ... of the channels that lose the most epochs:\n")
+        thresholds = epo_reject_candidates + [epo_reject['eeg']] + ([data_threshold] if data_threshold is not None else [])
+        print(rejection_table(trl_ptp, epo_reject, sorted(set(thresholds)),
+                              max_interp_channels - num_interp_already, exclude=interp_already).to_string(index=False))
+        if data_threshold is not None:
+            print("\ndata-driven eeg threshold (median + 3 MAD of the largest peak-to-peak per epoch): %.1f uV" % (data_threshold * 1e6))
         else:
-            epo_dict = {'trl':trl_epochs, 'cue':cue_epochs, 'retro_cue':retrocue_epochs, 'stim':stim_epochs, 'resp':resp_epochs}
-        
-        if int(sub)==10279:
-            epochs_currently_wanted = ['stim','resp']
+            print("\nno usable trl epochs (all outside the recording or in a bad annotation), so no data-driven eeg threshold")
+        print("\nReminder!!! You have already interpolated " + str(num_interp_already) + " channels (" + ' '.join(interp_already) + ")\n")
+        i3 = input("eeg rejection threshold in uV (press Enter to keep " + str(round(epo_reject['eeg'] * 1e6, 1)) + "): ")
+        if i3.strip():
+            epo_reject['eeg'] = float(i3) * 1e-6
+        i4 = input("Is there a channel causing lots of data loss that we should interpolate? [y/n]: ")
+        if i4 == 'y':
+            # -- start from the channels the detection flags in the post-ICA data (within what is left of the limit)
+            eeg_reref.info['bads'], _ = detect_bad_channels(eeg_reref, max_bads=max_interp_channels - num_interp_already, exclude=interp_already)
+            print("channels flagged by the bad channel detection: " + str(eeg_reref.info['bads']))
+            eeg_reref.plot(events=events, n_channels = 71, scalings= {'eeg': 20e-6, 'emg': 50e-6, 'eog': 50e-6}, block=True) # plot continuous data
+            i = input("Press Enter to Continue if you are finished selecting extra channels to interpolate (REMINDER: you cannot interpolate more than " + str(max_interp_channels) + " in total): ")
+            new_bad_num = len(eeg_reref.info['bads'])
+            if (num_interp_already+new_bad_num)>max_interp_channels:
+                print("\nReminder!!! You have already interpolated " + str(num_interp_already) + " channels (" + ' '.join(interp_already) + ")\n")
+                print("\n * * * * * The code will not interpolate the selected channels because more than " + str(max_interp_channels) + " in total have been selected * * * * *\n")
+                eeg_reref.info['bads'] = []
+            elif eeg_reref.info['bads']: 
+                new_bads = list(eeg_reref.info['bads'])
+                if low_mem:
+                    # -- interpolate in place and only keep the original data of the new bad channels in case we go back
+                    bad_idx = mne.pick_channels(eeg_reref.ch_names, new_bads, ordered=True)
+                    bad_data = eeg_reref.get_data(picks=bad_idx)
+                    eeg_reref_interp = eeg_reref.interpolate_bads()
+                else:
+                    eeg_reref_interp = eeg_reref.copy().interpolate_bads()
+                eeg_reref_interp.plot(events=events, n_channels = 71, scalings= {'eeg': 20e-6, 'emg': 50e-6, 'eog': 50e-6}, block=True) # plot continuous data
+                check_choice = True
+                while check_choice:
+                    i5 = input("Should we use the interpolated version for epoching? [y/n]: ")
+                    if i5 == 'y':
+                        cur_csv['extra_bad_channels'] = (cur_csv['extra_bad_channels'] + ' ' + ' '.join(new_bads)).strip()
+                        eeg_reref = eeg_reref_interp # make this our reref file
+                        update_ptp(trl_ptp, eeg_reref, new_bads) # only the interpolated channels changed
+                        check_choice = False
+                    elif i5 == 'n':
+                        if low_mem:
+                            eeg_reref._data[bad_idx] = bad_data # undo the in place interpolation
+                        eeg_reref.info['bads'] = []
+                        check_choice = False
+                    else:
+                        print('Unrecognized response... Please try again')
         else:
-            epochs_currently_wanted = ['trl','stim','resp']
-        for cur_epo in epochs_currently_wanted:
-            cur_epo_obj = epo_dict[cur_epo] # pull out current epoch object
-            #cur_epo_obj.plot_drop_log() # see if a particular channel results in most of the epoch loss 
-            rej_epo = True
-            while rej_epo:
-                #epo_events = mne.find_events(cur_epo_obj)
-                mne.viz.plot_epochs(cur_epo_obj, picks='all', events=events, n_channels=71, scalings= {'eeg': 20e-6, 'emg': 40e-6, 'eog': 20e-6}, block=True )
-                ie = input('\nAre you sure you want to proceed? [y/n]: ')
-                if ie == 'y':
-                    rej_epo = False
-            cur_epo_obj.save(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_"+cur_epo+"_eeg-epo.fif")), overwrite=False)
+            checking_auto_rej = False
+    cur_csv['epo_reject_eeg_uv'] = round(epo_reject['eeg'] * 1e6, 3)
+    print("\nepoching with eeg threshold " + str(cur_csv['epo_reject_eeg_uv']) + " uV, expecting " + str(int(surviving_epochs(trl_ptp, epo_reject).sum())) + " trl epochs\n")
+    save_preproc_params(sub, cur_csv)
+
+    # --- epoch every wanted event type, re-using the trl peak-to-peak for the rejection and reading each trial
+    #     window once (see thalhiv2_epochs.py)
+    epo_specs = {'trl': {'events': cue_events, 'event_id': cue_codes, 'metadata': beh_df},
+                 'cue': {'events': cue_events, 'event_id': cue_codes, 'metadata': beh_df},
+                 'retro_cue': {'events': retrocue_events, 'event_id': retrocue_codes, 'metadata': beh_df},
+                 'stim': {'events': stim_events, 'event_id': stim_codes, 'metadata': beh_df},
+                 'resp': {'events': resp_events, 'event_id': resp_codes, 'metadata': resp_df}}
+    if sub_cfg['feedback_epochs']:
+        epo_specs['feedback'] = {'events': feed_events, 'event_id': feed_codes, 'metadata': beh_df}
+    epo_specs = {cur_epo: dict(epo_specs[cur_epo], tmin=epo_windows[cur_epo][0], tmax=epo_windows[cur_epo][1]) for cur_epo in epo_files}
+    epo_dict = build_epochs(eeg_reref, epo_specs, epo_reject, trl_ptp)
+    del trl_ptp
+    print("\nepochs kept: " + ', '.join(cur_epo + ' ' + str(len(epo_dict[cur_epo])) for cur_epo in epo_dict) + "\n")
+
+    for cur_epo, epo_file in epo_files.items():
+        cur_epo_obj = epo_dict[cur_epo] # pull out current epoch object
+        #cur_epo_obj.plot_drop_log() # see if a particular channel results in most of the epoch loss 
+        if batch:
+            # -- drop the epochs that were rejected by hand in the previous run (saved as indices into the original events)
+            user_rej = saved_user_rejected_epochs(prior, cur_epo, epo_file)
+            cur_epo_obj.drop(np.flatnonzero(np.isin(cur_epo_obj.selection, user_rej)), reason='USER')
+        rej_epo = not batch
+        while rej_epo:
+            #epo_events = mne.find_events(cur_epo_obj)
+            mne.viz.plot_epochs(cur_epo_obj, picks='all', events=events, n_channels=71, scalings= {'eeg': 20e-6, 'emg': 40e-6, 'eog': 20e-6}, block=True )
+            ie = input('\nAre you sure you want to proceed? [y/n]: ')
+            if ie == 'y':
+                rej_epo = False
+        cur_csv['user_rejected_'+cur_epo+'_epochs'] = ' '.join(str(ind) for ind, log in enumerate(cur_epo_obj.drop_log) if 'USER' in log)
+        if os.path.exists(epo_file):
+            # -- the epoch stage only runs when a checkpoint said the epoch files are out of date, and all of them are
+            #    re-made with the same decisions, so the old file is removed on purpose (not by overwrite=True)
+            print("\treplacing " + os.path.basename(epo_file) + " (made with older epoch inputs or decisions)")
+            remove_checkpoint(epo_file)
+        cur_epo_obj.save(epo_file, overwrite=False)
+        if epoch_store:
+            save_epoch_store(cur_epo_obj, store_file_for(epo_file), source_file=epo_file)
+        del epo_dict[cur_epo] # saved, no need to keep it in memory
+        write_checkpoint(epo_file, 'epoch', stage_keys['epoch'], dict({'extra_bad_channels': cur_csv['extra_bad_channels'],
+                                                                       'user_rejected_epochs': cur_csv['user_rejected_'+cur_epo+'_epochs']},
+                                                                      **reject_decision(epo_reject)))
+    save_preproc_params(sub, cur_csv)
+    report_memory("epoching")
 
 
 
@@ -569,44 +849,31 @@ if args.preproc:
 # - - - - - - - - - - - - - - - -     Num Usable Epochs     - - - - - - - - - - - - - - - - - - -
 # ----------------------------------------------------------------------------------------------- 
 # ----------------------------------------------------------------------------------------------- 
-epo_plot_dict = {'Usable_stim_epochs': 'stim', 'Usable_trl_epochs': 'trl', 'Usable_resp_epochs': 'resp'}
-if args.get_epoch_nums:
+epo_nums_dict = {'Usable_stim_epochs': 'stim', 'Usable_trl_epochs': 'trl', 'Usable_resp_epochs': 'resp'}
+
+def epoch_count_tasks(sub_list):
+    ''' (subject, epoch type, epoch file) for every subject and epoch type counted by --get_epoch_nums '''
+    return [(sub, epo_type, os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_"+epo_type+"_eeg-epo.fif")))
+            for sub in sub_list for epo_type in epo_nums_dict.values()]
+
+def get_epoch_nums(subj_opt, jobs=1):
     # -- get list of epoched subjects
-    epo_subjects = generate_subj_list(subj_opt, os.path.join(output_path,"preproc"), 'stim_eeg-epo.fif')
-    sub_list = []
-    for epo_file in epo_subjects:
-        sid = re.search("[0-9]{5}",epo_file) # pull out subject id number from raw file string
-        if sid:
-            sub_list.append(sid.group(0))
-    print(sub_list)
+    sub_list = epoched_subjects(subj_opt)
 
-    # load google sheet as a data frame
-    sheet_name = "Preprocessing"
-    doc_info="" # would normally contain link info BUT removing for github upload
-    url = f"https://docs.google.com/spreadsheets/{doc_info}=out:csv&sheet={sheet_name}"
-    prepro_df = pd.read_csv(url)
-    print(prepro_df) # check that it loaded properly by viewing
-    
-    # -- now grab file and get usable epochs for each participant
-    #epo_nums_df = pd.DataFrame({'Subject_ID':sub_list, 'Usable_trl_epochs':np.zeros(len(sub_list)), 'Usable_stim_epochs':np.zeros(len(sub_list)), 'Usable_resp_epochs':np.zeros(len(sub_list))})
-    #print(epo_nums_df)
-    for sub in sorted(sub_list):
-        print("\ncurrently working on subject ", str(sub), "...")
-        sub_idx=list(prepro_df['Subject_ID']).index(int(sub))
-        for cur_epo_type in epo_plot_dict.keys():
-            print("currently getting epoch numbers for "+cur_epo_type)
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # 1) load raw data and set channel types and montage
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            epo_eeg = mne.read_epochs(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_"+epo_plot_dict[cur_epo_type]+"_eeg-epo.fif")), proj=True, preload = False)
-            usable_epos = epo_eeg.selection
-            num_usable_epos = usable_epos.shape[0]
-            prepro_df[cur_epo_type][sub_idx] = num_usable_epos
+    # -- usable (and dropped) epoch counts from the selection / drop log of each epoch file, no epochs are loaded
+    counts = epoch_counts_table(epoch_count_tasks(sub_list), jobs=jobs)
+    print(counts.to_string(index=False))
+    counts.to_csv(os.path.join(output_path,"preproc","epoch_counts.csv"), index=False)
+
+    # -- one Usable_<type>_epochs field per epoch type, written into the registry for all subjects in one go
+    usable = counts[counts['status'] == 'ok'].pivot(index='subject', columns='epoch_type', values='n_kept')
+    usable = usable.rename(columns={epo_type: col for col, epo_type in epo_nums_dict.items()})
+    update_subjects(registry_file, {sub: row.dropna().astype(int).to_dict() for sub, row in usable.iterrows()}, source='get_epoch_nums')
+
+    # -- the registry in the layout of the old google sheet (python thalhiv2_registry.py --export_sheet does the same)
+    prepro_df = sheet_table(registry_file)
     print(prepro_df)
-    
-    # upload changes to google sheet
-    prepro_df.to_csv(os.path.join(output_path,"scripts","temp.csv"))
-    #d2g.upload(prepro_df, gfile=url, wks_name=sheet_name) # would need to add credentials to actually update google sheet
+    prepro_df.to_csv(os.path.join(output_path,"scripts","temp.csv"), index=False)
             
 
 
@@ -617,16 +884,10 @@ if args.get_epoch_nums:
 # - - - - - - - - - - - - - - - -     Re-inspect Epochs     - - - - - - - - - - - - - - - - - - -
 # ----------------------------------------------------------------------------------------------- 
 # ----------------------------------------------------------------------------------------------- 
-epo_plot_dict = {'stimulus': 'stim', 'cue': 'trl', 'response': 'resp'}
-if args.reinspect_epochs:
+def reinspect_epochs(subj_opt):
+    epo_plot_dict = {'stimulus': 'stim', 'cue': 'trl', 'response': 'resp'}
     # -- get list of epoched subjects
-    epo_subjects = generate_subj_list(subj_opt, os.path.join(output_path,"preproc"), 'stim_eeg-epo.fif')
-    sub_list = []
-    for epo_file in epo_subjects:
-        sid = re.search("[0-9]{5}",epo_file) # pull out subject id number from raw file string
-        if sid:
-            sub_list.append(sid.group(0))
-    print(sub_list)
+    sub_list = epoched_subjects(subj_opt)
 
     # -- now grab file and re-inspect for each participant
     for sub in sorted(sub_list):
@@ -706,18 +967,20 @@ if args.reinspect_epochs:
 # stim_codes = {'Face':151, 'Scene':153}
 # resp_codes =  {'correct/yes':171, 'correct/no': 173, 'incorrect/yes':175, 'incorrect/no':177}
 # feed_codes = {'correct':181, 'incorrect':185}
-epo_plot_dict = {'stimulus': 'stim' , 'response': 'resp', 'cue': 'trl'}
-
-if args.gen_vis_erp_plots:
+def gen_vis_erp_plots(subj_opt, batch=False, jobs=1, log_dir=None, max_mem_gb=None):
     # -- get list of epoched subjects
-    epo_subjects = generate_subj_list(subj_opt, os.path.join(output_path,"preproc"), 'stim_eeg-epo.fif')
-    sub_list = []
-    for epo_file in epo_subjects:
-        sid = re.search("[0-9]{5}",epo_file) # pull out subject id number from raw file string
-        if sid:
-            sub_list.append(sid.group(0))
-    print(sub_list)
+    sub_list = epoched_subjects(subj_opt)
+    if batch:
+        # -- nothing to look at, so save the figures and run jobs subjects at a time
+        run_subjects(functools.partial(plot_vis_erps, batch=True), [(sub, sub) for sub in sub_list], 'gen_vis_erp_plots',
+                     log_dir, jobs=jobs, max_mem_gb=max_mem_gb)
+    else:
+        for sub in sub_list:
+            plot_vis_erps(sub)
 
+def plot_vis_erps(sub, batch=False):
+    ''' visual erp plots of one subject (shown one at a time, or saved to <output_path>/figures with batch=True) '''
+    epo_plot_dict = {'stimulus': 'stim' , 'response': 'resp', 'cue': 'trl'}
     # -- epoch the data to the trial period (7 second epochs)
     #     cue ........ 0 ms (make cue onset the start of the trial)
     #     delay1 ..... 500 ms
@@ -725,73 +988,115 @@ if args.gen_vis_erp_plots:
     #     delay2 ..... 1800 ms
     #     stim ....... 3800 ms
     #     feedback ... 5300 ms (lasts for 500 ms... trl end is 5800 ms)
-    for sub in sorted(sub_list):
-        print("\ncurrently working on subject ", str(sub), "...")
-        for cur_epo_type in epo_plot_dict.keys():
-            print("currently generating ERP plots for "+cur_epo_type+" epochs")
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # 1) load raw data and set channel types and montage
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            epo_eeg_all = mne.read_epochs(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_"+epo_plot_dict[cur_epo_type]+"_eeg-epo.fif")), preload = False)
-            epo_eeg = epo_eeg_all.copy()
-            epo_eeg.drop_bad()
-            #epo_eeg.set_montage(montage = "biosemi64")
-            #epo_events = mne.find_events(epo_eeg) # pull out the events (triggers) from the data file
-            print(epo_eeg.info)
-            if cur_epo_type == 'stimulus':
-                epo_eeg.apply_baseline(baseline=(None,0.0))
-                # epo_eeg.crop(tmin=3.0, tmax=4.5) #(tmin=-1.0, tmax=4.5)
-                # epo_eeg.apply_baseline(baseline=(3.0,3.8))
-            elif cur_epo_type == 'feedback':
-                epo_eeg.crop(tmin=4.5, tmax=6.0) #(tmin=-1.0, tmax=4.5)
-                epo_eeg.apply_baseline(baseline=(4.5,5.0))
-            elif cur_epo_type == 'response':
-                epo_eeg.apply_baseline(baseline=(-0.75,-0.25))
-            else: 
-                epo_eeg.apply_baseline(baseline=(-0.8,0.))
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # 2) convert epoched file to a pandas dataframe format
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            epo_df = epo_eeg.to_data_frame() # time will be in milliseconds and channel measurements in microvolts now
-            # -- grab face vs scene trials
-            stim_conds = []
-            for sc in list(epo_df.condition):
-                stim_conds.append(sc.split("/")[0])
-            epo_df["target"] = stim_conds
-            # -- grab occipital channels since it is a visual erp
-            if cur_epo_type == 'response':
-                channels = ["FCz", "Fz", "FC1", "FC2", "Cz"] 
-                # -- create data frame with just time points, target conditions, epochs, and occipital electrode average
-                vis_erp_data = pd.melt(epo_df[(["time","target","epoch"]+channels)], id_vars=["time","target","epoch"], value_vars=channels)
-            elif cur_epo_type == 'stimulus':
-                channels = ["P3","P5","P7","PO3","PO7","O1","O2","PO4","PO8","P8","P6","P4"]
-                # -- create data frame with just time points, target conditions, epochs, and occipital electrode average
-                # BELOW COMMENT MAKES COOL PLOTS BUT WE WON'T USE THEM FOR NOW ...
-                # av1 = epo_eeg["stimulus == 'Face'"].average()
-                # av2 = epo_eeg["stimulus == 'Scene'"].average()
-                # joint_kwargs = dict(ts_args=dict(time_unit='s'),
-                #                     topomap_args=dict(time_unit='s'))
-                # av1.plot_joint(show=False, **joint_kwargs)
-                # av2.plot_joint(show=False, **joint_kwargs)
-                # evokeds = dict()
-                # query = "stimulus == '{}'"
-                # for cur_stim in epo_eeg.metadata['stimulus'].unique():
-                #     evokeds[str(cur_stim)] = epo_eeg[query.format(cur_stim)].average()
-                # mne.viz.plot_compare_evokeds(evokeds, cmap=('stimulus category', 'viridis'), picks=channels) 
-                # i = input("Press Enter to Continue: ")
-                vis_erp_data = pd.melt(epo_df[(["time","target","epoch"]+channels)], id_vars=["time","target","epoch"], value_vars=channels)
-            else: 
-                channels = ["FCz", "Fz", "FC1", "FC2", "Cz"] 
-                # -- create data frame with just time points, target conditions, epochs, and occipital electrode average
-                vis_erp_data = pd.melt(epo_df[(["time","target","epoch"]+channels)], id_vars=["time","target","epoch"], value_vars=channels)
-            print(vis_erp_data)
+    print("\ncurrently working on subject ", str(sub), "...")
+    for cur_epo_type in epo_plot_dict.keys():
+        print("currently generating ERP plots for "+cur_epo_type+" epochs")
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # 1) load raw data and set channel types and montage
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        epo_eeg_all = mne.read_epochs(os.path.join(output_path,"preproc",("sub-"+sub+"_task-ThalHiV2_"+epo_plot_dict[cur_epo_type]+"_eeg-epo.fif")), preload = False)
+        epo_eeg = epo_eeg_all.copy()
+        epo_eeg.drop_bad()
+        #epo_eeg.set_montage(montage = "biosemi64")
+        #epo_events = mne.find_events(epo_eeg) # pull out the events (triggers) from the data file
+        print(epo_eeg.info)
+        if cur_epo_type == 'stimulus':
+            epo_eeg.apply_baseline(baseline=(None,0.0))
+            # epo_eeg.crop(tmin=3.0, tmax=4.5) #(tmin=-1.0, tmax=4.5)
+            # epo_eeg.apply_baseline(baseline=(3.0,3.8))
+        elif cur_epo_type == 'feedback':
+            epo_eeg.crop(tmin=4.5, tmax=6.0) #(tmin=-1.0, tmax=4.5)
+            epo_eeg.apply_baseline(baseline=(4.5,5.0))
+        elif cur_epo_type == 'response':
+            epo_eeg.apply_baseline(baseline=(-0.75,-0.25))
+        else: 
+            epo_eeg.apply_baseline(baseline=(-0.8,0.))
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # 2) convert epoched file to a pandas dataframe format
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        epo_df = epo_eeg.to_data_frame() # time will be in milliseconds and channel measurements in microvolts now
+        # -- grab face vs scene trials
+        stim_conds = []
+        for sc in list(epo_df.condition):
+            stim_conds.append(sc.split("/")[0])
+        epo_df["target"] = stim_conds
+        # -- grab occipital channels since it is a visual erp
+        if cur_epo_type == 'response':
+            channels = ["FCz", "Fz", "FC1", "FC2", "Cz"] 
+            # -- create data frame with just time points, target conditions, epochs, and occipital electrode average
+            vis_erp_data = pd.melt(epo_df[(["time","target","epoch"]+channels)], id_vars=["time","target","epoch"], value_vars=channels)
+        elif cur_epo_type == 'stimulus':
+            channels = ["P3","P5","P7","PO3","PO7","O1","O2","PO4","PO8","P8","P6","P4"]
+            # -- create data frame with just time points, target conditions, epochs, and occipital electrode average
+            # BELOW COMMENT MAKES COOL PLOTS BUT WE WON'T USE THEM FOR NOW ...
+            # av1 = epo_eeg["stimulus == 'Face'"].average()
+            # av2 = epo_eeg["stimulus == 'Scene'"].average()
+            # joint_kwargs = dict(ts_args=dict(time_unit='s'),
+            #                     topomap_args=dict(time_unit='s'))
+            # av1.plot_joint(show=False, **joint_kwargs)
+            # av2.plot_joint(show=False, **joint_kwargs)
+            # evokeds = dict()
+            # query = "stimulus == '{}'"
+            # for cur_stim in epo_eeg.metadata['stimulus'].unique():
+            #     evokeds[str(cur_stim)] = epo_eeg[query.format(cur_stim)].average()
+            # mne.viz.plot_compare_evokeds(evokeds, cmap=('stimulus category', 'viridis'), picks=channels) 
+            # i = input("Press Enter to Continue: ")
+            vis_erp_data = pd.melt(epo_df[(["time","target","epoch"]+channels)], id_vars=["time","target","epoch"], value_vars=channels)
+        else: 
+            channels = ["FCz", "Fz", "FC1", "FC2", "Cz"] 
+            # -- create data frame with just time points, target conditions, epochs, and occipital electrode average
+            vis_erp_data = pd.melt(epo_df[(["time","target","epoch"]+channels)], id_vars=["time","target","epoch"], value_vars=channels)
+        print(vis_erp_data)
 
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # 3) generate basic visual erp plots of the data
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # -- actually generate and display the erp plot
-            fig = plt.figure() # might not need this...
-            sns.lineplot(x='time', y='value', hue='target', data=vis_erp_data[((vis_erp_data.time>-300) & (vis_erp_data.time<1000))])
-            fig.suptitle(("sub-" + sub + " " + cur_epo_type + " onset"))
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # 3) generate basic visual erp plots of the data
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # -- actually generate and display the erp plot
+        fig = plt.figure() # might not need this...
+        sns.lineplot(x='time', y='value', hue='target', data=vis_erp_data[((vis_erp_data.time>-300) & (vis_erp_data.time<1000))])
+        fig.suptitle(("sub-" + sub + " " + cur_epo_type + " onset"))
+        if batch:
+            os.makedirs(os.path.join(output_path,"figures"), exist_ok=True)
+            fig.savefig(os.path.join(output_path,"figures",("sub-"+sub+"_task-ThalHiV2_"+epo_plot_dict[cur_epo_type]+"_vis-erp.png")))
+            plt.close(fig)
+        else:
             plt.draw()
             i = input("Press Enter to Continue: ")
+
+
+
+# ----------------------------------------------------------------------------------------------- 
+# ----------------------------------------------------------------------------------------------- 
+# - - - - - - - - - - - - - - - - - - - -   Run Stages    - - - - - - - - - - - - - - - - - - - - 
+# ----------------------------------------------------------------------------------------------- 
+# ----------------------------------------------------------------------------------------------- 
+if __name__ == "__main__":
+    #generate_plots = False
+    parser = init_argparse()
+    args = parser.parse_args(sys.argv[1:])
+    #generate_plots = args.generate_plots
+    subj_opt = args.subject
+    log_dir = args.log_dir if args.log_dir else os.path.join(output_path,"logs")
+    if args.max_mem_gb and not args.batch:
+        parser.error("--max_mem_gb only applies to the --batch stages (the interactive ones run in this process)")
+    if args.batch:
+        # -- headless, so nothing should try to open a window
+        plt.switch_backend('agg')
+
+    if args.preproc:
+        # -- generate raw subjects list
+        subjects = generate_subj_list(subj_opt, os.path.join(raw_bids,"sub-*","ses-01","eeg"), 'eeg.bdf')
+        print(subjects)
+        if args.batch:
+            run_subjects(functools.partial(preprocess_subject, batch=True, low_mem=args.low_mem, ica_decim=args.ica_decim, ica_method=args.ica_method, epoch_store=args.epoch_store), [(subject_id(raw_file), raw_file) for raw_file in subjects],
+                         'preproc', log_dir, jobs=args.jobs, max_mem_gb=args.max_mem_gb)
+        else:
+            for raw_file in subjects:
+                preprocess_subject(raw_file, low_mem=args.low_mem, ica_decim=args.ica_decim, ica_method=args.ica_method, epoch_store=args.epoch_store)
+    if args.get_epoch_nums:
+        get_epoch_nums(subj_opt, jobs=args.jobs)
+    if args.reinspect_epochs:
+        # -- interactive, always one subject at a time
+        reinspect_epochs(subj_opt)
+    if args.gen_vis_erp_plots:
+        gen_vis_erp_plots(subj_opt, batch=args.batch, jobs=args.jobs, log_dir=log_dir, max_mem_gb=args.max_mem_gb)
@@ -0,0 +1,178 @@
+"""
+Memory-mapped epoch store, an alternative to the -epo.fif files for the analysis stages
+    sub-XXXXX_task-ThalHiV2_<epo>_eeg-epo.npy       - (n_epochs, n_channels, n_times) float32 array in Volts
+    sub-XXXXX_task-ThalHiV2_<epo>_eeg-epo.npy.json  - sidecar with the channel names/types/positions, sfreq, tmin,
+                                                      events, event_id, selection, drop log and metadata
+
+    np.load(..., mmap_mode='r') maps the array without reading it, so slicing a few trials or channels only
+    reads those from disk (see read_epoch_store / slice_epoch_store). The fif files stay the files the pipeline
+    checks and re-uses, the store is made from them (and says which fif it was made from, so a store is
+    re-made once its fif changes).
+
+    save_epoch_store(epochs, store_file)  - mne epochs -> store (written in chunks, epochs do not have to be loaded)
+    epoch_store_to_mne(store_file)        - store -> mne.EpochsArray (e.g., to save it as -epo.fif again)
+
+usage:
+    python thalhiv2_epoch_store.py --to_store <path>/sub-*_eeg-epo.fif
+    python thalhiv2_epoch_store.py --to_fif <path>/sub-10001_task-ThalHiV2_stim_eeg-epo.npy
+"""
+import io
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import mne
+from thalhiv2_cache import source_key, sidecar_file
+
+
+store_version = 1
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Convert ThalHiV2 epoch files between -epo.fif and the memory-mapped .npy epoch store",
+        usage="[OPTIONS] files ... ",
+    )
+    parser.add_argument("files", nargs='+', help="-epo.fif files (with --to_store) or -epo.npy files (with --to_fif)")
+    parser.add_argument("--to_store", default=False, action="store_true",
+                        help="write an -epo.npy store next to each -epo.fif file (skips stores that are up to date)")
+    parser.add_argument("--to_fif", default=False, action="store_true",
+                        help="write an -epo.fif file next to each -epo.npy store")
+    parser.add_argument("--force", default=False, action="store_true", help="re-write outputs that are already up to date")
+    return parser
+
+
+def json_default(value):
+    ''' numpy scalars in the mne objects -> python numbers '''
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+def store_file_for(epo_file):
+    ''' sub-XXXXX_..._eeg-epo.fif -> sub-XXXXX_..._eeg-epo.npy '''
+    return os.path.splitext(epo_file)[0] + '.npy'
+
+
+def fif_file_for(store_file):
+    return os.path.splitext(store_file)[0] + '.fif'
+
+
+def read_store_sidecar(store_file):
+    with open(sidecar_file(store_file)) as f:
+        sidecar = json.load(f)
+    if sidecar['metadata'] is not None:
+        sidecar['metadata'] = pd.read_json(io.StringIO(sidecar['metadata']), orient='table')
+    sidecar['times'] = (np.arange(sidecar['shape'][2]) + int(round(sidecar['tmin'] * sidecar['sfreq']))) / sidecar['sfreq']
+    return sidecar
+
+
+def epoch_store_is_current(store_file, epo_file):
+    ''' True if the store exists and was made from the current version of epo_file '''
+    if not (os.path.exists(store_file) and os.path.exists(sidecar_file(store_file))):
+        return False
+    with open(sidecar_file(store_file)) as f:
+        return json.load(f).get('source_key') == source_key(epo_file)
+
+
+def save_epoch_store(epochs, store_file, source_file=None, chunk_size=64):
+    ''' write epochs to store_file (+ sidecar), reading them chunk_size epochs at a time '''
+    n_epochs = len(epochs)
+    shape = (n_epochs, len(epochs.ch_names), len(epochs.times))
+    tmp_file = store_file + '.tmp.npy'
+    data = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=shape)
+    for start in range(0, n_epochs, chunk_size):
+        data[start:start + chunk_size] = epochs.get_data(item=np.arange(start, min(start + chunk_size, n_epochs)))
+    data.flush()
+    del data
+    montage = epochs.get_montage()
+    positions = montage.get_positions() if montage is not None else None
+    sidecar = {'version': store_version, 'dtype': 'float32', 'units': 'V', 'shape': list(shape),
+               'sfreq': epochs.info['sfreq'], 'tmin': float(epochs.tmin), 'ch_names': epochs.ch_names,
+               'ch_types': epochs.get_channel_types(), 'bads': list(epochs.info['bads']),
+               'highpass': epochs.info['highpass'], 'lowpass': epochs.info['lowpass'], 'baseline': epochs.baseline,
+               'ch_pos': {ch: list(pos) for ch, pos in positions['ch_pos'].items()} if positions else None,
+               'coord_frame': positions['coord_frame'] if positions else None,
+               'fiducials': {key: list(positions[key]) for key in ['nasion', 'lpa', 'rpa'] if positions[key] is not None} if positions else None,
+               'events': epochs.events.tolist(), 'event_id': epochs.event_id, 'selection': epochs.selection.tolist(),
+               'drop_log': [list(log) for log in epochs.drop_log], 'reject': epochs.reject,
+               'metadata': epochs.metadata.to_json(orient='table') if epochs.metadata is not None else None,
+               'source_file': os.path.basename(source_file) if source_file else None,
+               'source_key': source_key(source_file) if source_file else None}
+    # -- the array is only swapped in once it is complete, and the sidecar (which marks it as usable) goes last
+    os.replace(tmp_file, store_file)
+    with open(sidecar_file(store_file), 'w') as f:
+        json.dump(sidecar, f, default=json_default)
+    return store_file
+
+
+def read_epoch_store(store_file, mmap_mode='r'):
+    ''' (memory-mapped data array, sidecar dict with times and the metadata as a DataFrame) '''
+    return np.load(store_file, mmap_mode=mmap_mode), read_store_sidecar(store_file)
+
+
+def slice_epoch_store(store_file, epochs=None, channels=None, tmin=None, tmax=None):
+    ''' float64 copy of only the requested epochs (indices or a boolean mask), channels and time range '''
+    data, sidecar = read_epoch_store(store_file)
+    times = sidecar['times']
+    epo_idx = np.arange(data.shape[0]) if epochs is None else np.arange(data.shape[0])[epochs]
+    ch_idx = np.arange(data.shape[1]) if channels is None else np.array([sidecar['ch_names'].index(ch) for ch in channels])
+    # -- tmin/tmax are rounded to the nearest sample, like epochs.crop
+    sfreq = sidecar['sfreq']
+    time_mask = np.ones(len(times), dtype=bool)
+    if tmin is not None:
+        time_mask &= times >= (round(tmin * sfreq) - 0.5) / sfreq
+    if tmax is not None:
+        time_mask &= times <= (round(tmax * sfreq) + 0.5) / sfreq
+    time_idx = np.flatnonzero(time_mask)
+    # -- only the requested (epoch, channel) rows of the file are read, time is a contiguous slice of each row
+    out = data[epo_idx[:, None], ch_idx[None, :], time_idx[0]:time_idx[-1] + 1]
+    return out.astype(np.float64), times[time_idx]
+
+
+def epoch_store_to_mne(store_file):
+    ''' mne.EpochsArray with the data, events, metadata and drop log from the store '''
+    data, sidecar = read_epoch_store(store_file, mmap_mode=None)
+    info = mne.create_info(sidecar['ch_names'], sidecar['sfreq'], sidecar['ch_types'])
+    if sidecar['ch_pos']:
+        fiducials = sidecar['fiducials'] or {}
+        info.set_montage(mne.channels.make_dig_montage(ch_pos={ch: np.array(pos) for ch, pos in sidecar['ch_pos'].items()},
+                                                       coord_frame=sidecar['coord_frame'],
+                                                       **{key: np.array(pos) for key, pos in fiducials.items()}))
+    info['bads'] = sidecar['bads']
+    with info._unlock():
+        info['highpass'], info['lowpass'] = sidecar['highpass'], sidecar['lowpass']
+    epochs = mne.EpochsArray(data.astype(np.float64), info, events=np.array(sidecar['events'], dtype=int).reshape(-1, 3),
+                             tmin=sidecar['tmin'], event_id=sidecar['event_id'], metadata=sidecar['metadata'],
+                             selection=sidecar['selection'], drop_log=tuple(tuple(log) for log in sidecar['drop_log']),
+                             baseline=tuple(sidecar['baseline']) if sidecar['baseline'] else None, on_missing='ignore',
+                             verbose=False)
+    epochs.reject = sidecar['reject']
+    return epochs
+
+
+def main(argv):
+    args = init_argparse().parse_args(argv)
+    if args.to_store == args.to_fif:
+        print("pick one of --to_store or --to_fif")
+        return 1
+    for fname in args.files:
+        if args.to_store:
+            store_file = store_file_for(fname)
+            if not args.force and epoch_store_is_current(store_file, fname):
+                print("up to date: " + os.path.basename(store_file))
+                continue
+            save_epoch_store(mne.read_epochs(fname, preload=False, verbose=False), store_file, source_file=fname)
+            print("wrote " + os.path.basename(store_file))
+        else:
+            epo_file = fif_file_for(fname)
+            if not args.force and os.path.exists(epo_file):
+                print("exists, use --force to overwrite: " + os.path.basename(epo_file))
+                continue
+            epoch_store_to_mne(fname).save(epo_file, overwrite=True)
+            print("wrote " + os.path.basename(epo_file))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
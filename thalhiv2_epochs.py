@@ -0,0 +1,123 @@
+"""
+Epoch several event types of a trial from one read of each trial window
+    build_epochs(raw, specs, reject, ptp_info) - {name: epochs} for every entry of specs, each one the same as
+        mne.Epochs(raw, reject=reject, baseline=None, on_missing='warn', event_repeated='drop', preload=True, **spec)
+
+    specs is {name: {'events': ..., 'event_id': ..., 'tmin': ..., 'tmax': ..., 'metadata': ...}}. The anchor type
+    (trl, the whole trial) decides the rejection of its epochs from ptp_info, the peak-to-peak matrix the rejection
+    review already computed (thalhiv2_rejection.epoch_ptp), instead of reading the data again. A window of the other
+    types (cue, stim, ...) that lies inside a kept trl window passes too (its peak-to-peak can not be larger); only the
+    rest are read to check them. Arrays are allocated once the kept epochs are known, and every trl window with kept
+    epochs is read once and the cue / stim / ... windows inside it are sliced from it (windows outside every trl
+    window, e.g. a late response, are read on their own).
+
+    the result is an mne.EpochsArray with the same data, events, selection, drop log and metadata as mne.Epochs,
+    so it saves to the same -epo.fif file
+"""
+import numpy as np
+import mne
+from thalhiv2_rejection import drop_reasons, epoch_ptp, over_threshold
+
+
+def rejected_channels(ptp, ch_names, ch_types, reject, bads):
+    ''' channels over their reject limit, in the order mne.Epochs lists them in the drop log '''
+    return tuple(ch_names[ind] for key, limit in reject.items() for ind in np.flatnonzero(ch_types == key)
+                 if ptp[ind] > limit and ch_names[ind] not in bads)
+
+
+def anchor_ptp(raw, epochs, starts, n_times, reject, ptp_info):
+    ''' (ptp_info, row of each epoch in it): ptp_info if it was computed for these windows, channels and bads, else
+    epoch_ptp of the epochs' own events
+    '''
+    checked = [ch for ch, ch_type in zip(raw.ch_names, raw.get_channel_types()) if ch_type in reject]
+    if (ptp_info is not None and ptp_info['n_times'] == n_times and len(ptp_info['starts']) > epochs.selection.max(initial=-1)
+            and np.array_equal(ptp_info['starts'][epochs.selection], starts) and set(ptp_info['bads']) == set(raw.info['bads'])
+            and set(checked) <= set(ptp_info['ch_names'])):
+        return ptp_info, epochs.selection
+    return epoch_ptp(raw, epochs.events, epochs.tmin, epochs.tmax, ch_types=tuple(reject)), np.arange(len(starts))
+
+
+def build_epochs(raw, specs, reject, ptp_info=None, anchor='trl'):
+    ''' {name: epochs} for each epoch type in specs (raw has to be preloaded)
+
+    ptp_info - epoch_ptp of the anchor epochs (re-used for their rejection, computed here if it is not given or was
+               made for other windows, channels or bads)
+    '''
+    epoch_kwargs = {'baseline': None, 'on_missing': 'warn', 'event_repeated': 'drop', 'verbose': False}
+    if any(not proj['active'] for proj in raw.info['projs']):
+        # -- projections would be applied per epoch before the rejection, leave that to mne
+        return {name: mne.Epochs(raw, reject=reject, preload=True, **epoch_kwargs, **spec) for name, spec in specs.items()}
+    # -- mne sorts out which events are used (event_id, repeated events) and the metadata without reading any data
+    lazy = {name: mne.Epochs(raw, preload=False, **epoch_kwargs, **spec) for name, spec in specs.items()}
+    ch_names = raw.ch_names
+    ch_types = np.array(raw.get_channel_types())
+    bads = list(raw.info['bads'])
+    windows = {name: (epochs.events[:, 0] - raw.first_samp + int(round(epochs.tmin * raw.info['sfreq'])), len(epochs.times))
+               for name, epochs in lazy.items()}
+    drop_log = {name: list(epochs.drop_log) for name, epochs in lazy.items()}
+    kept = {name: [] for name in lazy}
+    # -- anchor windows inside the recording can be read and sliced, the kept ones vouch for the windows inside them
+    anchor_starts, anchor_n = windows[anchor] if anchor in lazy else (np.array([], dtype=int), 0)
+    readable = (anchor_starts >= 0) & (anchor_starts + anchor_n <= raw.n_times)
+    anchor_order = np.argsort(anchor_starts, kind='stable')
+    anchor_kept = np.zeros(len(anchor_starts), dtype=bool)
+    if anchor in lazy:
+        info, rows = anchor_ptp(raw, lazy[anchor], anchor_starts, anchor_n, reject, ptp_info)
+        over = over_threshold(info, reject)
+        for ind, reason in enumerate(drop_reasons(raw, anchor_starts, anchor_n)):
+            bad_tuple = (reason,) if reason else tuple(ch for key in reject for ch, ch_type, is_over in
+                                                       zip(info['ch_names'], info['ch_types'], over[rows[ind]]) if ch_type == key and is_over)
+            if bad_tuple:
+                drop_log[anchor][lazy[anchor].selection[ind]] += bad_tuple
+            else:
+                kept[anchor].append(ind)
+        anchor_kept[kept[anchor]] = True
+    # -- where each epoch is read from: (anchor index, offset) inside a readable anchor window, (-1, start) on its own
+    sources = {anchor: [(ind, 0) for ind in kept[anchor]]} if anchor in lazy else {}
+    for name, epochs in lazy.items():
+        if name == anchor:
+            continue
+        starts, n_times = windows[name]
+        # -- the anchor window starting last before the epoch (they all have the same length, so the one ending last)
+        container = np.full(len(starts), -1)
+        inside = np.zeros(len(starts), dtype=bool)
+        if len(anchor_starts):
+            before = np.searchsorted(anchor_starts[anchor_order], starts, side='right') - 1
+            container = np.where(before >= 0, anchor_order[before], -1)
+            inside = (container >= 0) & (anchor_starts[container] + anchor_n >= starts + n_times) & readable[container]
+        sources[name] = []
+        for ind, reason in enumerate(drop_reasons(raw, starts, n_times)):
+            bad_tuple = (reason,) if reason else ()
+            if not reason and not (inside[ind] and anchor_kept[container[ind]]):
+                segment = raw.get_data(start=starts[ind], stop=starts[ind] + n_times)
+                bad_tuple = rejected_channels(np.ptp(segment, axis=1), ch_names, ch_types, reject, bads)
+            if bad_tuple:
+                drop_log[name][epochs.selection[ind]] += bad_tuple
+                continue
+            kept[name].append(ind)
+            sources[name].append((container[ind], starts[ind] - anchor_starts[container[ind]]) if inside[ind] else (-1, starts[ind]))
+    # -- only the kept epochs are stored, each anchor window with kept epochs in it is read once
+    data = {name: np.empty((len(kept[name]), len(ch_names), windows[name][1])) for name in lazy}
+    by_anchor = {}
+    for name, name_sources in sources.items():
+        n_times = windows[name][1]
+        for row, (container, offset) in enumerate(name_sources):
+            if container < 0:
+                data[name][row] = raw.get_data(start=offset, stop=offset + n_times)
+            else:
+                by_anchor.setdefault(container, []).append((name, row, offset, n_times))
+    for container in sorted(by_anchor):
+        segment = raw.get_data(start=anchor_starts[container], stop=anchor_starts[container] + anchor_n)
+        for name, row, offset, n_times in by_anchor[container]:
+            data[name][row] = segment[:, offset:offset + n_times]
+    out = {}
+    for name, epochs in lazy.items():
+        keep = np.array(kept[name], dtype=int)
+        metadata = epochs.metadata.iloc[keep] if epochs.metadata is not None else None
+        out[name] = mne.EpochsArray(data.pop(name), raw.info, events=epochs.events[keep], tmin=epochs.tmin, event_id=epochs.event_id,
+                                    metadata=metadata, selection=epochs.selection[keep], drop_log=tuple(drop_log[name]),
+                                    baseline=None, on_missing='ignore', verbose=False)
+        out[name].reject = dict(reject)
+        if not len(keep):
+            print("\tall " + name + " epochs were dropped, see the drop log")
+    return out
@@ -0,0 +1,132 @@
+"""
+Lightweight reader for the -epo.fif files written by the pipeline
+    read_epochs_bookkeeping - selection, drop log and reject limits of an epochs file, without reading the data
+    epoch_counts            - kept / dropped epoch counts (by reason) of one epochs file
+    epoch_counts_table      - tidy table of the counts of many files, read in parallel (--get_epoch_nums)
+
+FIF layout
+    a fif file is a chain of tags, each one a 16 byte big-endian header (kind, type, size, next) followed by
+    size bytes of data; next is 0 if the following tag comes straight after, -1 after the last tag or else the
+    position of the following tag. Blocks are opened / closed by FIFF_BLOCK_START / FIFF_BLOCK_END tags whose
+    data is the block kind. The epochs block holds the data tag (FIFF_EPOCH, by far the largest part of the
+    file) and, after it, the selection (int32 array) and drop log (json string) tags. Only tag headers are read
+    on the way there, the data tag is jumped over, so a file costs a handful of small reads whatever its size.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+# -- FIFF constants (mne._fiff.constants.FIFF)
+FIFF_BLOCK_START = 104
+FIFF_BLOCK_END = 105
+FIFF_REF_ROLE = 115
+FIFF_REF_FILE_NAME = 118
+FIFFV_ROLE_NEXT_FILE = 2
+FIFFB_MNE_EPOCHS = 373
+FIFFB_MNE_EPOCHS_OLD = 122 # used before mne 0.11
+FIFF_MNE_EPOCHS_SELECTION = 3800
+FIFF_MNE_EPOCHS_DROP_LOG = 3801
+FIFF_MNE_EPOCHS_REJECT_FLAT = 3802
+FIFFB_REF = 118
+
+edge_reasons = ['NO_DATA', 'TOO_SHORT']
+
+
+def read_fif_tags(fname, wanted):
+    ''' {kind: [raw bytes, ...]} of the wanted tag kinds inside an epochs block, plus the next split file name '''
+    found = {kind: [] for kind in wanted}
+    next_file, ref_role = None, None
+    blocks = []
+    with open(fname, 'rb') as f:
+        pos = 0
+        while pos >= 0:
+            f.seek(pos)
+            header = f.read(16)
+            if len(header) < 16:
+                break
+            kind, _, size, next_pos = np.frombuffer(header, dtype='>i4')
+            in_epochs = bool(blocks) and blocks[-1] in (FIFFB_MNE_EPOCHS, FIFFB_MNE_EPOCHS_OLD)
+            if kind == FIFF_BLOCK_START:
+                blocks.append(int(np.frombuffer(f.read(4), dtype='>i4')[0]))
+            elif kind == FIFF_BLOCK_END and blocks:
+                blocks.pop()
+            elif kind in found and in_epochs:
+                found[kind].append(f.read(size))
+            elif kind == FIFF_REF_ROLE and blocks and blocks[-1] == FIFFB_REF:
+                ref_role = int(np.frombuffer(f.read(4), dtype='>i4')[0])
+            elif kind == FIFF_REF_FILE_NAME and blocks and blocks[-1] == FIFFB_REF and ref_role == FIFFV_ROLE_NEXT_FILE:
+                next_file = f.read(size).decode('utf-8')
+            pos = pos + 16 + int(size) if next_pos == 0 else int(next_pos)
+    return found, next_file
+
+
+def read_epochs_bookkeeping(epo_file):
+    ''' selection (np.array), drop log (tuple of tuples) and reject limits of an epochs file, following split files
+
+    gives the same selection and drop_log as mne.read_epochs(epo_file, preload=False)
+    '''
+    selection, drop_log, reject = [], None, None
+    fname = epo_file
+    while fname is not None:
+        found, next_file = read_fif_tags(fname, [FIFF_MNE_EPOCHS_SELECTION, FIFF_MNE_EPOCHS_DROP_LOG,
+                                                 FIFF_MNE_EPOCHS_REJECT_FLAT])
+        selection += [np.frombuffer(data, dtype='>i4') for data in found[FIFF_MNE_EPOCHS_SELECTION]]
+        for data in found[FIFF_MNE_EPOCHS_DROP_LOG]:
+            part_log = [tuple(log) for log in json.loads(data.decode('utf-8'))]
+            # -- every part of a split file has the full drop log, with the epochs kept in the other parts
+            # marked IGNORED, merged the way mne.read_epochs does it
+            drop_log = part_log if drop_log is None else [other if log == ('IGNORED',) and other != ('IGNORED',) else log
+                                                         for log, other in zip(drop_log, part_log)]
+        if reject is None and found[FIFF_MNE_EPOCHS_REJECT_FLAT]:
+            reject = json.loads(found[FIFF_MNE_EPOCHS_REJECT_FLAT][0].decode('utf-8')).get('reject')
+        fname = os.path.join(os.path.dirname(epo_file), next_file) if next_file else None
+    selection = np.concatenate(selection).astype(int) if selection else np.array([], dtype=int)
+    if drop_log is None:
+        # -- files written without a drop log: nothing was dropped
+        drop_log = [()] * len(selection)
+    return selection, tuple(drop_log), reject
+
+
+def epoch_counts(epo_file):
+    ''' number of events, kept epochs and dropped epochs by reason (IGNORED events, i.e. other event types, are left out) '''
+    selection, drop_log, reject = read_epochs_bookkeeping(epo_file)
+    logs = [log for log in drop_log if log != ('IGNORED',)]
+    reasons = [log[0] if log else '' for log in logs]
+    counts = {'n_events': len(logs), 'n_kept': len(selection),
+              'n_dropped_annotation': sum(reason.lower().startswith('bad') for reason in reasons),
+              'n_dropped_edge': sum(reason in edge_reasons for reason in reasons),
+              'n_dropped_duplicate': sum(reason == 'DROP DUPLICATE' for reason in reasons),
+              'n_dropped_user': sum(reason == 'USER' for reason in reasons)}
+    counts['n_dropped_rejected'] = len(logs) - counts['n_kept'] - sum(counts[key] for key in counts if key.startswith('n_dropped'))
+    counts['pct_kept'] = round(100 * counts['n_kept'] / counts['n_events'], 1) if counts['n_events'] else np.nan
+    counts['reject_eeg_uv'] = round(reject['eeg'] * 1e6, 1) if reject and 'eeg' in reject else np.nan
+    return counts
+
+
+def epoch_count_row(task):
+    ''' one row of the counts table, a missing or unreadable file gives a row with its error '''
+    subject, epoch_type, epo_file = task
+    row = {'subject': subject, 'epoch_type': epoch_type, 'status': 'ok', 'error': ''}
+    try:
+        row.update(epoch_counts(epo_file))
+    except (OSError, ValueError) as err:
+        row.update({'status': 'failed', 'error': repr(err)})
+    return row
+
+
+def epoch_counts_table(tasks, jobs=1):
+    ''' tidy (subject, epoch_type) counts table for every (subject, epoch_type, epo_file) in tasks
+
+    the reads are small and mostly waiting on the file system (e.g., NFS), so jobs files are read at once in threads
+    '''
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            rows = list(pool.map(epoch_count_row, tasks))
+    else:
+        rows = [epoch_count_row(task) for task in tasks]
+    columns = ['subject', 'epoch_type', 'status', 'n_events', 'n_kept', 'pct_kept', 'n_dropped_rejected', 'n_dropped_annotation',
+               'n_dropped_edge', 'n_dropped_duplicate', 'n_dropped_user', 'reject_eeg_uv', 'error']
+    return pd.DataFrame(rows, columns=columns).sort_values(by=['subject', 'epoch_type']).reset_index(drop=True)
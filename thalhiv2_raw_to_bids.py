@@ -1,23 +1,91 @@
+"""
+Convert the raw ThalHiV2 EEG recordings (bdf) to BIDS
+    every recording in raw_eeg_dir is written to bids_dir with write_raw_bids, with the task events decoded from the
+    Status channel (only the trigger channel is read, see thalhiv2_bdf.py) and the per-subject fixes of
+    thalhiv2_subject_exceptions.json
+
+    only new or changed recordings are converted: a manifest in bids_dir (.thalhiv2_bids_manifest.json) keeps the
+    size, mtime and sha256 of every converted bdf and the signatures of the BIDS files it produced (incl. the
+    session's scans.tsv), and a recording is converted again if any of those changed or went missing, or if
+    participants.tsv no longer lists its subject or dataset_description.json is broken (--force re-converts everything)
+
+    --jobs N converts N recordings at once in a process pool. Reading the headers and triggers runs in parallel,
+    write_raw_bids runs under an exclusive lock on bids_dir/.thalhiv2_bids.lock because it also rewrites the dataset
+    level participants.tsv and dataset_description.json; the manifest is only written by the parent process. A
+    failing recording never stops the others, the summary table at the end lists every recording with its status.
+
+    --annotate_breaks adds the same 'bad_break' annotations for the breaks between task blocks as the preprocessing
+    pipeline (thalhiv2_annotations.py), so they show up in the BIDS events.tsv
+
+    --scan converts nothing and prints one row per recording (subject, session, measurement date, duration, sampling
+    rate, number of channels and the count of every trigger code) from the bdf header and the Status channel only,
+    without loading the data; --scan_csv also saves the table
+
+usage:
+    python thalhiv2_raw_to_bids.py --jobs 4
+    python thalhiv2_raw_to_bids.py --scan --scan_csv bdf_inventory.csv
+"""
 import mne
 from mne_bids import BIDSPath, write_raw_bids
 import glob
 import os
+import sys
+import time
+import argparse
+import hashlib
+import json
+import fcntl
+import contextlib
+import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from thalpy import base
+from thalhiv2_bdf import scan_bdf_file, find_bdf_events
+from thalhiv2_subjects import get_subject_config
+from thalhiv2_annotations import block_break_annotations, events_in_recording
 import numpy as np
+import pandas as pd
+
 
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Convert raw ThalHiV2 EEG (bdf) files to BIDS format",
+        usage="[OPTIONS] ... ",
+    )
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of subjects to convert in parallel (process pool), default is 1 (serial)")
+    parser.add_argument("--force",
+                        help="re-convert every recording even if the manifest says it is up to date, default is false",
+                        default=False, action="store_true")
+    parser.add_argument("--scan",
+                        help="only read the bdf headers and trigger channel of every recording and print an inventory table, default is false",
+                        default=False, action="store_true")
+    parser.add_argument("--scan_csv", default=None,
+                        help="optional csv file to save the --scan inventory table to")
+    parser.add_argument("--annotate_breaks",
+                        help="mark the breaks between task blocks as 'bad_break' annotations in the BIDS files (same as the preprocessing pipeline), "
+                             "use with --force to add them to recordings that are already converted, default is false",
+                        default=False, action="store_true")
+    parser.add_argument("--print_events",
+                        help="print the full event array found in each recording, default is false",
+                        default=False, action="store_true")
+    return parser
 
-def generate_events(raw):
-    events_data = mne.find_events(raw, shortest_event=1)
 
-    eligible_events = set(trigDict.values())
-    ev_data_excludeIneligibleEvents = []
-    print(events_data)
-    for ev in events_data:
-        # print(ev)
-        if ev[2] in eligible_events:
-            ev_data_excludeIneligibleEvents.append(ev)
+def filter_eligible_events(events_data, eligible_codes):
+    ''' keep only rows of a (sample, prev, code) event array whose code is one of eligible_codes '''
+    events_data = np.asarray(events_data)
+    return events_data[np.isin(events_data[:, 2], eligible_codes)]
 
-    return np.asarray(ev_data_excludeIneligibleEvents)
+
+def generate_events(bdf_file, verbose=False):
+    # only the Status channel is read (see thalhiv2_bdf.py), same output as mne.find_events(raw, shortest_event=1)
+    events_data = find_bdf_events(bdf_file, shortest_event=1)
+    if verbose:
+        print(events_data)
+    # save flags are stored as bytes in trigDict so they never match a trigger code (same as before)
+    eligible_codes = [code for code in trigDict.values() if isinstance(code, int)]
+    return filter_eligible_events(events_data, eligible_codes)
 
 
 raw_eeg_dir = '/mnt/cifs/rdss/rdss_kahwang/ThalHi_data/v2_EEG_data/Raw/'
@@ -35,15 +103,144 @@ trigDict = {'startSaveflag':bytes([201]), 'stopSaveflag':bytes([255]),
             'ITI': 191}
 
 
-# convert to bids format for eeg data not already in bids dir
-os.chdir(raw_eeg_dir)
-bdf_files = glob.glob('sub-*_task-ThalHi*_eeg_*.bdf')
-print('\n\n- - - - - - - Converting EEG files to BIDS format - - - - - - -\n\n')
-print('list of files: \n', bdf_files)
-for bdf_file in bdf_files:
-    subject = base.parse_sub_from_file(bdf_file, prefix='sub-')
-    if int(subject) == 10263:
-        bdf_file = glob.glob('sub-*_task-ThalHi*_eeg2_*.bdf')[0]
+break_code = 999 # code for 'bad_break' in the BIDS events.tsv, not used by any trigger
+
+
+manifest_file = os.path.join(bids_dir, '.thalhiv2_bids_manifest.json') # dot file so the BIDS validator ignores it
+lock_file = os.path.join(bids_dir, '.thalhiv2_bids.lock')
+
+
+@contextlib.contextmanager
+def bids_lock():
+    ''' exclusive lock on lock_file for the duration of the block (waits for the other conversion workers)
+
+    write_raw_bids also reads, updates and rewrites the dataset level participants.tsv and dataset_description.json,
+    so parallel workers take turns for that call (the bdf headers and triggers are still read in parallel)
+    '''
+    os.makedirs(bids_dir, exist_ok=True)
+    with open(lock_file, 'a') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def resolve_source_file(bdf_file):
+    ''' return the bdf file that is actually converted for this recording (see raw_bdf_glob in thalhiv2_subject_exceptions.json) '''
+    subject = base.parse_sub_from_file(os.path.basename(bdf_file), prefix='sub-')
+    sub_cfg = get_subject_config(subject)
+    if sub_cfg['raw_bdf_glob']:
+        bdf_file = glob.glob(os.path.join(raw_eeg_dir, sub_cfg['raw_bdf_glob']))[0]
+    return bdf_file
+
+
+def hash_file(file_path, chunk_size=2**24):
+    ''' sha256 of a file, read in 16 MB chunks so multi-GB bdf files never sit in memory '''
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def file_signature(file_path, with_hash=True):
+    stat = os.stat(file_path)
+    sig = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if with_hash:
+        sig['sha256'] = hash_file(file_path)
+    return sig
+
+
+def load_manifest():
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest):
+    # -- write to a temp file first and swap it in so an interrupted run never leaves a half-written manifest
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def output_signatures(outputs):
+    ''' {path relative to bids_dir: size and mtime} of the BIDS files written for one recording '''
+    return {os.path.relpath(out, bids_dir): file_signature(out, with_hash=False) for out in sorted(outputs)}
+
+
+def dataset_files_ok(subject):
+    ''' True if the dataset level files write_raw_bids also writes are there and intact: dataset_description.json
+    parses and participants.tsv lists the subject (these are shared by all recordings, so they are checked for
+    content rather than against a size / mtime that every other conversion changes)
+    '''
+    try:
+        with open(os.path.join(bids_dir, 'dataset_description.json')) as f:
+            json.load(f)
+        participants = pd.read_csv(os.path.join(bids_dir, 'participants.tsv'), sep='\t', dtype=str)
+    except (OSError, ValueError, pd.errors.ParserError):
+        return False
+    return 'participant_id' in participants and ('sub-' + str(subject)) in set(participants['participant_id'])
+
+
+def is_up_to_date(source_file, manifest):
+    ''' True if the manifest entry for this source file matches it on disk, all of its BIDS outputs (including the
+    session's scans.tsv) still exist unchanged and the dataset level files are intact
+    '''
+    entry = manifest.get(os.path.basename(source_file))
+    if entry is None:
+        return False
+    if not all(os.path.exists(os.path.join(bids_dir, out)) for out in entry['outputs']):
+        return False
+    # -- entries written before output signatures were recorded only have the existence check above
+    for out, out_sig in entry.get('output_signatures', {}).items():
+        if file_signature(os.path.join(bids_dir, out), with_hash=False) != out_sig:
+            return False
+    if not dataset_files_ok(entry.get('subject') or base.parse_sub_from_file(os.path.basename(source_file), prefix='sub-')):
+        return False
+    sig = file_signature(source_file, with_hash=False)
+    if sig['size'] != entry['size']:
+        return False
+    if sig['mtime'] != entry['mtime']:
+        # -- only pay for a full hash when the cheap checks disagree (e.g., file was copied or touched)
+        if hash_file(source_file) != entry['sha256']:
+            return False
+        entry['mtime'] = sig['mtime']
+    return True
+
+
+def scan_recording(bdf_file):
+    ''' inventory row for one recording (header + trigger counts only) '''
+    subject = base.parse_sub_from_file(os.path.basename(bdf_file), prefix='sub-')
+    source_file = resolve_source_file(bdf_file)
+    eligible_codes = {name: code for name, code in trigDict.items() if isinstance(code, int)}
+    scan = {'subject': subject, 'session': ''}
+    if 'session-001' in source_file:
+        scan['session'] = '01'
+    if  'session-002' in source_file:
+        scan['session'] = '02'
+    scan.update(scan_bdf_file(source_file, eligible_codes, shortest_event=1))
+    return scan
+
+
+def scan_recordings(bdf_files, jobs=1):
+    ''' table with subject, session, duration, sampling rate and trigger counts for every recording '''
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            scans = list(pool.map(scan_recording, bdf_files))
+    else:
+        scans = [scan_recording(bdf_file) for bdf_file in bdf_files]
+    scan_df = pd.DataFrame(scans).sort_values(by=['subject', 'session']).reset_index(drop=True)
+    return scan_df.rename(columns={'blockStart': 'n_block_starts', 'blockEnd': 'n_block_stops'})
+
+
+def convert_bdf_to_bids(bdf_file, print_events=False, annotate_breaks=False):
+    ''' convert one raw bdf recording to BIDS and return a summary row for the final report '''
+    subject = base.parse_sub_from_file(os.path.basename(bdf_file), prefix='sub-')
+    bdf_file = resolve_source_file(bdf_file)
 
     print('\ncurrent file: ', bdf_file)
     raw = mne.io.read_raw_bdf(bdf_file)
@@ -53,8 +250,95 @@ for bdf_file in bdf_files:
         session = '01'
     if  'session-002' in bdf_file:
         session = '02'
-    event_data = generate_events(raw)
+    event_data = generate_events(bdf_file, verbose=print_events)
     bids_path = BIDSPath(subject=subject, task=task,  datatype='eeg', session=session,
                          root=bids_dir)
-    write_raw_bids(raw, bids_path=bids_path, overwrite=True,
-                   events_data=event_data, event_id=trigDict)
+    event_id = trigDict
+    if annotate_breaks:
+        # -- only blocks inside the part of the recording the pipeline keeps (crop / concatenate_segments)
+        sub_cfg = get_subject_config(subject)
+        sfreq = raw.info['sfreq']
+        raw.set_annotations(block_break_annotations(events_in_recording(event_data, sfreq, sub_cfg, first_samp=raw.first_samp), sfreq,
+                                                    orig_time=raw.info['meas_date'], **sub_cfg['block_breaks']))
+        event_id = dict(trigDict, bad_break=break_code)
+    with bids_lock():
+        write_raw_bids(raw, bids_path=bids_path, overwrite=True,
+                       events_data=event_data, event_id=event_id)
+    # -- record what was written so later runs can skip this recording
+    outputs = glob.glob(os.path.join(bids_path.directory, ('sub-'+subject+'_ses-'+session+'_task-'+task+'_*')))
+    outputs.append(os.path.join(bids_dir, 'sub-'+subject, 'ses-'+session, 'sub-'+subject+'_ses-'+session+'_scans.tsv'))
+    manifest_entry = file_signature(bdf_file)
+    manifest_entry['subject'] = subject
+    manifest_entry['outputs'] = sorted(os.path.relpath(out, bids_dir) for out in outputs)
+    manifest_entry['output_signatures'] = output_signatures(outputs)
+    manifest_entry['converted'] = datetime.datetime.now().isoformat(timespec='seconds')
+    return {'subject': subject, 'session': session, 'file': os.path.basename(bdf_file), 'n_events': len(event_data),
+            'manifest_entry': manifest_entry}
+
+
+def run_conversion(bdf_file, print_events=False, annotate_breaks=False):
+    ''' wrapper around convert_bdf_to_bids so one bad subject never takes down the rest of the batch '''
+    start_time = time.time()
+    try:
+        result = convert_bdf_to_bids(bdf_file, print_events=print_events, annotate_breaks=annotate_breaks)
+        result['status'] = 'ok'
+        result['error'] = ''
+    except Exception as err:
+        traceback.print_exc()
+        result = {'subject': base.parse_sub_from_file(os.path.basename(bdf_file), prefix='sub-'), 'session': '',
+                  'file': os.path.basename(bdf_file), 'n_events': np.nan,
+                  'status': 'failed', 'error': repr(err)}
+    result['seconds'] = round(time.time() - start_time, 1)
+    return result
+
+
+def main(argv):
+    args = init_argparse().parse_args(argv)
+    # convert to bids format for eeg data not already in bids dir
+    bdf_files = sorted(glob.glob(os.path.join(raw_eeg_dir, 'sub-*_task-ThalHi*_eeg_*.bdf')))
+    if args.scan:
+        print('\n\n- - - - - - - Scanning raw EEG file headers - - - - - - -\n\n')
+        scan_df = scan_recordings(bdf_files, args.jobs)
+        print(scan_df.to_string())
+        if args.scan_csv:
+            scan_df.to_csv(args.scan_csv, index=False)
+        return 0
+    print('\n\n- - - - - - - Converting EEG files to BIDS format - - - - - - -\n\n')
+    print('list of files: \n', bdf_files)
+    # -- only convert recordings that are new or have changed since the last run
+    manifest = load_manifest()
+    if not args.force:
+        up_to_date = [bdf_file for bdf_file in bdf_files if is_up_to_date(resolve_source_file(bdf_file), manifest)]
+        bdf_files = [bdf_file for bdf_file in bdf_files if bdf_file not in up_to_date]
+        print('\nskipping ', len(up_to_date), ' recordings that are already up to date in ', bids_dir)
+    print('converting ', len(bdf_files), ' new or changed recordings: \n', bdf_files)
+    results = []
+    if args.jobs > 1:
+        print('\nconverting with ', args.jobs, ' parallel jobs\n')
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(run_conversion, bdf_file, args.print_events, args.annotate_breaks): bdf_file for bdf_file in bdf_files}
+            for future in as_completed(futures):
+                result = future.result()
+                print('finished sub-' + str(result['subject']) + ' (' + result['status'] + ', ' + str(result['seconds']) + ' s)')
+                results.append(result)
+    else:
+        for bdf_file in bdf_files:
+            results.append(run_conversion(bdf_file, args.print_events, args.annotate_breaks))
+
+    # -- update the manifest once in the parent process so parallel workers never race on the file
+    for result in results:
+        if result['status'] == 'ok':
+            manifest[result['file']] = result.pop('manifest_entry')
+    save_manifest(manifest)
+
+    # -- final summary table, one row per recording
+    summary_df = pd.DataFrame(results, columns=['subject', 'session', 'file', 'n_events', 'status', 'seconds', 'error'])
+    summary_df = summary_df.sort_values(by='subject').reset_index(drop=True)
+    print('\n\n- - - - - - - BIDS conversion summary - - - - - - -\n')
+    print(summary_df.to_string())
+    print('\n', (summary_df['status'] == 'ok').sum(), ' converted, ', (summary_df['status'] != 'ok').sum(), ' failed\n')
+    return 0 if (summary_df['status'] == 'ok').all() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,179 @@
+"""
+Local registry of per-subject preprocessing parameters and usability, replacing the "Preprocessing" google sheet
+    update_subject(registry_file, sub, values)  - set some fields of one subject (e.g., the saved preprocessing parameters)
+    update_subjects(registry_file, rows)        - same for many subjects in one transaction (e.g., --get_epoch_nums)
+    read_registry(registry_file)                - one row per subject, one column per field
+    sheet_table(registry_file)                  - the same in the layout of the google sheet (Subject_ID, Usable, ...)
+
+the registry is a single sqlite file holding (subject, field, value) rows, values are stored as json so numbers stay
+numbers. Every write takes an exclusive lock on <registry_file>.lock (fcntl, which also works across machines on NFS)
+and runs as one sqlite transaction, so the --jobs workers of a stage can update it at the same time and a reader
+never sees half of an update. The rollback journal is used instead of WAL, WAL does not work on network file systems.
+
+thalhiv2_eeg_pipeline.py writes every subject's preprocessing parameters to <output_path>/preproc/thalhiv2_registry.sqlite
+(and the usable epoch numbers with --get_epoch_nums), the behavioral notebook reads its Usable flags from it; no
+network access or google credentials are needed for either
+
+usage:
+    python thalhiv2_registry.py --import_sheet Preprocessing.csv         (one time: the sheet downloaded as csv)
+    python thalhiv2_registry.py --import_params <output_path>/preproc/sub-*_preprocessingParameters.csv
+    python thalhiv2_registry.py --set 10001 Usable=0 notes="lost the last block"
+    python thalhiv2_registry.py --export_sheet Preprocessing.csv         (same columns as the google sheet)
+"""
+import os
+import re
+import sys
+import json
+import fcntl
+import sqlite3
+import argparse
+import datetime
+import contextlib
+import numpy as np
+import pandas as pd
+
+
+default_registry_file = '/data/backed_up/shared/ThalHiV2/EEG_data/preproc/thalhiv2_registry.sqlite'
+sheet_columns = ['Subject_ID', 'Usable', 'Usable_stim_epochs', 'Usable_trl_epochs', 'Usable_resp_epochs']
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Read, update and export the ThalHiV2 preprocessing registry",
+        usage="[OPTIONS] ... ",
+    )
+    parser.add_argument("--registry", default=default_registry_file, help="registry file, default is " + default_registry_file)
+    parser.add_argument("--import_sheet", default=None, help="csv export of the google sheet to load into the registry")
+    parser.add_argument("--import_params", nargs='+', default=None, help="preprocessingParameters csv files to load into the registry")
+    parser.add_argument("--set", nargs='+', default=None, metavar="SUBJECT FIELD=VALUE",
+                        help="set fields of one subject, e.g. --set 10001 Usable=0")
+    parser.add_argument("--export_sheet", default=None, help="csv file to write the registry to, in the google sheet layout")
+    return parser
+
+
+@contextlib.contextmanager
+def registry_lock(registry_file):
+    ''' exclusive lock on <registry_file>.lock for the duration of the block (waits for other writers) '''
+    os.makedirs(os.path.dirname(os.path.abspath(registry_file)), exist_ok=True)
+    with open(registry_file + '.lock', 'a') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def connect_registry(registry_file):
+    ''' connection to the registry (created if needed), transactions are started explicitly '''
+    conn = sqlite3.connect(registry_file, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("CREATE TABLE IF NOT EXISTS subject_values (subject INTEGER NOT NULL, field TEXT NOT NULL, value TEXT, "
+                 "source TEXT, updated TEXT, PRIMARY KEY (subject, field))")
+    return conn
+
+
+def encode_value(value):
+    ''' python / numpy value -> json text '''
+    if isinstance(value, np.generic):
+        value = value.item()
+    return json.dumps(value, default=str)
+
+
+def update_subjects(registry_file, rows, source=''):
+    ''' set the fields in rows ({subject: {field: value}}) for all subjects at once, as a single transaction '''
+    updated = datetime.datetime.now().isoformat(timespec='seconds')
+    values = [(int(sub), str(field), encode_value(value), source, updated)
+              for sub, fields in rows.items() for field, value in fields.items()]
+    with registry_lock(registry_file):
+        conn = connect_registry(registry_file)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO subject_values (subject, field, value, source, updated) VALUES (?, ?, ?, ?, ?) "
+                             "ON CONFLICT (subject, field) DO UPDATE SET value=excluded.value, source=excluded.source, "
+                             "updated=excluded.updated", values)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+    return len(values)
+
+
+def update_subject(registry_file, sub, values, source=''):
+    ''' set the fields in values ({field: value}) of one subject '''
+    return update_subjects(registry_file, {sub: values}, source)
+
+
+def read_registry(registry_file):
+    ''' data frame with a Subject_ID column and one column per field (fields are in the order they were first set) '''
+    if not os.path.exists(registry_file):
+        return pd.DataFrame(columns=['Subject_ID'])
+    conn = connect_registry(registry_file)
+    try:
+        long_df = pd.read_sql_query("SELECT subject, field, value FROM subject_values ORDER BY rowid", conn)
+    finally:
+        conn.close()
+    long_df['value'] = [json.loads(value) for value in long_df['value']]
+    fields = list(dict.fromkeys(long_df['field']))
+    wide_df = long_df.pivot(index='subject', columns='field', values='value').reindex(columns=fields)
+    wide_df = wide_df.rename_axis(index='Subject_ID', columns=None).reset_index()
+    return wide_df.sort_values(by='Subject_ID').reset_index(drop=True)
+
+
+def sheet_table(registry_file):
+    ''' the registry in the layout of the google sheet: its columns first (numbers as numbers), then everything else '''
+    wide_df = read_registry(registry_file)
+    for col in sheet_columns:
+        if col not in wide_df:
+            wide_df[col] = np.nan
+        elif col != 'Subject_ID':
+            wide_df[col] = pd.to_numeric(wide_df[col], errors='coerce')
+    return wide_df[sheet_columns + [col for col in wide_df.columns if col not in sheet_columns]]
+
+
+def import_sheet(registry_file, csv_file):
+    ''' load a csv export of the google sheet (every non-empty cell of every subject) '''
+    sheet_df = pd.read_csv(csv_file)
+    sheet_df = sheet_df[pd.to_numeric(sheet_df['Subject_ID'], errors='coerce').notna()]
+    rows = {int(row.pop('Subject_ID')): {field: value for field, value in row.items() if not pd.isna(value)}
+            for row in sheet_df.to_dict(orient='records')}
+    return update_subjects(registry_file, rows, source='sheet')
+
+
+def import_param_csvs(registry_file, csv_files):
+    ''' load the per-subject preprocessingParameters csv files written by thalhiv2_eeg_pipeline.py '''
+    rows = {}
+    for csv_file in csv_files:
+        sub = re.search('sub-([0-9]+)', os.path.basename(csv_file)).group(1)
+        rows[sub] = pd.read_csv(csv_file, keep_default_na=False).iloc[0].to_dict()
+    return update_subjects(registry_file, rows, source='preproc')
+
+
+def parse_assignment(text):
+    ''' FIELD=VALUE -> (field, value), the value is read as json if it can be (numbers, lists) and kept as text if not '''
+    field, value = text.split('=', 1)
+    try:
+        return field, json.loads(value)
+    except ValueError:
+        return field, value
+
+
+def main(argv):
+    args = init_argparse().parse_args(argv)
+    if args.import_sheet:
+        print("imported " + str(import_sheet(args.registry, args.import_sheet)) + " values from " + args.import_sheet)
+    if args.import_params:
+        print("imported " + str(import_param_csvs(args.registry, args.import_params)) + " values from " + str(len(args.import_params)) + " files")
+    if args.set:
+        update_subject(args.registry, args.set[0], dict(parse_assignment(text) for text in args.set[1:]), source='manual')
+    sheet_df = sheet_table(args.registry)
+    print(sheet_df[sheet_columns].to_string(index=False))
+    if args.export_sheet:
+        sheet_df.to_csv(args.export_sheet, index=False)
+        print("wrote " + args.export_sheet)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+"""
+Peak-to-peak epoch rejection worked out on a cached matrix instead of re-epoching
+    epoch_ptp(raw, events, tmin, tmax)       - peak-to-peak of every epoch and channel, computed once
+    update_ptp(ptp_info, raw, channels)      - re-compute the columns of channels that were just interpolated
+    surviving_epochs(ptp_info, reject, ...)  - which epochs mne.Epochs(..., reject=reject) would keep
+    rejection_table(ptp_info, thresholds, ...) - epochs surviving each candidate eeg threshold, with 0, 1, 2 ...
+                                               more channels interpolated (the ones that save the most epochs)
+
+epochs are dropped the same way mne.Epochs does it (drop_reasons): outside the recording, overlapping a 'bad*' annotation,
+repeated events (event_repeated='drop') or a channel of a type in reject going over its peak-to-peak limit
+(channels in info['bads'] are not checked). A channel that is going to be interpolated is left out of the check
+(the interpolated signal is a mix of its neighbours, which are checked), call update_ptp once it actually is.
+"""
+import numpy as np
+import pandas as pd
+
+
+def drop_reasons(raw, starts, n_times, reject_by_annotation=True):
+    ''' why mne.Epochs would drop each epoch before looking at the data ('' if it would not)
+
+    starts are the first samples of the epochs relative to the first sample of raw; like mne an epoch starting
+    before the recording is 'NO_DATA', one overlapping a 'bad*' annotation gets its description and one running
+    past the end is 'TOO_SHORT'
+    '''
+    starts = np.asarray(starts)
+    reasons = np.full(len(starts), '', dtype=object)
+    if reject_by_annotation:
+        sfreq = raw.info['sfreq']
+        annots = raw.annotations
+        onsets = annots.onset - raw.first_time # annotation onsets are relative to meas_date, like raw.first_time
+        for onset, duration, desc in zip(onsets, annots.duration, annots.description):
+            if desc.lower().startswith('bad'):
+                overlaps = (onset < (starts + n_times) / sfreq) & (onset + duration > starts / sfreq)
+                reasons[overlaps & (reasons == '')] = str(desc)
+    reasons[(starts + n_times > raw.n_times) & (reasons == '')] = 'TOO_SHORT'
+    reasons[starts < 0] = 'NO_DATA'
+    return reasons
+
+
+def epoch_ptp(raw, events, tmin, tmax, ch_types=('eeg', 'eog', 'emg', 'ecg'), reject_by_annotation=True):
+    ''' peak-to-peak of every epoch and channel (in Volts) plus which epochs are usable before any ptp rejection '''
+    sfreq = raw.info['sfreq']
+    types = np.array(raw.get_channel_types())
+    picks = np.flatnonzero(np.isin(types, ch_types))
+    start_offset = int(round(tmin * sfreq))
+    n_times = int(round(tmax * sfreq)) - start_offset + 1
+    starts = np.asarray(events)[:, 0] - raw.first_samp + start_offset
+    usable = drop_reasons(raw, starts, n_times, reject_by_annotation) == ''
+    # -- like event_repeated='drop', only the first of several events on the same sample is kept
+    repeated = np.ones(len(starts), dtype=bool)
+    repeated[np.unique(np.asarray(events)[:, 0], return_index=True)[1]] = False
+    usable &= ~repeated
+    ptp = np.full((len(starts), len(picks)), np.nan)
+    for ind in np.flatnonzero(usable):
+        # -- one epoch at a time, so only a single epoch of data is ever copied
+        ptp[ind] = np.ptp(raw.get_data(picks=picks, start=starts[ind], stop=starts[ind] + n_times), axis=1)
+    return {'ptp': ptp, 'ch_names': [raw.ch_names[pick] for pick in picks], 'ch_types': types[picks],
+            'usable': usable, 'starts': starts, 'n_times': n_times, 'bads': list(raw.info['bads'])}
+
+
+def update_ptp(ptp_info, raw, channels):
+    ''' re-compute the peak-to-peak columns of channels (e.g., after interpolating them in raw) '''
+    cols = [ptp_info['ch_names'].index(ch) for ch in channels]
+    for ind in np.flatnonzero(ptp_info['usable']):
+        start = ptp_info['starts'][ind]
+        ptp_info['ptp'][ind, cols] = np.ptp(raw.get_data(picks=list(channels), start=start, stop=start + ptp_info['n_times']), axis=1)
+    ptp_info['bads'] = list(raw.info['bads'])
+    return ptp_info
+
+
+def over_threshold(ptp_info, reject, ignore=()):
+    ''' (n_epochs, n_channels) True where a checked channel goes over its reject limit '''
+    limits = np.array([reject.get(ch_type, np.inf) for ch_type in ptp_info['ch_types']])
+    limits[np.isin(ptp_info['ch_names'], list(ignore) + ptp_info['bads'])] = np.inf
+    return ptp_info['ptp'] > limits[None, :]
+
+
+def surviving_epochs(ptp_info, reject, ignore=()):
+    ''' boolean mask of the epochs that are kept with these reject limits when the ignore channels are left out '''
+    return ptp_info['usable'] & ~over_threshold(ptp_info, reject, ignore).any(axis=1)
+
+
+def costly_channels(ptp_info, reject, ignore=()):
+    ''' number of epochs each channel would give back if it was left out of the check (largest first) '''
+    over = over_threshold(ptp_info, reject, ignore) & ptp_info['usable'][:, None]
+    only_reason = over & (over.sum(axis=1) == 1)[:, None]
+    return pd.Series(only_reason.sum(axis=0), index=ptp_info['ch_names']).sort_values(ascending=False)
+
+
+def best_channels_to_interpolate(ptp_info, reject, max_channels, exclude=()):
+    ''' greedy pick of up to max_channels channels that together save the most epochs '''
+    picked = []
+    for _ in range(max(max_channels, 0)):
+        n_base = surviving_epochs(ptp_info, reject, picked).sum()
+        gains = {ch: surviving_epochs(ptp_info, reject, picked + [ch]).sum() - n_base
+                 for ch, n_over in costly_channels(ptp_info, reject, picked).items()
+                 if ch not in exclude and n_over > 0}
+        if not gains or max(gains.values()) <= 0:
+            break
+        picked.append(max(gains, key=gains.get))
+    return picked
+
+
+def suggested_threshold(ptp_info, ch_type='eeg', n_mad=3.0):
+    ''' data-driven limit: median + n_mad * MAD (scaled) of the largest peak-to-peak of each usable epoch, None if
+    there is no usable epoch (or no good channel of ch_type) to base it on
+    '''
+    cols = (ptp_info['ch_types'] == ch_type) & ~np.isin(ptp_info['ch_names'], ptp_info['bads'])
+    if not ptp_info['usable'].any() or not cols.any():
+        return None
+    worst = np.max(ptp_info['ptp'][ptp_info['usable']][:, cols], axis=1)
+    med = np.median(worst)
+    return med + n_mad * 1.4826 * np.median(np.abs(worst - med))
+
+
+def rejection_table(ptp_info, reject, thresholds, max_channels, exclude=()):
+    ''' epochs kept for each candidate eeg threshold with 0 .. max_channels of the most costly channels interpolated '''
+    rows = []
+    for threshold in thresholds:
+        cur_reject = dict(reject, eeg=threshold)
+        best = best_channels_to_interpolate(ptp_info, cur_reject, max_channels, exclude)
+        for n_interp in range(len(best) + 1):
+            n_kept = int(surviving_epochs(ptp_info, cur_reject, best[:n_interp]).sum())
+            rows.append({'eeg_threshold_uv': round(threshold * 1e6, 1), 'interpolate': ' '.join(best[:n_interp]),
+                         'n_kept': n_kept, 'pct_kept': round(100 * n_kept / len(ptp_info['usable']), 1)})
+    return pd.DataFrame(rows)
@@ -0,0 +1,189 @@
+"""
+Run one pipeline stage for many subjects in a pool of worker processes
+    run_subjects(func, tasks, jobs=N, ...) calls func(arg) for every (subject, arg) in tasks, N at a time, and
+
+        * gives every subject its own log file (everything the stage prints, including mne and tracebacks)
+        * caps the resident memory of each worker (max_mem_gb), a subject that goes over fails with a MemoryError
+          instead of taking the whole node (and the other subjects) down
+        * splits the cores between the workers so numpy/scipy threads do not oversubscribe the machine
+        * never lets one failing subject stop the rest, and prints a summary table at the end; a worker that dies
+          outright (OOM killer, segfault) fails its subject and the subjects still to do are run in a new pool
+
+    with max_mem_gb set the subjects always run in workers, also with jobs=1 (the cap is enforced by signalling the
+    worker's main thread, which would end the whole run in the parent process)
+
+    each subject runs in a fresh process so memory is handed back to the system between subjects
+"""
+import os
+import sys
+import time
+import signal
+import resource
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+
+
+_thread_env_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def rss_bytes():
+    ''' resident anonymous memory of this process (linux, RssAnon in /proc/self/status): the arrays it allocated,
+    without the pages of memory-mapped files, which the system can always drop again
+    '''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def memory_exceeded(signum, frame):
+    raise MemoryError("resident memory went over the --max_mem_gb cap of this worker")
+
+
+def limit_memory(max_mem_gb, interval=0.5):
+    ''' watch the resident memory of the current (worker) process, going over max_mem_gb raises MemoryError in it
+
+    the cap is on resident anonymous memory (see rss_bytes) rather than the address space (RLIMIT_AS), so
+    memory-mapped files (e.g., the whole BDF file read_status_channel maps) and reserved but untouched memory
+    (malloc arenas, BLAS buffers) do not count. The check runs every interval seconds, a MemoryError is raised in the main thread as soon as
+    it is back in python; allocations inside one long compiled call can still overshoot until then (and if the
+    node runs out first, the OOM killer ends the worker, which run_subjects reports as a failed subject)
+    '''
+    if not max_mem_gb or not os.path.exists('/proc/self/status'):
+        return
+    max_bytes = int(max_mem_gb * 1024**3)
+    signal.signal(signal.SIGUSR1, memory_exceeded)
+    def watch():
+        while True:
+            time.sleep(interval)
+            if rss_bytes() > max_bytes:
+                os.kill(os.getpid(), signal.SIGUSR1)
+                time.sleep(5 * interval) # one signal at a time, let the subject fail
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def peak_rss_mb():
+    ''' peak resident memory of the current process in MB (ru_maxrss is in kB on linux) '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_logged(func, subject, arg, stage, log_file):
+    ''' func(arg) with stdout/stderr sent to log_file, returns a summary row (never raises) '''
+    start = time.time()
+    row = {'subject': subject, 'stage': stage, 'status': 'ok', 'error': '', 'log': log_file, 'result': None}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    with open(log_file, 'w') as log:
+        # -- redirect at the file descriptor level so output from mne and compiled code ends up in the log too
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            row['result'] = func(arg)
+        except BaseException as err:
+            traceback.print_exc()
+            row['status'] = 'failed'
+            row['error'] = repr(err)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+    row['seconds'] = round(time.time() - start, 1)
+    row['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return row
+
+
+def report_row(row):
+    print("\tsub-" + str(row['subject']) + " " + row['status'] + " (" + str(row['seconds']) + " s)")
+
+
+def died_row(subject, stage, log_file, err):
+    ''' summary row of a subject whose worker process died (no result, its log ends where the process did) '''
+    return {'subject': subject, 'stage': stage, 'status': 'failed', 'log': log_file, 'result': None, 'seconds': None,
+            'peak_rss_mb': None, 'error': 'worker process died (killed, e.g. by the OOM killer, or crashed): ' + repr(err)}
+
+
+def run_pool(func, items, stage, jobs, max_mem_gb):
+    ''' run the (index, subject, arg, log_file) items in one pool, at most jobs of them submitted at a time, returns
+    ({index: row}, items that were running when the pool broke (a worker died), items not started yet)
+    '''
+    rows, running, waiting, broken = {}, {}, list(items), False
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=limit_memory, initargs=(max_mem_gb,), max_tasks_per_child=1) as pool:
+        while (waiting or running) and not broken:
+            # -- only as many subjects as workers are handed to the pool, so a broken pool leaves the others waiting
+            while waiting and len(running) < jobs:
+                index, subject, arg, log_file = item = waiting.pop(0)
+                running[pool.submit(run_logged, func, subject, arg, stage, log_file)] = item
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    broken = True # BrokenProcessPool, run_logged itself never raises
+                    continue
+                index = running.pop(future)[0]
+                rows[index] = future.result()
+                report_row(rows[index])
+    return rows, sorted(running.values()), waiting
+
+
+def run_subjects(func, tasks, stage, log_dir, jobs=1, max_mem_gb=None):
+    ''' run func(arg) for each (subject, arg) pair in tasks, jobs at a time, and return the summary rows (in task order)
+
+    func has to be a module level function (or functools.partial of one) so it can be sent to the workers
+    '''
+    os.makedirs(log_dir, exist_ok=True)
+    log_files = [os.path.join(log_dir, "sub-" + str(subject) + "_" + stage + ".log") for subject, _ in tasks]
+    print("\nrunning " + stage + " for " + str(len(tasks)) + " subjects with " + str(jobs) + " worker(s), logs in " + log_dir + "\n")
+    rows = {}
+    saved_env = {var: os.environ.get(var) for var in _thread_env_vars + ['MPLBACKEND']}
+    try:
+        if jobs > 1 or max_mem_gb:
+            # -- workers are started fresh (spawn) so the thread limits below are picked up when numpy loads; with
+            # one job and a memory cap the subjects still run in a (single) worker so the cap cannot end the whole run
+            threads = str(max(1, (os.cpu_count() or 1) // jobs))
+            for var in _thread_env_vars:
+                os.environ[var] = threads
+            os.environ['MPLBACKEND'] = 'agg'
+            pending = [(index, subject, arg, log_file) for index, ((subject, arg), log_file) in enumerate(zip(tasks, log_files))]
+            while pending:
+                done, suspects, pending = run_pool(func, pending, stage, jobs, max_mem_gb)
+                rows.update(done)
+                if suspects:
+                    # -- which of the running subjects killed the worker is unknown, so each of them is re-run in a pool
+                    # of its own (a pool that breaks then points at its subject), the rest go back to the parallel pool
+                    print("\n\ta worker process died, re-running the " + str(len(suspects)) + " subject(s) it was running one at a time\n")
+                for index, subject, arg, log_file in suspects:
+                    done, died, _ = run_pool(func, [(index, subject, arg, log_file)], stage, 1, max_mem_gb)
+                    rows.update(done)
+                    if died:
+                        rows[index] = died_row(subject, stage, log_file, BrokenProcessPool())
+                        report_row(rows[index])
+        else:
+            for index, ((subject, arg), log_file) in enumerate(zip(tasks, log_files)):
+                rows[index] = run_logged(func, subject, arg, stage, log_file)
+                report_row(rows[index])
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        results = [rows[index] for index in sorted(rows)]
+        print_summary(results, stage)
+    return results
+
+
+def print_summary(results, stage):
+    print('\n\n - - - - - ' + stage + ' summary - - - - - -\n')
+    summary = pd.DataFrame(results, columns=['subject', 'status', 'seconds', 'peak_rss_mb', 'error', 'log'])
+    print(summary.to_string(index=False))
+    n_failed = int((summary['status'] != 'ok').sum())
+    print("\n" + str(len(summary) - n_failed) + " ok, " + str(n_failed) + " failed\n")
@@ -0,0 +1,62 @@
+"""
+Per-subject exceptions for the ThalHiV2 EEG data
+    every subject-specific fix (crops, re-joined recordings, dropped events, behavioral row patches, ...)
+    lives in thalhiv2_subject_exceptions.json so the BIDS conversion, the preprocessing pipeline and the
+    behavioral notebook all apply the same fixes
+
+    get_subject_config(sub)          - defaults merged with the entry for that subject
+    behavior_files(sub, data_dir)    - sorted list of the behavioral block csv files to use
+    fix_behavior_block(df, bf, cfg)  - apply the registered row fixes to one behavioral block
+"""
+import os
+import re
+import glob
+import copy
+import json
+
+
+registry_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thalhiv2_subject_exceptions.json')
+_registry_cache = {}
+
+
+def load_registry(fname=registry_file):
+    if fname not in _registry_cache:
+        with open(fname) as f:
+            _registry_cache[fname] = json.load(f)
+    return _registry_cache[fname]
+
+
+def get_subject_config(sub, registry=None):
+    ''' registry defaults updated with everything registered for this subject '''
+    if registry is None:
+        registry = load_registry()
+    cfg = copy.deepcopy(registry['defaults'])
+    cfg.update(copy.deepcopy(registry['subjects'].get(str(int(sub)), {})))
+    cfg['sub'] = str(int(sub))
+    return cfg
+
+
+def behavior_files(sub, data_dir, cfg=None):
+    if cfg is None:
+        cfg = get_subject_config(sub)
+    return sorted(glob.glob(os.path.join(data_dir, cfg['behavior_glob'].format(sub=cfg['sub']))))
+
+
+def block_from_filename(fname):
+    bid = re.search("block-([0-9]{3})", os.path.basename(fname))
+    return int(bid.group(1)) if bid else None
+
+
+def fix_behavior_block(df, fname, cfg):
+    ''' apply the registered behavioral fixes for the block stored in fname (returns a new data frame) '''
+    block = block_from_filename(fname)
+    for fix in cfg['behavior_fixes']:
+        if fix['block'] != block:
+            continue
+        df = df.copy()
+        for start, stop in fix.get('drop_rows', []):
+            df = df.drop(range(start, stop))
+        for row, values in fix.get('set_values', {}).items():
+            for col, val in values.items():
+                df.loc[int(row), col] = val
+    return df